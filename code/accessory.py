@@ -1,13 +1,14 @@
 """Module to handle hap protocol."""
 
 import logging
-import time
+import threading
 
 from pyhap.accessory import Accessory
 from pyhap.const import CATEGORY_DOOR_LOCK
 
+from lockstate import LockStateChange, LockStateMachine
 from service import Service
-from mqtt import Mqtt
+from mqtt import MqttLock
 from prometheus import AppMetrics
 
 log = logging.getLogger()
@@ -22,18 +23,29 @@ class Lock(Accessory):
             self,
             *args,
             should_relock:bool,
-            mqtt:Mqtt,
+            mqtt:MqttLock,
             metrics:AppMetrics,
             service: Service,
+            relock_delay:float=1.0,
+            timer_factory=threading.Timer,
             **kwargs):
         super().__init__(*args, **kwargs)
         self._last_client_public_keys = None
 
-        self._lock_target_state = 0
-        self._lock_current_state = 0
+        self.lock_state = LockStateMachine()
+        # Guards lock state against concurrent NFC, HAP, MQTT and relock timer threads
+        self._state_lock = threading.RLock()
+        self._relock_timer = None
+        self._timer_factory = timer_factory
 
         self.service = service
         self.service.on_endpoint_authenticated = self.on_endpoint_authenticated
+        self.service.on_transaction_traced = metrics.transaction_traced
+        self.service.on_nfc_polled = metrics.nfc_polled
+        self.service.on_protocol_error = metrics.protocol_error
+        self.service.on_reader_connected = metrics.reader_connected
+        self.service.repository.on_saved = metrics.repository_saved
+        metrics.track_service(self.service)
         self.add_lock_service()
         self.add_nfc_access_service()
 
@@ -41,47 +53,84 @@ class Lock(Accessory):
 
         self.mqtt = mqtt
         self.mqtt.update_callback = self.mqtt_update_callback
-        self.mqtt.update_state(target_locked=bool(self._lock_target_state),
-                               current_locked=bool(self._lock_current_state))
+        self.mqtt.on_reconnected = metrics.mqtt_reconnected
+        self.mqtt.on_message_dropped = metrics.mqtt_message_dropped
+        self.mqtt.on_relock_delay = self.set_relock_delay
+        self.mqtt.on_reannounce = self.publish_lock_state
+        self.publish_lock_state()
+        self.lock_state.subscribe(self.on_lock_state_changed)
 
         self.should_relock = should_relock
+        self.relock_delay = relock_delay
 
     def on_endpoint_authenticated(self, endpoint):
         """Handle lock authentication."""
         endpoint_id = endpoint.id.hex()
         self.mqtt.device_passed_auth(endpoint_id)
-        self._lock_target_state = 0 if self._lock_current_state else 1
-        log.info("NFC Authed for device: %s", endpoint_id)
-        log.debug("Toggling lock state due to endpoint authentication event %s -> %s %s",
-                  self._lock_target_state, self._lock_current_state, endpoint)
-        self.lock_target_state.set_value(self._lock_target_state, should_notify=True)
-        self.mqtt.update_state(target_locked=bool(self._lock_target_state),
-                               current_locked=bool(self._lock_current_state))
-        self.metrics.lock_updated(target_locked=bool(self._lock_target_state),
-                               current_locked=bool(self._lock_current_state),
-                               key_id=endpoint_id)
-        self._lock_current_state = self._lock_target_state
-        self.lock_current_state.set_value(self._lock_current_state, should_notify=True)
-        self.mqtt.update_state(target_locked=bool(self._lock_target_state),
-                               current_locked=bool(self._lock_current_state))
-        self.metrics.lock_updated(target_locked=bool(self._lock_target_state),
-                               current_locked=bool(self._lock_current_state),
-                               key_id=endpoint_id)
-        if self.should_relock and not bool(self._lock_target_state):
-            time.sleep(1)
-            self._lock_target_state = 1
-            self.mqtt.update_state(target_locked=bool(self._lock_target_state),
-                                   current_locked=bool(self._lock_current_state))
-            self.metrics.lock_updated(target_locked=bool(self._lock_target_state),
-                                current_locked=bool(self._lock_current_state),
-                                key_id=endpoint_id)
-            self._lock_current_state = 1
-            self.mqtt.update_state(target_locked=bool(self._lock_target_state),
-                                   current_locked=bool(self._lock_current_state))
-            self.metrics.lock_updated(target_locked=bool(self._lock_target_state),
-                                current_locked=bool(self._lock_current_state),
-                                key_id=endpoint_id)
-
+        with self._state_lock:
+            # A tap while relock is pending keeps the lock open and restarts the delay
+            locked = False if self._cancel_relock() else not self.lock_state.state.current_locked
+            log.info("NFC Authed for device: %s", endpoint_id)
+            log.debug("Toggling lock state due to endpoint authentication event %s -> %s %s",
+                      self.lock_state.state, locked, endpoint)
+            self.lock_state.set_locked(locked, key_id=endpoint_id)
+            if self.should_relock and not locked:
+                self._schedule_relock(endpoint_id)
+
+    def on_lock_state_changed(self, change:LockStateChange):
+        """Fan out a lock state change to HAP, MQTT and metrics."""
+        if change.target_changed:
+            self.lock_target_state.set_value(int(change.state.target_locked), should_notify=True)
+        if change.current_changed:
+            self.lock_current_state.set_value(int(change.state.current_locked), should_notify=True)
+        self.mqtt.update_state(target_locked=change.state.target_locked,
+                               current_locked=change.state.current_locked)
+        self.metrics.lock_updated(target_locked=change.state.target_locked,
+                                  current_locked=change.state.current_locked,
+                                  key_id=change.key_id or "Homekit",
+                                  unlocked=change.unlocked)
+
+    def set_relock_delay(self, delay:float):
+        """Set relock delay, applies to relocks scheduled from now on."""
+        log.info("Relock delay set to %s seconds", delay)
+        with self._state_lock:
+            self.relock_delay = delay
+
+    def publish_lock_state(self):
+        """Publish current lock state to mqtt again."""
+        state = self.lock_state.state
+        self.mqtt.update_state(target_locked=state.target_locked,
+                               current_locked=state.current_locked)
+
+    def _schedule_relock(self, key_id:str):
+        """Lock again after relock_delay without blocking the caller."""
+        timer = self._timer_factory(self.relock_delay, lambda: self._relock(key_id, timer))
+        timer.daemon = True
+        self._relock_timer = timer
+        timer.start()
+
+    def _cancel_relock(self) -> bool:
+        """Cancel pending relock, returns True if there was one."""
+        timer, self._relock_timer = self._relock_timer, None
+        if timer is None:
+            return False
+        timer.cancel()
+        return True
+
+    def _relock(self, key_id:str, timer):
+        with self._state_lock:
+            if self._relock_timer is not timer:
+                # Cancelled while waiting for the state lock
+                return
+            self._relock_timer = None
+            log.info("Relocking after %s seconds", self.relock_delay)
+            self.lock_state.set_locked(True, key_id=key_id)
+
+    async def stop(self):
+        """Cancel pending relock when driver stops."""
+        with self._state_lock:
+            self._cancel_relock()
+        await super().stop()
 
     def add_preload_service(self, service, chars=None, unique_id=None):
         """Create a service with the given name and add it to this acc."""
@@ -167,12 +216,12 @@ class Lock(Accessory):
     def get_lock_current_state(self):
         """Get lock current state."""
         log.info("get_lock_current_state")
-        return self._lock_current_state
+        return int(self.lock_state.state.current_locked)
 
     def get_lock_target_state(self):
         """Handle getting lock current target state."""
         log.info("get_lock_target_state")
-        return self._lock_target_state
+        return int(self.lock_state.state.target_locked)
 
     def mqtt_update_callback(self, set_locked:bool):
         """Set the mqtt call back when mqtt updates the state."""
@@ -181,13 +230,12 @@ class Lock(Accessory):
     def set_lock_target_state(self, value): #Value is 1 for locked
         """Set the locks taget state."""
         log.info("set_lock_target_state %s", value)
-        self._lock_target_state = self._lock_current_state = value
-        self.lock_current_state.set_value(self._lock_current_state, should_notify=True)
-        self.mqtt.update_state(target_locked=bool(self._lock_target_state),
-                               current_locked=bool(self._lock_current_state))
-        self.metrics.lock_updated(target_locked=bool(self._lock_target_state),
-                               current_locked=bool(self._lock_current_state))
-        return self._lock_target_state
+        self.service.mark_activity()
+        with self._state_lock:
+            # Explicit command overrides pending relock
+            self._cancel_relock()
+            self.lock_state.set_locked(bool(value))
+            return value
 
     def get_lock_version(self):
         """Get lock version."""
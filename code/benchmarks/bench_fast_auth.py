@@ -0,0 +1,156 @@
+"""Measures FAST tap-to-unlock time against the number of provisioned endpoints.
+
+Run from the code directory: python -m benchmarks.bench_fast_auth
+The device is the least recently used endpoint, which is the worst case for the search
+"""
+
+import os
+import time
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from cryptogram import EndpointKeyIndex, create_cryptogram_matcher, derive_fast_keys
+from entity import Context, Endpoint, Enrollments, Interface, Issuer, KeyType
+from homekey import read_homekey
+from util.crypto import get_ec_key_public_points
+from util.iso7816 import ISO7816Response, ISO7816Tag
+from util.structable import pack
+from util.tlv import BERTLV as TLV
+
+ENDPOINT_COUNTS = (1, 16, 128, 1024)
+WORKERS = (0, 2, 4)
+REPEATS = 20
+ENDPOINTS_PER_ISSUER = 16
+
+PROTOCOL_VERSION = b"\x02\x00"
+FLAGS = bytes([0x01, 0x01])
+
+
+class Device:
+    """Answers SELECT, AUTH0 and CONTROL FLOW the way a phone in FAST mode would"""
+
+    def __init__(self, endpoint, reader_public_key_x, reader_identifier):
+        self.endpoint = endpoint
+        self.reader_public_key_x = reader_public_key_x
+        self.reader_identifier = reader_identifier
+        self.ephemeral_public_key = ec.generate_private_key(ec.SECP256R1()).public_key()
+
+    def transceive(self, data):
+        ins = data[1]
+        if ins == 0xA4:
+            response = ISO7816Response(
+                sw1=0x90, sw2=0x00, data=TLV(0x5C, value=PROTOCOL_VERSION)
+            )
+        elif ins == 0x80:
+            response = self.auth0(data)
+        else:
+            response = ISO7816Response(sw1=0x90, sw2=0x00)
+        return pack(response)
+
+    def auth0(self, data):
+        tlv_array = TLV.unpack_array(data[5:])
+        reader_ephemeral_public_key_x = bytes(tlv_array[1].value[1:33])
+        transaction_identifier = bytes(tlv_array[2].value)
+        x, y = get_ec_key_public_points(self.ephemeral_public_key)
+        info = pack(
+            (
+                self.reader_public_key_x,
+                Context.VOLATILE_FAST,
+                self.reader_identifier,
+                self.endpoint.public_key[1:33],
+                Interface.CONTACTLESS,
+                TLV(0x5C, value=[PROTOCOL_VERSION]),
+                TLV(0x5C, value=PROTOCOL_VERSION),
+                reader_ephemeral_public_key_x,
+                transaction_identifier,
+                FLAGS,
+                x,
+            )
+        )
+        cryptogram = derive_fast_keys(self.endpoint.persistent_key, info)[:16]
+        return ISO7816Response(
+            sw1=0x90,
+            sw2=0x00,
+            data=[TLV(0x86, value=bytes([0x04, *x, *y])), TLV(0x9D, value=cryptogram)],
+        )
+
+
+def generate_issuers(endpoint_count):
+    endpoints = []
+    for index in range(endpoint_count):
+        x, y = get_ec_key_public_points(
+            ec.generate_private_key(ec.SECP256R1()).public_key()
+        )
+        endpoints.append(
+            Endpoint(
+                last_used_at=endpoint_count - index,
+                counter=0,
+                key_type=KeyType.SECP256R1,
+                public_key=bytes([0x04, *x, *y]),
+                persistent_key=os.urandom(32),
+                enrollments=Enrollments(hap=None, attestation=None),
+            )
+        )
+    return [
+        Issuer(
+            public_key=os.urandom(32),
+            endpoints=endpoints[offset : offset + ENDPOINTS_PER_ISSUER],
+        )
+        for offset in range(0, endpoint_count, ENDPOINTS_PER_ISSUER)
+    ]
+
+
+def measure(issuers, index, matcher, device, reader_private_key, reader_identifier):
+    timings = []
+    for _ in range(REPEATS):
+        tag = ISO7816Tag(device)
+        start = time.perf_counter()
+        _, _, endpoint = read_homekey(
+            tag,
+            reader_identifier=reader_identifier,
+            reader_private_key=reader_private_key,
+            issuers=issuers,
+            preferred_versions=[PROTOCOL_VERSION],
+            endpoint_index=index,
+            matcher=matcher,
+        )
+        timings.append(time.perf_counter() - start)
+        assert endpoint is not None and endpoint.id == device.endpoint.id
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    reader_private_key = os.urandom(32)
+    reader_identifier = os.urandom(16)
+    reader_public_key_x, _ = get_ec_key_public_points(
+        ec.derive_private_key(
+            int.from_bytes(reader_private_key, "big"), ec.SECP256R1()
+        ).public_key()
+    )
+
+    header = "endpoints".rjust(10) + "".join(
+        (f"{workers} workers" if workers > 1 else "serial").rjust(14)
+        for workers in WORKERS
+    )
+    print("Median tap-to-unlock time in ms, device is least recently used endpoint")
+    print(header)
+    for endpoint_count in ENDPOINT_COUNTS:
+        issuers = generate_issuers(endpoint_count)
+        index = EndpointKeyIndex(issuers)
+        device = Device(
+            issuers[-1].endpoints[-1], reader_public_key_x, reader_identifier
+        )
+        row = str(endpoint_count).rjust(10)
+        for workers in WORKERS:
+            matcher = create_cryptogram_matcher(workers)
+            median = measure(
+                issuers, index, matcher, device, reader_private_key, reader_identifier
+            )
+            matcher.close()
+            row += f"{median * 1000:.2f}".rjust(14)
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Measures how long a tap keeps the NFC thread busy with MQTT updates against a slow broker.
+
+Run from the code directory: python -m benchmarks.bench_mqtt
+"""
+
+import time
+from types import SimpleNamespace
+
+from mqtt import MqttPublisher
+
+TAPS = 20
+# Calls made by Lock.on_endpoint_authenticated for an unlock with relock
+STATES = ("unlocked", "unlocked", "unlocked", "locked", "locked")
+
+
+class SlowClient:
+    def __init__(self, latency):
+        self.latency = latency
+        self.published = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        time.sleep(self.latency)
+        self.published += 1
+        return SimpleNamespace(rc=0)
+
+
+def handle_tap(publish):
+    publish("lock/key_id_authed", "0123456789abcdef")
+    for state in STATES:
+        publish("lock/mqtt_state_topic", state, 0, True)
+
+
+def main():
+    print(
+        "latency".ljust(10)
+        + "direct".rjust(12)
+        + "queued".rjust(12)
+        + "published".rjust(12)
+    )
+    for latency in (0.0, 0.001, 0.01, 0.05):
+        client = SlowClient(latency)
+        started = time.perf_counter()
+        for _ in range(TAPS):
+            handle_tap(client.publish)
+        direct = (time.perf_counter() - started) / TAPS
+
+        client = SlowClient(latency)
+        publisher = MqttPublisher(client)
+        publisher.set_connected(True)
+        publisher.start()
+        started = time.perf_counter()
+        for _ in range(TAPS):
+            handle_tap(publisher.publish)
+        queued = (time.perf_counter() - started) / TAPS
+        publisher.stop(timeout=60)
+
+        print(
+            f"{latency * 1000:.0f}ms".ljust(10)
+            + f"{direct * 1e6:.0f}us".rjust(12)
+            + f"{queued * 1e6:.0f}us".rjust(12)
+            + f"{client.published}/{TAPS * (len(STATES) + 1)}".rjust(12)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Measures packing of structures that are built on every Home Key transaction.
+
+Run from the code directory: python -m benchmarks.bench_pack
+"""
+
+import os
+import timeit
+
+from entity import Context, Interface
+from util.iso7816 import ISO7816Command
+from util.structable import pack
+from util.tlv import BERTLV as TLV
+
+REPEATS = 20000
+
+PROTOCOL_VERSION = b"\x02\x00"
+
+
+def auth0_command():
+    return ISO7816Command(
+        cla=0x80,
+        ins=0x80,
+        p1=0x01,
+        p2=0x01,
+        data=pack(
+            [
+                TLV(0x5C, value=PROTOCOL_VERSION),
+                TLV(0x87, value=bytes([0x04, *os.urandom(64)])),
+                TLV(0x4C, value=os.urandom(16)),
+                TLV(0x4D, value=os.urandom(24)),
+            ]
+        ),
+    )
+
+
+def nested_tlv():
+    return TLV(
+        0x70,
+        value=[
+            TLV(0x5C, value=[PROTOCOL_VERSION, b"\x01\x00"]),
+            TLV(0x71, value=[TLV(0x9E, value=os.urandom(64))]),
+            TLV(0x4E, value=os.urandom(6)),
+        ],
+    )
+
+
+def fast_auth_info():
+    return (
+        os.urandom(32),
+        Context.VOLATILE_FAST,
+        os.urandom(24),
+        os.urandom(32),
+        Interface.CONTACTLESS,
+        TLV(0x5C, value=[PROTOCOL_VERSION]),
+        TLV(0x5C, value=PROTOCOL_VERSION),
+        os.urandom(32),
+        os.urandom(16),
+        bytes([0x01, 0x01]),
+        os.urandom(32),
+    )
+
+
+def main():
+    command = auth0_command()
+    tlv = nested_tlv()
+    info = fast_auth_info()
+    cases = {
+        "ISO7816Command.pack": command.pack,
+        "BERTLV.pack": tlv.pack,
+        "fast_auth info": lambda: pack(info),
+    }
+    print(f"Microseconds per call, {REPEATS} repeats")
+    for name, function in cases.items():
+        duration = timeit.timeit(function, number=REPEATS)
+        print(name.ljust(22) + f"{duration / REPEATS * 1e6:.2f}".rjust(10))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Measures repository save, load and lookup paths.
+
+Run from the code directory: python -m benchmarks.bench_repository
+"""
+
+import logging
+import os
+import tempfile
+import timeit
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from entity import Endpoint, Enrollments, Issuer, KeyType
+from homekey import find_endpoint_by_id_in_issuers
+from repository import Repository
+from util.crypto import get_ec_key_public_points
+
+ISSUERS = 8
+ENDPOINTS_PER_ISSUER = 16
+REPEATS = 200
+
+
+def generate_issuers():
+    issuers = []
+    for _ in range(ISSUERS):
+        endpoints = []
+        for _ in range(ENDPOINTS_PER_ISSUER):
+            x, y = get_ec_key_public_points(
+                ec.generate_private_key(ec.SECP256R1()).public_key()
+            )
+            endpoints.append(
+                Endpoint(
+                    last_used_at=0,
+                    counter=0,
+                    key_type=KeyType.SECP256R1,
+                    public_key=bytes([0x04, *x, *y]),
+                    persistent_key=os.urandom(32),
+                    enrollments=Enrollments(hap=None, attestation=None),
+                )
+            )
+        issuers.append(Issuer(public_key=os.urandom(32), endpoints=endpoints))
+    return issuers
+
+
+def report(name, seconds, repeats=REPEATS):
+    print(f"{name:<40}{seconds / repeats * 1_000_000:>12.1f} us")
+
+
+def main():
+    # Repository complains about the missing storage file on first start
+    logging.disable(logging.ERROR)
+    issuers = generate_issuers()
+    last_endpoint = issuers[-1].endpoints[-1]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "homekey.json")
+        repository = Repository(path)
+        repository.upsert_issuers(issuers)
+        # Restart once so that the journal is compacted into the snapshot
+        repository = Repository(path)
+
+        print(f"{ISSUERS * ENDPOINTS_PER_ISSUER} endpoints in {ISSUERS} issuers")
+        report(
+            "Endpoint.id",
+            timeit.timeit(lambda: last_endpoint.id, number=REPEATS * 100),
+            REPEATS * 100,
+        )
+        report(
+            "find_endpoint_by_id_in_issuers",
+            timeit.timeit(
+                lambda: find_endpoint_by_id_in_issuers(issuers, last_endpoint.id),
+                number=REPEATS,
+            ),
+        )
+        report(
+            "Repository.get_endpoint_by_id",
+            timeit.timeit(
+                lambda: repository.get_endpoint_by_id(last_endpoint.id),
+                number=REPEATS,
+            ),
+        )
+        report(
+            "Issuer.to_dict (all issuers)",
+            timeit.timeit(lambda: [i.to_dict() for i in issuers], number=REPEATS),
+        )
+        report(
+            "Repository.upsert_issuers (all issuers)",
+            timeit.timeit(lambda: repository.upsert_issuers(issuers), number=REPEATS),
+        )
+        report(
+            "Repository load",
+            timeit.timeit(lambda: Repository(path), number=REPEATS // 10),
+            REPEATS // 10,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Compares BER-TLV parsing against the previous repack-to-measure implementation.
+
+Run from the code directory: python -m benchmarks.bench_tlv
+Inputs are shaped like SELECT, AUTH0, AUTH1 and ENVELOPE responses of a Home Key transaction
+"""
+
+import os
+import timeit
+
+from util.generic import get_tlv_tag
+from util.structable import pack
+from util.tlv import BERTLV, BERTLVLength, BERTLVTag, TLVList
+
+REPEATS = 20000
+
+
+def legacy_unpack_tag(data):
+    result = []
+    index = 0
+    tag = data[index]
+    index += 1
+    result.append(tag)
+    tag_extension_left = tag & 0b00011111 == 0b00011111
+    while tag_extension_left:
+        tag_extension = data[index]
+        result.append(tag_extension)
+        tag_extension_left = bool(tag_extension & 0b10000000)
+        index += 1
+    return BERTLVTag(result)
+
+
+def legacy_unpack_length(data):
+    index = 0
+    result = [data[index]]
+    index += 1
+    if data[0] & 0b10000000:
+        length_length = data[0] & 0b01111111
+        result.extend(data[index : index + length_length])
+    return BERTLVLength(result)
+
+
+def legacy_unpack(data):
+    index = 0
+    data = memoryview(data)
+    tag = legacy_unpack_tag(data[index:])
+    index += len(tag.data)
+    length = legacy_unpack_length(data[index:])
+    index += len(length.data)
+    data = memoryview(data)[index : index + length.value]
+    if len(data) != length.value:
+        raise ValueError("Tag length does not match data size")
+    # Previous implementation sliced constructed values at a wrong offset, which is kept out here
+    if tag.is_constructed:
+        return BERTLV(tag, length, legacy_unpack_array(data))
+    return BERTLV(tag, length, bytes(data))
+
+
+def legacy_unpack_array(data):
+    result = []
+    index = 0
+    while index < len(data) - 1:
+        _tlv = legacy_unpack(data[index:])
+        index += len(_tlv.pack())
+        result.append(_tlv)
+    return TLVList(result)
+
+
+def legacy_get_tlv_tag(tlv_array, tag_value):
+    try:
+        return next(tlv_ for tlv_ in tlv_array if tlv_.tag.data[0] == tag_value).value
+    except StopIteration:
+        return None
+
+
+RESPONSES = {
+    "SELECT": (
+        pack(BERTLV(0x5C, value=bytes.fromhex("02000100"))),
+        (0x5C,),
+    ),
+    "AUTH0": (
+        pack(
+            [
+                BERTLV(0x86, value=bytes([0x04, *os.urandom(64)])),
+                BERTLV(0x9D, value=os.urandom(16)),
+            ]
+        ),
+        (0x86, 0x9D),
+    ),
+    "AUTH1": (
+        pack(
+            [
+                BERTLV(0x4E, value=os.urandom(6)),
+                BERTLV(0x9E, value=os.urandom(64)),
+                BERTLV(0x57, value=os.urandom(32)),
+                BERTLV(0x4A, value=os.urandom(16)),
+            ]
+        ),
+        (0x9E, 0x4E),
+    ),
+    "ENVELOPE": (
+        pack(BERTLV(0x53, value=os.urandom(700))),
+        (0x53,),
+    ),
+}
+
+
+def main():
+    print(f"Microseconds per parse and tag lookups, {REPEATS} repeats")
+    print("response".ljust(10) + "legacy".rjust(10) + "current".rjust(10))
+    for name, (data, tags) in RESPONSES.items():
+        legacy_array = legacy_unpack_array(data)
+        current_array = BERTLV.unpack_array(data)
+        for tag in tags:
+            assert bytes(legacy_get_tlv_tag(legacy_array, tag)) == bytes(
+                get_tlv_tag(current_array, tag)
+            )
+
+        legacy = timeit.timeit(
+            lambda: [legacy_get_tlv_tag(legacy_unpack_array(data), t) for t in tags],
+            number=REPEATS,
+        )
+        current = timeit.timeit(
+            lambda: [get_tlv_tag(BERTLV.unpack_array(data), t) for t in tags],
+            number=REPEATS,
+        )
+        print(
+            name.ljust(10)
+            + f"{legacy / REPEATS * 1e6:.2f}".rjust(10)
+            + f"{current / REPEATS * 1e6:.2f}".rjust(10)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from operator import attrgetter
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from entity import Issuer
+from util.crypto import get_ec_key_public_points, load_ec_public_key_from_bytes
+
+log = logging.getLogger()
+
+
+@dataclass(frozen=True)
+class EndpointKeyEntry:
+    """Key material of a single endpoint that FAST cryptogram matching depends on"""
+
+    endpoint_id: bytes
+    # Per-endpoint constant part of the FAST HKDF info
+    public_key_x: bytes
+    persistent_key: bytes
+    last_used_at: int
+
+
+class EndpointKeyIndex:
+    """Caches parsed endpoint public keys for the FAST cryptogram search.
+
+    Entries are ordered by most recent use, so the endpoint that was used last
+    is tried first, bringing expected HKDF evaluations per tap close to one
+    """
+
+    _entries: Tuple[EndpointKeyEntry, ...]
+    _public_key_x_cache: Dict[bytes, bytes]
+
+    def __init__(self, issuers: List[Issuer] = ()):
+        self._entries = tuple()
+        self._public_key_x_cache = dict()
+        self.update(issuers)
+
+    def __iter__(self) -> Iterator[EndpointKeyEntry]:
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_public_key_x(self, public_key: bytes):
+        public_key_x = self._public_key_x_cache.get(public_key)
+        if public_key_x is None:
+            public_key_x, _ = get_ec_key_public_points(
+                load_ec_public_key_from_bytes(public_key)
+            )
+        return public_key_x
+
+    def update(self, issuers: List[Issuer]):
+        """Rebuilds the index, only parsing public keys that were not seen before"""
+        public_key_x_cache = dict()
+        entries = []
+        for endpoint in (e for i in issuers for e in i.endpoints):
+            try:
+                public_key_x = self._get_public_key_x(endpoint.public_key)
+            except ValueError:
+                log.warning(f"Skipping endpoint {endpoint.id.hex()} with invalid key")
+                continue
+            public_key_x_cache[endpoint.public_key] = public_key_x
+            entries.append(
+                EndpointKeyEntry(
+                    endpoint_id=endpoint.id,
+                    public_key_x=public_key_x,
+                    persistent_key=endpoint.persistent_key,
+                    last_used_at=endpoint.last_used_at,
+                )
+            )
+        # Sort is stable, so endpoints that were never used keep enrollment order
+        entries.sort(key=attrgetter("last_used_at"), reverse=True)
+        # Swap whole containers so that readers on other threads see a consistent state
+        self._public_key_x_cache = public_key_x_cache
+        self._entries = tuple(entries)
+
+
+def derive_fast_keys(persistent_key: bytes, info: bytes, key_size=16) -> bytes:
+    """Derives kcmac, kenc, kmac and krmac concatenated together"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=key_size * 4,
+        salt=None,
+        info=info,
+    ).derive(persistent_key)
+
+
+class CryptogramMatcher:
+    """Searches for the endpoint whose kcmac equals the cryptogram returned in AUTH0"""
+
+    def match(
+        self,
+        entries: Sequence[EndpointKeyEntry],
+        info_prefix: bytes,
+        info_suffix: bytes,
+        returned_cryptogram: bytes,
+        key_size=16,
+    ) -> Optional[Tuple[EndpointKeyEntry, bytes]]:
+        """Returns matching entry together with derived key material"""
+        return self._match(
+            entries, info_prefix, info_suffix, returned_cryptogram, key_size
+        )
+
+    def _match(
+        self,
+        entries: Sequence[EndpointKeyEntry],
+        info_prefix: bytes,
+        info_suffix: bytes,
+        returned_cryptogram: bytes,
+        key_size: int,
+        found: Optional[threading.Event] = None,
+    ):
+        for entry in entries:
+            if found is not None and found.is_set():
+                return None
+            hkdf = derive_fast_keys(
+                entry.persistent_key,
+                info_prefix + entry.public_key_x + info_suffix,
+                key_size=key_size,
+            )
+            calculated_cryptogram = hkdf[:key_size]
+            log.debug(
+                f"Endpoint({entry.endpoint_id.hex()}): {returned_cryptogram.hex()=} ? {calculated_cryptogram.hex()=}"
+            )
+            if returned_cryptogram == calculated_cryptogram:
+                return entry, hkdf
+        return None
+
+    def close(self):
+        pass
+
+
+class ParallelCryptogramMatcher(CryptogramMatcher):
+    """Fans the cryptogram search out over a thread pool.
+
+    Opt-in, matching is serial by default: on CPython HKDF over such short inputs
+    hardly releases the GIL, and benchmarks/bench_fast_auth.py shows little to no gain
+    from the pool. It is kept for interpreters or builds where hashing runs in parallel.
+    Each worker takes every n-th candidate, which keeps recently used endpoints
+    at the front of every worker's share, and stops as soon as any worker finds a match
+    """
+
+    def __init__(self, workers: int, min_candidates=8):
+        self.workers = workers
+        # Below this amount of candidates the pool overhead outweighs the benefit
+        self.min_candidates = min_candidates
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="cryptogram"
+        )
+
+    def match(
+        self,
+        entries: Sequence[EndpointKeyEntry],
+        info_prefix: bytes,
+        info_suffix: bytes,
+        returned_cryptogram: bytes,
+        key_size=16,
+    ) -> Optional[Tuple[EndpointKeyEntry, bytes]]:
+        entries = tuple(entries)
+        if len(entries) < max(self.min_candidates, 2):
+            return self._match(
+                entries, info_prefix, info_suffix, returned_cryptogram, key_size
+            )
+
+        found = threading.Event()
+        pending = {
+            self._executor.submit(
+                self._match,
+                entries[offset :: self.workers],
+                info_prefix,
+                info_suffix,
+                returned_cryptogram,
+                key_size,
+                found,
+            )
+            for offset in range(min(self.workers, len(entries)))
+        }
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result is not None:
+                        return result
+            return None
+        finally:
+            # Remaining workers notice the flag before their next derivation
+            found.set()
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_cryptogram_matcher(workers: int = 0) -> CryptogramMatcher:
+    """Returns a parallel matcher if more than one worker is requested"""
+    if workers > 1:
+        return ParallelCryptogramMatcher(workers)
+    return CryptogramMatcher()
+
+
+__all__ = (
+    "EndpointKeyEntry",
+    "EndpointKeyIndex",
+    "CryptogramMatcher",
+    "ParallelCryptogramMatcher",
+    "create_cryptogram_matcher",
+    "derive_fast_keys",
+)
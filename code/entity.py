@@ -1,8 +1,9 @@
+import copy
 import hashlib
 import os
-from dataclasses import dataclass
+from dataclasses import FrozenInstanceError, dataclass
 from enum import Enum, IntEnum
-from typing import List, Optional, Union
+from typing import Optional, Sequence, Union
 
 from util.structable import represent
 from util.tlv import TLV8Field, TLV8Object
@@ -19,11 +20,33 @@ class Context(Enum):
     VOLATILE_FAST = "VolatileFast"
 
 
+def check_not_frozen(entity):
+    # Unset slot means that entity was never frozen
+    if getattr(entity, "_frozen", False):
+        raise FrozenInstanceError(
+            f"{type(entity).__name__} is part of a snapshot, copy it before making changes"
+        )
+
+
 @dataclass
 class Enrollment:
+    __slots__ = ("at", "payload", "_frozen")
+
     at: int
     payload: Union[bytes, str]
 
+    def __setattr__(self, name, value):
+        check_not_frozen(self)
+        object.__setattr__(self, name, value)
+
+    def freeze(self):
+        """Rejects any further changes"""
+        object.__setattr__(self, "_frozen", True)
+
+    def __deepcopy__(self, memo):
+        # All fields are immutable
+        return Enrollment(at=self.at, payload=self.payload)
+
     @classmethod
     def from_dict(cls, enrollment: dict):
         return Enrollment(at=enrollment.get("at", 0), payload=enrollment.get("payload"))
@@ -34,9 +57,28 @@ class Enrollment:
 
 @dataclass
 class Enrollments:
+    __slots__ = ("hap", "attestation", "_frozen")
+
     hap: Optional[Enrollment]
     attestation: Optional[Enrollment]
 
+    def __setattr__(self, name, value):
+        check_not_frozen(self)
+        object.__setattr__(self, name, value)
+
+    def freeze(self):
+        """Rejects any further changes to enrollments and their contents"""
+        for enrollment in (self.hap, self.attestation):
+            if enrollment is not None:
+                enrollment.freeze()
+        object.__setattr__(self, "_frozen", True)
+
+    def __deepcopy__(self, memo):
+        return Enrollments(
+            hap=copy.deepcopy(self.hap, memo),
+            attestation=copy.deepcopy(self.attestation, memo),
+        )
+
     @classmethod
     def from_dict(cls, enrollments: dict):
         return Enrollments(
@@ -62,6 +104,17 @@ class Enrollments:
 
 @dataclass
 class Endpoint:
+    __slots__ = (
+        "last_used_at",
+        "counter",
+        "key_type",
+        "public_key",
+        "persistent_key",
+        "enrollments",
+        "_id",
+        "_frozen",
+    )
+
     last_used_at: int
     counter: int
     key_type: KeyType
@@ -69,9 +122,31 @@ class Endpoint:
     persistent_key: bytes
     enrollments: Enrollments
 
+    def __setattr__(self, name, value):
+        check_not_frozen(self)
+        object.__setattr__(self, name, value)
+        # Identifier is derived from public key, so it's only recalculated when the key changes
+        if name == "public_key":
+            object.__setattr__(self, "_id", hashlib.sha1(value).digest()[:6])
+
+    def freeze(self):
+        """Rejects any further changes to endpoint and its enrollments"""
+        self.enrollments.freeze()
+        object.__setattr__(self, "_frozen", True)
+
     @property
     def id(self):
-        return hashlib.sha1(self.public_key).digest()[:6]
+        return self._id
+
+    def __deepcopy__(self, memo):
+        return Endpoint(
+            self.last_used_at,
+            self.counter,
+            self.key_type,
+            self.public_key,
+            self.persistent_key,
+            copy.deepcopy(self.enrollments, memo),
+        )
 
     @classmethod
     def from_dict(cls, endpoint: dict):
@@ -100,12 +175,38 @@ class Endpoint:
 
 @dataclass
 class Issuer:
+    __slots__ = ("public_key", "endpoints", "_id", "_frozen")
+
     public_key: bytes
-    endpoints: List[Endpoint]
+    endpoints: Sequence[Endpoint]
+
+    def __setattr__(self, name, value):
+        check_not_frozen(self)
+        object.__setattr__(self, name, value)
+        if name == "public_key":
+            object.__setattr__(
+                self,
+                "_id",
+                hashlib.sha256("key-identifier".encode() + value).digest()[:8],
+            )
 
     @property
     def id(self):
-        return hashlib.sha256("key-identifier".encode() + self.public_key).digest()[:8]
+        return self._id
+
+    def freeze(self):
+        """Rejects any further changes to issuer and its endpoints"""
+        for endpoint in self.endpoints:
+            endpoint.freeze()
+        object.__setattr__(self, "endpoints", tuple(self.endpoints))
+        object.__setattr__(self, "_frozen", True)
+
+    def __deepcopy__(self, memo):
+        # Copies are mutable, including endpoints of frozen issuers
+        return Issuer(
+            public_key=self.public_key,
+            endpoints=[copy.deepcopy(endpoint, memo) for endpoint in self.endpoints],
+        )
 
     @classmethod
     def from_dict(cls, issuer: dict):
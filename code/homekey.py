@@ -1,9 +1,14 @@
 import base64
+import contextvars
+import dataclasses
 import hashlib
 import logging
 import os
+import threading
 import time
-from typing import Collection, List, Optional, Tuple
+from concurrent.futures import CancelledError, Executor, Future
+from functools import cached_property, lru_cache, partial
+from typing import Callable, Collection, List, Optional, Tuple
 
 import cbor2
 from cryptography.exceptions import InvalidSignature
@@ -16,6 +21,7 @@ from cryptography.hazmat.primitives.asymmetric.utils import (
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.x963kdf import X963KDF
 
+from cryptogram import CryptogramMatcher, EndpointKeyIndex
 from entity import (
     Context,
     Endpoint,
@@ -25,6 +31,8 @@ from entity import (
     Issuer,
     KeyType,
 )
+from keypool import EphemeralKey, EphemeralKeyPool, TransactionMaterial
+from tracing import span, traced
 from util.crypto import get_ec_key_public_points, load_ec_public_key_from_bytes
 from util.digital_key import (
     DigitalKeyFlow,
@@ -68,6 +76,72 @@ def get_endpoints_from_issuers(issuers: List[Issuer]):
     return (e for i in issuers for e in i.endpoints)
 
 
+def upsert_endpoint_in_issuers(
+    issuers: List[Issuer], endpoint: Endpoint, issuer: Optional[Issuer] = None
+) -> List[Issuer]:
+    """Returns new issuer list where endpoint replaces the one with the same id,
+    or is added to the provided issuer if it is not known yet.
+    Issuers that are not affected are reused without copying
+    """
+    known = find_endpoint_by_id_in_issuers(issuers, endpoint.id) is not None
+    result = []
+    for i in issuers:
+        if known and any(e.id == endpoint.id for e in i.endpoints):
+            i = Issuer(
+                public_key=i.public_key,
+                endpoints=[endpoint if e.id == endpoint.id else e for e in i.endpoints],
+            )
+        elif not known and issuer is not None and i.id == issuer.id:
+            i = Issuer(public_key=i.public_key, endpoints=[*i.endpoints, endpoint])
+        result.append(i)
+    return result
+
+
+# Reader key rarely changes, while group identifier is needed for every ECP broadcast
+@lru_cache(maxsize=8)
+def get_reader_group_identifier(reader_private_key: bytes) -> bytes:
+    return hashlib.sha256("key-identifier".encode() + reader_private_key).digest()[:8]
+
+
+class ReaderIdentity:
+    """Reader key material that stays the same between transactions"""
+
+    def __init__(self, private_key: bytes, identifier: Optional[bytes] = None):
+        self.private_key_bytes = private_key
+        self.group_identifier = get_reader_group_identifier(private_key)
+        # Group identifier followed by unique reader identifier
+        self.identifier = identifier
+
+    @classmethod
+    def from_unique_identifier(cls, private_key: bytes, unique_identifier: bytes):
+        reader = cls(private_key)
+        reader.identifier = reader.group_identifier + unique_identifier
+        return reader
+
+    # Key is derived on first use, as it's invalid until reader is configured via HAP
+    @cached_property
+    def private_key(self) -> ec.EllipticCurvePrivateKey:
+        return ec.derive_private_key(
+            int.from_bytes(self.private_key_bytes, "big"), ec.SECP256R1()
+        )
+
+    @cached_property
+    def public_key(self) -> ec.EllipticCurvePublicKey:
+        return self.private_key.public_key()
+
+    @cached_property
+    def public_key_points(self) -> Tuple[bytes, bytes]:
+        return get_ec_key_public_points(self.public_key)
+
+    @property
+    def public_key_x(self) -> bytes:
+        return self.public_key_points[0]
+
+    @property
+    def public_key_y(self) -> bytes:
+        return self.public_key_points[1]
+
+
 def generate_ec_key_if_provided_is_none(
     private_key: Optional[ec.EllipticCurvePrivateKey],
 ):
@@ -78,6 +152,32 @@ def generate_ec_key_if_provided_is_none(
     )
 
 
+def get_transaction_material(
+    key_pool: Optional[EphemeralKeyPool],
+    reader_ephemeral_private_key: Optional[bytes],
+    transaction_identifier: Optional[bytes],
+    attestation_exchange_common_secret: Optional[bytes],
+) -> TransactionMaterial:
+    """Takes material from the pool, or generates it, unless it was provided explicitly"""
+    if key_pool is not None and reader_ephemeral_private_key is None:
+        material = key_pool.get()
+    else:
+        material = TransactionMaterial(
+            ephemeral_key=EphemeralKey.from_private_key(
+                generate_ec_key_if_provided_is_none(reader_ephemeral_private_key)
+            ),
+            transaction_identifier=os.urandom(16),
+            attestation_exchange_common_secret=os.urandom(32),
+        )
+    return dataclasses.replace(
+        material,
+        transaction_identifier=transaction_identifier
+        or material.transaction_identifier,
+        attestation_exchange_common_secret=attestation_exchange_common_secret
+        or material.attestation_exchange_common_secret,
+    )
+
+
 def get_key_material_generator(
     reader_ephemeral_private_key: ec.EllipticCurvePrivateKey,
     endpoint_ephemeral_public_key: ec.EllipticCurvePublicKey,
@@ -141,26 +241,23 @@ def fast_auth(
     interface: int,
     flags: bytes,
     reader_identifier: bytes,
-    reader_public_key: ec.EllipticCurvePublicKey,
-    reader_ephemeral_public_key: ec.EllipticCurvePublicKey,
+    reader_public_key_x: bytes,
+    reader_ephemeral_key: EphemeralKey,
     transaction_identifier: bytes,
     issuers: List[Issuer],
     key_size=16,
+    endpoint_index: Optional[EndpointKeyIndex] = None,
+    matcher: Optional[CryptogramMatcher] = None,
+    # Called before cryptogram search begins
+    on_endpoint_ephemeral_public_key: Optional[
+        Callable[[ec.EllipticCurvePublicKey], None]
+    ] = None,
 ) -> Tuple[
     ec.EllipticCurvePublicKey, Optional[Endpoint], Optional[DigitalKeySecureContext]
 ]:
-    (
-        reader_ephemeral_public_key_x,
-        reader_ephemeral_public_key_y,
-    ) = get_ec_key_public_points(reader_ephemeral_public_key)
-    reader_ephemeral_public_key_bytes = bytes(
-        [0x04, *reader_ephemeral_public_key_x, *reader_ephemeral_public_key_y]
-    )
-    reader_public_key_x, _ = get_ec_key_public_points(reader_public_key)
-
     command_tlv = [
         TLV(0x5C, value=protocol_version),
-        TLV(0x87, value=reader_ephemeral_public_key_bytes),
+        TLV(0x87, value=reader_ephemeral_key.public_key_bytes),
         TLV(0x4C, value=transaction_identifier),
         TLV(0x4D, value=reader_identifier),
     ]
@@ -170,7 +267,8 @@ def fast_auth(
         cla=0x80, ins=0x80, p1=flags[0], p2=flags[1], data=command_data, le=None
     )
     log.debug(f"AUTH0 CMD = {command}")
-    response = tag.transceive(command)
+    with span("auth0"):
+        response = tag.transceive(command)
     if response.sw != (0x90, 0x00):
         raise ProtocolError(f"AUTH0 INVALID STATUS {response.sw}")
     log.debug(f"AUTH0 RES = {response}")
@@ -188,90 +286,103 @@ def fast_auth(
     endpoint_ephemeral_public_key_x, _ = get_ec_key_public_points(
         endpoint_ephemeral_public_key
     )
+    if on_endpoint_ephemeral_public_key is not None:
+        on_endpoint_ephemeral_public_key(endpoint_ephemeral_public_key)
 
     returned_cryptogram = get_tlv_tag(tlv_array, 0x9D)
     if returned_cryptogram is None:
         return endpoint_ephemeral_public_key, None, None
 
-    endpoint = None
     # FAST gives us no way to find out the identity of endpoint from the data for security reasons,
-    # so we have to iterate over all provisioned endpoints and hope that it's there
-    log.debug("Searching for an endpoint with matching cryptogram...")
-    for endpoint in get_endpoints_from_issuers(issuers):
-        k_persistent = endpoint.persistent_key
-        endpoint_public_key_bytes = endpoint.public_key
-        endpoint_public_key: ec.EllipticCurvePublicKey = load_ec_public_key_from_bytes(
-            endpoint_public_key_bytes
-        )
-        endpoint_public_key_x, _ = get_ec_key_public_points(endpoint_public_key)
-
-        # Whoever did this. Did that help? ;)
-        info_material = (
-            reader_public_key_x,
-            Context.VOLATILE_FAST,
-            reader_identifier,
-            endpoint_public_key_x,
+    # so we have to iterate over all provisioned endpoints and hope that it's there.
+    # HKDF info only differs in endpoint public key between endpoints, so the rest is packed once.
+    # Whoever did this. Did that help? ;)
+    info_prefix = pack((reader_public_key_x, Context.VOLATILE_FAST, reader_identifier))
+    info_suffix = pack(
+        (
             interface,
             TLV(0x5C, value=device_protocol_versions),
             TLV(0x5C, value=protocol_version),
-            reader_ephemeral_public_key_x,
+            reader_ephemeral_key.public_key_x,
             transaction_identifier,
             flags,
             endpoint_ephemeral_public_key_x,
         )
+    )
 
-        info = pack(info_material)
+    if endpoint_index is None:
+        endpoint_index = EndpointKeyIndex(issuers)
 
-        hkdf = HKDF(
-            algorithm=hashes.SHA256(),
-            length=key_size * 4,
-            salt=None,
-            info=info,
-        ).derive(k_persistent)
-        kcmac = hkdf[: key_size * 1]
-        kenc = hkdf[key_size * 1 : key_size * 2]
-        kmac = hkdf[key_size * 2 : key_size * 3]
-        krmac = hkdf[key_size * 3 :]
-        calculated_cryptogram = kcmac
-        log.debug(
-            f"Endpoint({endpoint.id.hex()}): {returned_cryptogram.hex()=} ? {calculated_cryptogram.hex()=}"
+    if matcher is None:
+        matcher = CryptogramMatcher()
+
+    log.debug("Searching for an endpoint with matching cryptogram...")
+    with span("cryptogram_search"):
+        match = matcher.match(
+            endpoint_index,
+            info_prefix,
+            info_suffix,
+            returned_cryptogram,
+            key_size=key_size,
         )
-        if returned_cryptogram == calculated_cryptogram:
-            log.debug(
-                f"Cryptograms match for Endpoint({endpoint.id.hex()}): {kcmac.hex()=} {kenc.hex()=} {kmac.hex()=} {krmac.hex()=};"
-            )
-            return (
-                endpoint_ephemeral_public_key,
-                endpoint,
-                DigitalKeySecureContext(tag, kenc, kmac, krmac),
-            )
-        else:
-            endpoint = None
-    return endpoint_ephemeral_public_key, endpoint, None
+    if match is None:
+        return endpoint_ephemeral_public_key, None, None
 
+    entry, hkdf = match
+    endpoint = find_endpoint_by_id_in_issuers(issuers, entry.endpoint_id)
+    if endpoint is None:
+        log.warning(f"Endpoint({entry.endpoint_id.hex()}) is not in issuer state")
+        return endpoint_ephemeral_public_key, None, None
 
-def standard_auth(
-    tag: ISO7816Tag,
+    kcmac = hkdf[: key_size * 1]
+    kenc = hkdf[key_size * 1 : key_size * 2]
+    kmac = hkdf[key_size * 2 : key_size * 3]
+    krmac = hkdf[key_size * 3 :]
+    log.debug(
+        f"Cryptograms match for Endpoint({endpoint.id.hex()}): {kcmac.hex()=} {kenc.hex()=} {kmac.hex()=} {krmac.hex()=};"
+    )
+    return (
+        endpoint_ephemeral_public_key,
+        endpoint,
+        DigitalKeySecureContext(tag, kenc, kmac, krmac),
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class StandardAuthPreparation:
+    """AUTH1 command and session keys, which only depend on AUTH0 exchange"""
+
+    endpoint_ephemeral_public_key: ec.EllipticCurvePublicKey
+    endpoint_ephemeral_public_key_x: bytes
+    command: ISO7816Command
+    k_persistent: bytes
+    kenc: bytes
+    kmac: bytes
+    krmac: bytes
+
+
+def prepare_standard_auth(
     device_protocol_versions: List[bytes],
     protocol_version: bytes,
     interface: int,
     flags: bytes,
     reader_identifier: bytes,
-    reader_ephemeral_private_key: ec.EllipticCurvePrivateKey,
+    reader_ephemeral_key: EphemeralKey,
     reader_private_key: ec.EllipticCurvePrivateKey,
     transaction_identifier: bytes,
     endpoint_ephemeral_public_key: ec.EllipticCurvePublicKey,
-    issuers: List[Issuer],
     key_size=16,
-) -> Tuple[Optional[bytes], Optional[Endpoint], Optional[DigitalKeySecureContext]]:
-    reader_ephemeral_public_key = reader_ephemeral_private_key.public_key()
-
+    # Checked before signing and before key agreement, raises CancelledError once set
+    cancelled: Optional[threading.Event] = None,
+) -> StandardAuthPreparation:
+    """Signs AUTH1 and derives session keys without talking to the device,
+    so it can be done while FAST cryptogram is still being matched"""
+    if cancelled is not None and cancelled.is_set():
+        raise CancelledError()
     endpoint_ephemeral_public_key_x, _ = get_ec_key_public_points(
         endpoint_ephemeral_public_key
     )
-    reader_ephemeral_public_key_x, _ = get_ec_key_public_points(
-        reader_ephemeral_public_key
-    )
+    reader_ephemeral_public_key_x = reader_ephemeral_key.public_key_x
     log.debug(
         f"{endpoint_ephemeral_public_key_x.hex()=} {reader_ephemeral_public_key_x.hex()=}"
     )
@@ -286,9 +397,10 @@ def standard_auth(
     authentication_hash_input = pack(authentication_hash_input_material)
     log.debug(f"{authentication_hash_input.hex()=}")
 
-    signature = reader_private_key.sign(
-        authentication_hash_input, ec.ECDSA(hashes.SHA256())
-    )
+    with span("auth1_signature"):
+        signature = reader_private_key.sign(
+            authentication_hash_input, ec.ECDSA(hashes.SHA256())
+        )
     log.debug(f"{signature.hex()=} ({hex(len(signature))})")
     x, y = decode_dss_signature(signature)
     signature_point_form = bytes([*x.to_bytes(32, "big"), *y.to_bytes(32, "big")])
@@ -297,33 +409,87 @@ def standard_auth(
     data = TLV(0x9E, value=signature_point_form)
     command = ISO7816Command(cla=0x80, ins=0x81, p1=0x00, p2=0x00, data=data)
 
-    log.debug(f"AUTH1 COMMAND {command}")
-    response = tag.transceive(command)
-    log.debug(f"AUTH1 RESPONSE: {response}")
-    if response.sw != (0x90, 0x00):
-        raise ProtocolError(f"AUTH1 INVALID STATUS {response.sw}")
+    if cancelled is not None and cancelled.is_set():
+        raise CancelledError()
+
+    with span("key_derivation"):
+        get_key_material = get_key_material_generator(
+            reader_ephemeral_private_key=reader_ephemeral_key.private_key,
+            endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
+            transaction_identifier=transaction_identifier,
+            interface=interface,
+            flags=flags,
+            protocol_version=protocol_version,
+            device_protocol_versions=device_protocol_versions,
+        )
+
+        k_persistent = get_key_material(
+            context=Context.PERSISTENT, key_size=key_size * 2
+        )
+        log.debug(f"{k_persistent.hex()=}")
+
+        hkdf = get_key_material(context=Context.VOLATILE, key_size=key_size * 3)
+        log.debug(f"{hkdf.hex()=}")
+        kenc = hkdf[: key_size * 1]
+        kmac = hkdf[key_size * 1 : key_size * 2]
+        krmac = hkdf[key_size * 2 :]
+        log.debug(f"{kenc.hex()=} {kmac.hex()=} {krmac.hex()=}")
 
-    get_key_material = get_key_material_generator(
-        reader_ephemeral_private_key=reader_ephemeral_private_key,
+    return StandardAuthPreparation(
         endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
-        transaction_identifier=transaction_identifier,
-        interface=interface,
-        flags=flags,
-        protocol_version=protocol_version,
-        device_protocol_versions=device_protocol_versions,
+        endpoint_ephemeral_public_key_x=endpoint_ephemeral_public_key_x,
+        command=command,
+        k_persistent=k_persistent,
+        kenc=kenc,
+        kmac=kmac,
+        krmac=krmac,
     )
 
-    k_persistent = get_key_material(context=Context.PERSISTENT, key_size=key_size * 2)
-    log.debug(f"{k_persistent.hex()=}")
 
-    hkdf = get_key_material(context=Context.VOLATILE, key_size=key_size * 3)
-    log.debug(f"{hkdf.hex()=}")
-    kenc = hkdf[: key_size * 1]
-    kmac = hkdf[key_size * 1 : key_size * 2]
-    krmac = hkdf[key_size * 2 :]
-    log.debug(f"{kenc.hex()=} {kmac.hex()=} {krmac.hex()=}")
+def standard_auth(
+    tag: ISO7816Tag,
+    device_protocol_versions: List[bytes],
+    protocol_version: bytes,
+    interface: int,
+    flags: bytes,
+    reader_identifier: bytes,
+    reader_ephemeral_key: EphemeralKey,
+    reader_private_key: ec.EllipticCurvePrivateKey,
+    transaction_identifier: bytes,
+    endpoint_ephemeral_public_key: ec.EllipticCurvePublicKey,
+    issuers: List[Issuer],
+    key_size=16,
+    # Computed in place if not provided
+    preparation: Optional[StandardAuthPreparation] = None,
+) -> Tuple[Optional[bytes], Optional[Endpoint], Optional[DigitalKeySecureContext]]:
+    if preparation is None:
+        preparation = prepare_standard_auth(
+            device_protocol_versions=device_protocol_versions,
+            protocol_version=protocol_version,
+            interface=interface,
+            flags=flags,
+            reader_identifier=reader_identifier,
+            reader_ephemeral_key=reader_ephemeral_key,
+            reader_private_key=reader_private_key,
+            transaction_identifier=transaction_identifier,
+            endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
+            key_size=key_size,
+        )
+    endpoint_ephemeral_public_key_x = preparation.endpoint_ephemeral_public_key_x
+    reader_ephemeral_public_key_x = reader_ephemeral_key.public_key_x
+    k_persistent = preparation.k_persistent
 
-    secure = DigitalKeySecureContext(tag, kenc, kmac, krmac)
+    command = preparation.command
+    log.debug(f"AUTH1 COMMAND {command}")
+    with span("auth1"):
+        response = tag.transceive(command)
+    log.debug(f"AUTH1 RESPONSE: {response}")
+    if response.sw != (0x90, 0x00):
+        raise ProtocolError(f"AUTH1 INVALID STATUS {response.sw}")
+
+    secure = DigitalKeySecureContext(
+        tag, preparation.kenc, preparation.kmac, preparation.krmac
+    )
 
     try:
         response, secure.counter = secure.decrypt_response(response)
@@ -379,6 +545,7 @@ def standard_auth(
     return k_persistent, endpoint, secure
 
 
+@traced("attestation")
 def exchange_attestation(tag: ISO7816Tag, shared_secret: bytes):
     """Performs attestation exchange, returns attestation package"""
     _ = select_applet(tag, ISO7816Application.HOME_KEY_CONFIGURATION)
@@ -411,7 +578,8 @@ def exchange_attestation(tag: ISO7816Tag, shared_secret: bytes):
         data=pack(TLV(0x53, value=envelope1_engagement_message)),
     )
     log.debug(f"ENVELOPE1 CMD = {envelope1_command}")
-    envelope1_response = tag.transceive(envelope1_command)
+    with span("attestation_envelope1"):
+        envelope1_response = tag.transceive(envelope1_command)
     log.debug(f"ENVELOPE1 RES = {envelope1_response}")
 
     envelope1_command_ndef = NDEFMessage.unpack(
@@ -483,19 +651,20 @@ def exchange_attestation(tag: ISO7816Tag, shared_secret: bytes):
         cla=0x00, ins=0xC3, p1=0x00, p2=0x00, data=envelope2_command_data, le=0x00
     )
     log.debug(f"ENVELOPE2 CMD = {command}")
-    response = tag.transceive(command)
-    log.debug(f"ENVELOPE2 RES = {response}")
+    with span("attestation_envelope2"):
+        response = tag.transceive(command)
+        log.debug(f"ENVELOPE2 RES = {response}")
 
-    data = response.data
+        data = response.data
 
-    while response.sw1 == 0x61:
-        command = ISO7816Command(
-            cla=0x00, ins=0xC0, p1=0x00, p2=0x00, data=None, le=response.sw2
-        )
-        log.debug(f"GET DATA CMD = {command}")
-        response = tag.transceive(command)
-        log.debug(f"GET DATA RES = {response}")
-        data += response.data
+        while response.sw1 == 0x61:
+            command = ISO7816Command(
+                cla=0x00, ins=0xC0, p1=0x00, p2=0x00, data=None, le=response.sw2
+            )
+            log.debug(f"GET DATA CMD = {command}")
+            response = tag.transceive(command)
+            log.debug(f"GET DATA RES = {response}")
+            data += response.data
 
     endpoint_cbor_plaintext = iso18013secure.decrypt_message_from_endpoint(
         TLV.unpack(data).value
@@ -503,6 +672,7 @@ def exchange_attestation(tag: ISO7816Tag, shared_secret: bytes):
     return endpoint_cbor_plaintext
 
 
+@traced("mailbox_exchange")
 def mailbox_exchange(
     secure: DigitalKeySecureContext, mailbox_operations: Collection[TLV] = None
 ):
@@ -524,6 +694,7 @@ def mailbox_exchange(
     return response.data
 
 
+@traced("select")
 def select_applet(tag: ISO7816Tag, applet=ISO7816Application.HOME_KEY):
     command = ISO7816.select_aid(applet)
     log.debug(f"SELECT CMD = {command}")
@@ -536,6 +707,7 @@ def select_applet(tag: ISO7816Tag, applet=ISO7816Application.HOME_KEY):
     return response.data
 
 
+@traced("control_flow")
 def control_flow(tag: ISO7816Tag, p1=0x01, p2=0x00):
     command = ISO7816Command(cla=0x80, ins=0x3C, p1=p1, p2=p2, data=None, le=None)
     log.debug(f"OP_CONTROL_FLOW CMD = {command}")
@@ -547,9 +719,8 @@ def control_flow(tag: ISO7816Tag, p1=0x01, p2=0x00):
 def perform_authentication_flow(
     tag: ISO7816Tag,
     flow: DigitalKeyFlow,
-    reader_identifier: bytes,
-    reader_private_key: ec.EllipticCurvePrivateKey,
-    reader_ephemeral_private_key: ec.EllipticCurvePrivateKey,
+    reader: ReaderIdentity,
+    reader_ephemeral_key: EphemeralKey,
     attestation_exchange_common_secret: bytes,
     protocol_version: bytes,
     device_protocol_versions: List[bytes],
@@ -558,39 +729,77 @@ def perform_authentication_flow(
     interface: int,
     issuers: List[Issuer],
     key_size=16,
+    endpoint_index: Optional[EndpointKeyIndex] = None,
+    matcher: Optional[CryptogramMatcher] = None,
+    speculative_executor: Optional[Executor] = None,
 ) -> Tuple[DigitalKeyFlow, Optional[Issuer], Optional[Endpoint]]:
     """Returns an Endpoint if one was found and successfully authenticated.
-    Returns an Issuer if endpoint was authenticated via Attestation
+    Returns an Issuer if endpoint was authenticated via Attestation.
+    If speculative_executor is provided, STANDARD flow is prepared on it
+    while FAST cryptogram is being matched
     """
-    reader_public_key = reader_private_key.public_key()
-    reader_public_key_x, reader_public_key_y = get_ec_key_public_points(
-        reader_public_key
-    )
     log.debug(
-        f"Reader public key: x={reader_public_key_x.hex()} y={reader_public_key_y.hex()}"
+        f"Reader public key: x={reader.public_key_x.hex()} y={reader.public_key_y.hex()}"
     )
 
-    reader_ephemeral_public_key = reader_ephemeral_private_key.public_key()
-
     log.debug(f"{protocol_version.hex()=}")
 
+    prepare = partial(
+        prepare_standard_auth,
+        device_protocol_versions=device_protocol_versions,
+        protocol_version=protocol_version,
+        interface=interface,
+        flags=flags,
+        reader_identifier=reader.identifier,
+        reader_ephemeral_key=reader_ephemeral_key,
+        reader_private_key=reader.private_key,
+        transaction_identifier=transaction_identifier,
+        key_size=key_size,
+    )
+    preparation_future: Optional[Future] = None
+    # Future.cancel has no effect once the job started, so the job also checks this
+    preparation_cancelled = threading.Event()
+
+    def on_endpoint_ephemeral_public_key(public_key: ec.EllipticCurvePublicKey):
+        nonlocal preparation_future
+        if speculative_executor is not None:
+            # Context is copied so that spans end up in the trace of this transaction
+            preparation_future = speculative_executor.submit(
+                contextvars.copy_context().run,
+                prepare,
+                endpoint_ephemeral_public_key=public_key,
+                cancelled=preparation_cancelled,
+            )
+
     endpoint_ephemeral_public_key, endpoint, secure = fast_auth(
         tag=tag,
         device_protocol_versions=device_protocol_versions,
         protocol_version=protocol_version,
         interface=interface,
         flags=flags,
-        reader_identifier=reader_identifier,
-        reader_public_key=reader_public_key,
-        reader_ephemeral_public_key=reader_ephemeral_public_key,
+        reader_identifier=reader.identifier,
+        reader_public_key_x=reader.public_key_x,
+        reader_ephemeral_key=reader_ephemeral_key,
         transaction_identifier=transaction_identifier,
         issuers=issuers,
         key_size=key_size,
+        endpoint_index=endpoint_index,
+        matcher=matcher,
+        on_endpoint_ephemeral_public_key=on_endpoint_ephemeral_public_key,
     )
 
     if endpoint is not None and flow <= DigitalKeyFlow.FAST:
+        if preparation_future is not None:
+            preparation_cancelled.set()
+            preparation_future.cancel()
         return DigitalKeyFlow.FAST, None, endpoint
 
+    preparation = (
+        preparation_future.result()
+        if preparation_future is not None
+        else prepare(endpoint_ephemeral_public_key=endpoint_ephemeral_public_key)
+    )
+
     k_persistent, endpoint, secure = standard_auth(
         tag=tag,
         device_protocol_versions=device_protocol_versions,
@@ -598,16 +807,17 @@ def perform_authentication_flow(
         interface=interface,
         flags=flags,
         transaction_identifier=transaction_identifier,
-        reader_identifier=reader_identifier,
-        reader_private_key=reader_private_key,
-        reader_ephemeral_private_key=reader_ephemeral_private_key,
+        reader_identifier=reader.identifier,
+        reader_private_key=reader.private_key,
+        reader_ephemeral_key=reader_ephemeral_key,
         issuers=issuers,
         endpoint_ephemeral_public_key=endpoint_ephemeral_public_key,
         key_size=key_size,
+        preparation=preparation,
     )
 
     if endpoint is not None and k_persistent is not None:
-        endpoint.persistent_key = k_persistent
+        endpoint = dataclasses.replace(endpoint, persistent_key=k_persistent)
 
     if endpoint is not None and flow <= DigitalKeyFlow.STANDARD:
         return DigitalKeyFlow.STANDARD, None, endpoint
@@ -677,24 +887,36 @@ def perform_authentication_flow(
 
 def read_homekey(
     tag: ISO7816Tag,
-    reader_identifier: bytes,
-    reader_private_key: bytes,
-    issuers: List[Issuer],
+    # Ignored if reader is provided
+    reader_identifier: Optional[bytes] = None,
+    # Ignored if reader is provided
+    reader_private_key: Optional[bytes] = None,
+    issuers: List[Issuer] = (),
     preferred_versions: Collection[bytes] = None,
     flow=DigitalKeyFlow.FAST,
     transaction_code: DigitalKeyTransactionType = DigitalKeyTransactionType.UNLOCK,
-    # Generated at random if not provided
+    # Taken from key_pool or generated at random if not provided
     reader_ephemeral_private_key: Optional[bytes] = None,
-    # Generated at random if not provided
+    # Taken from key_pool or generated at random if not provided
     transaction_identifier: Optional[bytes] = None,
-    # Generated at random if not provided
+    # Taken from key_pool or generated at random if not provided
     attestation_exchange_common_secret: Optional[bytes] = None,
     interface=Interface.CONTACTLESS,
     key_size=16,
+    # Built from issuers if not provided
+    endpoint_index: Optional[EndpointKeyIndex] = None,
+    # Derived from reader_private_key and reader_identifier if not provided
+    reader: Optional[ReaderIdentity] = None,
+    # Serial search if not provided
+    matcher: Optional[CryptogramMatcher] = None,
+    key_pool: Optional[EphemeralKeyPool] = None,
+    # STANDARD flow is only prepared once FAST fails if not provided
+    speculative_executor: Optional[Executor] = None,
 ) -> Tuple[DigitalKeyFlow, List[Issuer], Optional[Endpoint]]:
     """
     Returns a list representing new configured issuer state
-    and an optional endpoint in case authentication has been successful
+    and an optional endpoint in case authentication has been successful.
+    Provided issuers are not modified
     """
     transaction_flags = {
         DigitalKeyTransactionFlags.FAST
@@ -705,7 +927,6 @@ def read_homekey(
 
     response = select_applet(tag, applet=ISO7816Application.HOME_KEY)
     tlv_array = TLV.unpack_array(response)
-    log.debug(f"{reader_identifier.hex()=}")
 
     versions_tag = get_tlv_tag(tlv_array, 0x5C)
     if versions_tag is None:
@@ -726,34 +947,40 @@ def read_homekey(
     if protocol_version != b"\x02\x00":
         raise ProtocolError("Only officially supported protocol version is 0200")
 
-    reader_private_key = ec.derive_private_key(
-        int.from_bytes(reader_private_key, "big"), ec.SECP256R1()
+    if reader is None:
+        reader = ReaderIdentity(reader_private_key, identifier=reader_identifier)
+    log.debug(f"{reader.identifier.hex()=}")
+
+    material = get_transaction_material(
+        key_pool,
+        reader_ephemeral_private_key,
+        transaction_identifier,
+        attestation_exchange_common_secret,
     )
 
     result_flow, issuer, endpoint = perform_authentication_flow(
         tag=tag,
         flow=flow,
-        reader_identifier=reader_identifier,
-        reader_private_key=reader_private_key,
-        reader_ephemeral_private_key=generate_ec_key_if_provided_is_none(
-            reader_ephemeral_private_key
-        ),
-        attestation_exchange_common_secret=attestation_exchange_common_secret
-        or os.urandom(32),
+        reader=reader,
+        reader_ephemeral_key=material.ephemeral_key,
+        attestation_exchange_common_secret=material.attestation_exchange_common_secret,
         protocol_version=protocol_version,
         device_protocol_versions=device_protocol_versions,
-        transaction_identifier=transaction_identifier or os.urandom(16),
+        transaction_identifier=material.transaction_identifier,
         flags=flags,
         interface=interface,
         issuers=issuers,
         key_size=key_size,
+        endpoint_index=endpoint_index,
+        matcher=matcher,
+        speculative_executor=speculative_executor,
     )
+    # Issuers might be a shared snapshot, so they are copied on write instead of being modified
     if endpoint is not None:
-        endpoint.last_used_at = int(time.time())
-        endpoint.counter += 1
-
-    if issuer and endpoint not in get_endpoints_from_issuers(issuers):
-        issuer.endpoints.append(endpoint)
+        endpoint = dataclasses.replace(
+            endpoint, last_used_at=int(time.time()), counter=endpoint.counter + 1
+        )
+        issuers = upsert_endpoint_in_issuers(issuers, endpoint, issuer)
 
     # Notify about transaction completion.
     if result_flow != DigitalKeyFlow.ATTESTATION:
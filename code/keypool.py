@@ -0,0 +1,123 @@
+import logging
+import os
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from util.crypto import get_ec_key_public_points
+
+log = logging.getLogger()
+
+
+@dataclass(frozen=True)
+class EphemeralKey:
+    """Reader ephemeral key pair with public point pre-encoded for AUTH0"""
+
+    private_key: ec.EllipticCurvePrivateKey
+    public_key_x: bytes
+    public_key_y: bytes
+    # Uncompressed point, as sent in AUTH0 tag 0x87
+    public_key_bytes: bytes
+
+    @classmethod
+    def from_private_key(cls, private_key: ec.EllipticCurvePrivateKey):
+        x, y = get_ec_key_public_points(private_key.public_key())
+        return cls(
+            private_key=private_key,
+            public_key_x=x,
+            public_key_y=y,
+            public_key_bytes=bytes([0x04, *x, *y]),
+        )
+
+    @classmethod
+    def generate(cls):
+        return cls.from_private_key(ec.generate_private_key(ec.SECP256R1()))
+
+
+@dataclass(frozen=True)
+class TransactionMaterial:
+    """Single-use random material consumed by one authentication attempt"""
+
+    ephemeral_key: EphemeralKey
+    transaction_identifier: bytes
+    attestation_exchange_common_secret: bytes
+
+    @classmethod
+    def generate(cls):
+        return cls(
+            ephemeral_key=EphemeralKey.generate(),
+            transaction_identifier=os.urandom(16),
+            attestation_exchange_common_secret=os.urandom(32),
+        )
+
+
+class EphemeralKeyPool:
+    """Keeps a bounded amount of TransactionMaterial ready ahead of time.
+
+    Producer only runs while the pool is marked idle, so that key generation
+    does not compete with an ongoing transaction. Every item is handed out once;
+    if the pool runs dry, material is generated on the spot
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self._items = queue.Queue(maxsize=size)
+        self._idle = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self):
+        return self._items.qsize()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            name="keypool", target=self._produce, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        # Wake producer up so that it notices the flag
+        self._idle.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._idle.clear()
+
+    def set_idle(self, idle: bool):
+        if idle:
+            self._idle.set()
+        else:
+            self._idle.clear()
+
+    def _produce(self):
+        material = None
+        while not self._stopped.is_set():
+            self._idle.wait()
+            if self._stopped.is_set():
+                break
+            try:
+                material = material or TransactionMaterial.generate()
+                self._items.put(material, timeout=0.5)
+                material = None
+            except queue.Full:
+                continue
+            except Exception:
+                log.exception("Could not generate transaction material")
+                self._stopped.wait(5)
+
+    def get(self) -> TransactionMaterial:
+        try:
+            return self._items.get_nowait()
+        except queue.Empty:
+            log.debug("Key pool is empty, generating transaction material in place")
+            return TransactionMaterial.generate()
+
+
+__all__ = ("EphemeralKey", "TransactionMaterial", "EphemeralKeyPool")
@@ -0,0 +1,90 @@
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+log = logging.getLogger()
+
+
+@dataclass(frozen=True)
+class LockState:
+    target_locked: bool
+    current_locked: bool
+
+
+@dataclass(frozen=True)
+class LockStateChange:
+    previous: LockState
+    state: LockState
+    # Identifier of the endpoint that caused the change, None if it came from HAP or MQTT
+    key_id: Optional[str] = None
+
+    @property
+    def target_changed(self) -> bool:
+        return self.previous.target_locked != self.state.target_locked
+
+    @property
+    def current_changed(self) -> bool:
+        return self.previous.current_locked != self.state.current_locked
+
+    @property
+    def unlocked(self) -> bool:
+        """True if this change is the one that opened the lock"""
+        return self.previous.current_locked and not self.state.current_locked
+
+
+class LockStateMachine:
+    """Single source of truth for lock state.
+
+    Transitions are applied atomically and subscribers are notified once per
+    actual change, in the order changes happened
+    """
+
+    def __init__(self, state: LockState = LockState(False, False)):
+        self._state = state
+        self._subscribers: List[Callable[[LockStateChange], None]] = []
+        self._lock = threading.RLock()
+
+    @property
+    def state(self) -> LockState:
+        return self._state
+
+    def subscribe(self, callback: Callable[[LockStateChange], None]):
+        self._subscribers.append(callback)
+
+    def apply(
+        self,
+        target_locked: Optional[bool] = None,
+        current_locked: Optional[bool] = None,
+        key_id: Optional[str] = None,
+    ) -> Optional[LockStateChange]:
+        """Changes given fields at once, returns None if nothing changed"""
+        with self._lock:
+            previous = self._state
+            state = LockState(
+                target_locked=(
+                    previous.target_locked if target_locked is None else target_locked
+                ),
+                current_locked=(
+                    previous.current_locked
+                    if current_locked is None
+                    else current_locked
+                ),
+            )
+            if state == previous:
+                return None
+            self._state = state
+            change = LockStateChange(previous=previous, state=state, key_id=key_id)
+            for subscriber in self._subscribers:
+                try:
+                    subscriber(change)
+                except Exception:
+                    log.exception(f"Could not handle {change}")
+            return change
+
+    def set_locked(self, locked: bool, key_id: Optional[str] = None):
+        """Virtual lock moves instantly, so target and current are changed together"""
+        return self.apply(target_locked=locked, current_locked=locked, key_id=key_id)
+
+
+__all__ = ("LockState", "LockStateChange", "LockStateMachine")
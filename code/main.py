@@ -4,18 +4,39 @@ import logging
 import signal
 import sys
 
+from pyhap.accessory import Bridge
 from pyhap.accessory_driver import AccessoryDriver
 
 from accessory import Lock
 from util.bfclf import BroadcastFrameContactlessFrontend
 from repository import Repository
 from service import Service
-from mqtt import Mqtt
+from mqtt import Mqtt, MqttLock
 from prometheus import AppMetrics
 
+def parse_locks(value: str, lock_name: str, nfc_port: str) -> list:
+    """Parse "Front Door=USB0,Back Door=USB1" into lock configs, defaulting to a single lock."""
+    locks = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, port = item.partition("=")
+        locks.append({"name": name.strip(), "nfc_port": port.strip() or nfc_port})
+    return locks or [{"name": lock_name, "nfc_port": nfc_port}]
+
+
+def get_lock_persist_path(path: str, lock_name: str) -> str:
+    """Return a file path next to the given one, dedicated to a lock."""
+    root, extension = os.path.splitext(path)
+    return f"{root}.{lock_name}{extension}"
+
+
 def load_configuration() -> dict:
     """Load application configs."""
     return {
+        "locks": parse_locks(str(os.getenv("LOCKS", "")),
+                             str(os.getenv("LOCK_NAME", "NFC_LOCK")),
+                             str(os.getenv("NFC_PORT", "USB0"))),
         "logging": {
             "level":  int(os.getenv("LOG_LEVEL", "20"))
         },
@@ -28,13 +49,21 @@ def load_configuration() -> dict:
             "lock_name": str(os.getenv("LOCK_NAME", "NFC_LOCK")),
             "port": int(os.getenv("HAP_PORT", "51926")),
             "persist": str(os.getenv("HAP_PERSIST", "/persist/hap.state")),
-            "should_relock": (True if os.getenv("LOCK_SHOULD_RELOCK", "True") == "True" else False)
+            "should_relock": (True if os.getenv("LOCK_SHOULD_RELOCK", "True") == "True" else False),
+            "relock_delay": float(os.getenv("LOCK_RELOCK_DELAY", "1"))
         },
         "homekey": {
             "persist": str(os.getenv("HOMEKEY_PERSIST", "/persist/homekey.json")),
             "express": (True if os.getenv("HOMEKEY_EXPRESS", "True") == "True" else False),
             "finish": str(os.getenv("HOMEKEY_FINISH", "black")),
-            "flow": str(os.getenv("HOMEKEY_FLOW", "fast"))
+            "flow": str(os.getenv("HOMEKEY_FLOW", "fast")),
+            "match_workers": int(os.getenv("HOMEKEY_MATCH_WORKERS", "0")),
+            "key_pool_size": int(os.getenv("HOMEKEY_KEY_POOL_SIZE", "4")),
+            "speculative_standard": (True if os.getenv("HOMEKEY_SPECULATIVE_STANDARD", "False") == "True" else False),
+            "usage_flush_interval": int(os.getenv("HOMEKEY_USAGE_FLUSH_INTERVAL", "30")),
+            "poll_idle_interval": float(os.getenv("HOMEKEY_POLL_IDLE_INTERVAL", "0")),
+            "poll_active_period": float(os.getenv("HOMEKEY_POLL_ACTIVE_PERIOD", "30")),
+            "cooldown": str(os.getenv("HOMEKEY_COOLDOWN", "2"))
         },
         "mqtt": {
             "server": str(os.getenv("MQTT_SERVER", "192.168.1.2")),
@@ -46,6 +75,9 @@ def load_configuration() -> dict:
             "lock_id": str(os.getenv("LOCK_NAME", "NFC_LOCK")),
             "prefix_topic": str(os.getenv("MQTT_PREFIX_TOPIC", "mqtt-homekey-lock")),
             "hass_enabled": (True if os.getenv("MQTT_HASS_ENABLED", "True") == "True" else False),
+            "hass_discovery_delay": float(os.getenv("MQTT_HASS_DISCOVERY_DELAY", "10")),
+            "reconnect_max_delay": float(os.getenv("MQTT_RECONNECT_MAX_DELAY", "120")),
+            "offline_buffer_size": int(os.getenv("MQTT_OFFLINE_BUFFER_SIZE", "100")),
             "hass_status_topic": str(os.getenv("MQTT_STATUS_TOPIC", "homeassistant/status"))
         },
         "metrics": {
@@ -70,19 +102,34 @@ def configure_logging(config: dict):
 
 def configure_metrics(config: dict) -> AppMetrics:
     """Return application metrics."""
-    metrics = AppMetrics.from_dict(config=config["metrics"])
+    metrics = AppMetrics.from_dict(config=config)
     return metrics
 
 
-def configure_hap_accessory(config: dict, mqtt: Mqtt, metrics:AppMetrics, homekey_service=None):
+def configure_hap_accessory(config: dict, mqtt: MqttLock, metrics:AppMetrics, homekey_service=None):
     """Configure HAP accessory."""
     driver = AccessoryDriver(port=config["port"], persist_file=config["persist"])
     accessory = Lock(driver, config["lock_name"], should_relock=config["should_relock"],
+                     relock_delay=config.get("relock_delay", 1.0),
                      mqtt=mqtt, metrics=metrics, service=homekey_service)
     driver.add_accessory(accessory=accessory)
     return driver, accessory
 
 
+def configure_hap_bridge(config: dict, mqtt: Mqtt, metrics: dict, homekey_services: dict):
+    """Configure HAP bridge with a lock accessory for every NFC reader."""
+    driver = AccessoryDriver(port=config["port"], persist_file=config["persist"])
+    bridge = Bridge(driver, config["lock_name"])
+    for lock_name, homekey_service in homekey_services.items():
+        accessory = Lock(driver, lock_name, should_relock=config["should_relock"],
+                         relock_delay=config.get("relock_delay", 1.0),
+                         mqtt=mqtt.lock(lock_name), metrics=metrics[lock_name],
+                         service=homekey_service)
+        bridge.add_accessory(accessory)
+    driver.add_accessory(accessory=bridge)
+    return driver, bridge
+
+
 def configure_nfc_device(config: dict):
     """Configure NFC module."""
     clf = BroadcastFrameContactlessFrontend(
@@ -96,10 +143,19 @@ def configure_homekey_service(config: dict, nfc_device, repository=None):
     """Configure homekey service."""
     service = Service(
         nfc_device,
-        repository=repository or Repository(config["persist"]),
+        repository=repository or Repository(
+            config["persist"],
+            usage_flush_interval=config.get("usage_flush_interval", 30),
+        ),
         express=config.get("express", True),
         finish=config.get("finish"),
         flow=config.get("flow"),
+        match_workers=config.get("match_workers", 0),
+        key_pool_size=config.get("key_pool_size", 4),
+        speculative_standard=config.get("speculative_standard", False),
+        poll_idle_interval=config.get("poll_idle_interval", 0.0),
+        poll_active_period=config.get("poll_active_period", 30.0),
+        cooldowns=config.get("cooldown", 2.0),
     )
     return service
 
@@ -108,24 +164,42 @@ def main():
     """Main application run."""
     config = load_configuration()
     log = configure_logging(config["logging"])
-    metrics = configure_metrics(config["metrics"])
-
-    nfc_device = configure_nfc_device(config["nfc"])
-    homekey_service = configure_homekey_service(config["homekey"], nfc_device)
-    mqtt = Mqtt(config["mqtt"])
-    hap_driver, _ = configure_hap_accessory(config["hap"], mqtt, metrics, homekey_service)
+    locks = config["locks"]
+    # All locks share one MQTT connection and one metrics endpoint
+    mqtt = Mqtt(config["mqtt"], lock_ids=[lock["name"] for lock in locks])
+    metrics = {}
+    homekey_services = {}
+    for lock in locks:
+        metrics[lock["name"]] = configure_metrics({**config["metrics"], "lock_name": lock["name"]})
+        nfc_device = configure_nfc_device({**config["nfc"], "port": lock["nfc_port"]})
+        homekey_config = config["homekey"]
+        if len(locks) > 1:
+            homekey_config = {**homekey_config,
+                              "persist": get_lock_persist_path(homekey_config["persist"], lock["name"])}
+        homekey_services[lock["name"]] = configure_homekey_service(homekey_config, nfc_device)
+
+    if len(locks) == 1:
+        lock_name = locks[0]["name"]
+        hap_driver, _ = configure_hap_accessory(config["hap"], mqtt.lock(lock_name),
+                                                metrics[lock_name], homekey_services[lock_name])
+    else:
+        hap_driver, _ = configure_hap_bridge(config["hap"], mqtt, metrics, homekey_services)
 
     for s in (signal.SIGINT, signal.SIGTERM):
         signal.signal(
             s,
             lambda *_: (
                 log.info(f"SIGNAL {s}"),
-                homekey_service.stop(),
+                [homekey_service.stop() for homekey_service in homekey_services.values()],
                 hap_driver.stop(),
+                mqtt.stop(),
             ),
         )
 
-    homekey_service.start()
+    # Collectors are shared by all locks, so a single server exports all of them
+    next(iter(metrics.values())).start_server()
+    for homekey_service in homekey_services.values():
+        homekey_service.start()
     hap_driver.start()
 
 
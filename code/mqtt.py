@@ -1,15 +1,23 @@
 """Module to handle mqtt."""
 import json
+import math
 import random
+import re
 import string
-import time
+import threading
 import logging
+from collections import OrderedDict
 from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
 
 import paho.mqtt.client as mqtt_client
 
 log = logging.getLogger()
 
+def hass_object_id(name:str) -> str:
+    """Make a name usable in discovery topics and unique ids, hass only accepts [a-zA-Z0-9_-]."""
+    return re.sub(r"[^a-zA-Z0-9_-]", "_", name)
+
 @dataclass
 class MqttConfig:
     """Class to hold mqtt configs."""
@@ -20,6 +28,9 @@ class MqttConfig:
     mqtt_user: str
     mqtt_pass: str
     mqtt_ha_enable: bool
+    mqtt_ha_discovery_delay: float
+    mqtt_reconnect_max_delay: float
+    mqtt_offline_buffer_size: int
     lock_id: str
     mqtt_topic_prefix: str
     mqtt_ha_status_topic: str
@@ -39,6 +50,9 @@ class MqttConfig:
             mqtt_user = config.get("user", ""),
             mqtt_pass = config.get("pass", ""),
             mqtt_ha_enable = config.get("hass_enabled", True),
+            mqtt_ha_discovery_delay = config.get("hass_discovery_delay", 10.0),
+            mqtt_reconnect_max_delay = config.get("reconnect_max_delay", 120.0),
+            mqtt_offline_buffer_size = config.get("offline_buffer_size", 100),
             lock_id = config.get("lock_id", "0"),
             mqtt_topic_prefix = config.get("prefix_topic", ""),
             mqtt_ha_status_topic = config.get(
@@ -53,63 +67,329 @@ class MqttConfig:
                 "prefix_topic", "") + "/" + config.get("lock_id", "0") + "/key_id_authed"
         )
 
+    def lock_topic(self, lock_id:str, name:str) -> str:
+        """Topic of a lock sharing this connection, e.g. prefix/lock_id/mqtt_state_topic."""
+        return self.mqtt_topic_prefix + "/" + lock_id + "/" + name
+
+@dataclass
+class MqttMessage:
+    """Class to hold an outbound mqtt message."""
+    topic: str
+    payload: str
+    qos: int = 0
+    retain: bool = False
+
+class MqttOutbox:
+    """Queue of outbound messages, doubling as a buffer while offline.
+    A retained message replaces the pending one for the same topic, as only the latest value matters,
+    other messages are all kept in order. Once max_size is exceeded, oldest other message is dropped.
+    Retained messages are never dropped, there is at most one per topic so they are bounded anyway."""
+    def __init__(self, max_size:int=100, on_dropped=None):
+        self.max_size = max_size
+        self.on_dropped = on_dropped
+        self._messages = OrderedDict()
+        self._sequence = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._messages)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def _key(self, message:MqttMessage):
+        if message.retain:
+            return ("retained", message.topic)
+        self._sequence += 1
+        return ("event", self._sequence)
+
+    def _drop_oldest(self):
+        key = next((k for k in self._messages if k[0] == "event"), None)
+        if key is None:
+            return
+        message = self._messages.pop(key)
+        log.warning("Outbound queue is full, dropping message to %s", message.topic)
+        if self.on_dropped is not None:
+            self.on_dropped(message)
+
+    def put(self, message:MqttMessage) -> bool:
+        """Enqueue message, returns True if it superseded a pending one."""
+        with self._condition:
+            key = self._key(message)
+            superseded = self._messages.pop(key, None) is not None
+            self._messages[key] = message
+            if len(self._messages) > self.max_size:
+                self._drop_oldest()
+            self._condition.notify()
+            return superseded
+
+    def put_back(self, message:MqttMessage):
+        """Return a message that could not be sent to the front of the queue."""
+        with self._condition:
+            key = self._key(message)
+            if key in self._messages:
+                # Superseded while it was being sent
+                return
+            self._messages[key] = message
+            self._messages.move_to_end(key, last=False)
+            if len(self._messages) > self.max_size:
+                self._drop_oldest()
+            self._condition.notify()
+
+    def get(self, timeout:Optional[float]=None) -> Optional[MqttMessage]:
+        """Dequeue oldest message, returns None on timeout or once closed and drained."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._messages or self._closed, timeout)
+            if not self._messages:
+                return None
+            _, message = self._messages.popitem(last=False)
+            return message
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+class MqttPublisher:
+    """Class to publish messages from a worker thread, so that callers never wait for the broker.
+    Messages are held back while the connection is down."""
+    def __init__(self, client=None, max_pending:int=100):
+        self.client = client
+        self.outbox = MqttOutbox(max_pending, on_dropped=self._message_dropped)
+        self.superseded = 0
+        self.dropped = 0
+        self._connected = threading.Event()
+        self._thread = threading.Thread(name="mqtt-publisher", target=self._run, daemon=True)
+
+    # This should be overriden by the owner
+    def on_message_dropped(self, message:MqttMessage):
+        """Called when a message is dropped from a full queue or could not be published."""
+
+    def _message_dropped(self, message:MqttMessage):
+        self.dropped += 1
+        self.on_message_dropped(message)
+
+    def set_connected(self, connected:bool):
+        if connected:
+            self._connected.set()
+        else:
+            self._connected.clear()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout:float=5.0):
+        """Publish pending messages if connected and stop the worker."""
+        self.outbox.close()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def publish(self, topic:str, payload:str, qos:int=0, retain:bool=False):
+        if self.outbox.put(MqttMessage(topic, payload, qos, retain)):
+            self.superseded += 1
+
+    def _run(self):
+        while True:
+            while not self._connected.wait(0.5):
+                if self.outbox.closed:
+                    return
+            message = self.outbox.get()
+            if message is None:
+                return
+            try:
+                result = self.client.publish(message.topic, message.payload, message.qos, message.retain)
+            except Exception:
+                log.exception("Could not publish to %s", message.topic)
+                self._message_dropped(message)
+                continue
+            if result.rc == mqtt_client.MQTT_ERR_NO_CONN:
+                # Connection dropped before on_disconnect was called
+                self.set_connected(False)
+                self.outbox.put_back(message)
+            elif result.rc != mqtt_client.MQTT_ERR_SUCCESS:
+                log.warning("Could not publish to %s: %s", message.topic, mqtt_client.error_string(result.rc))
+                self._message_dropped(message)
+
+
+class MqttDispatcher:
+    """Routes inbound messages to handlers by topic.
+    Exact topics are found with a single dict lookup, filters with wildcards are only tried if none matched."""
+    def __init__(self):
+        self._handlers: Dict[str, Callable[[str, str], None]] = {}
+        self._filters: List[tuple] = []
+
+    def add(self, topic:str, handler:Callable[[str, str], None]):
+        if "+" in topic or "#" in topic:
+            self._filters.append((topic, handler))
+        else:
+            self._handlers[topic] = handler
+
+    def dispatch(self, topic:str, payload:str) -> bool:
+        """Call handler of a topic, returns False if there is none."""
+        handler = self._handlers.get(topic)
+        if handler is None:
+            handler = next((h for f, h in self._filters if mqtt_client.topic_matches_sub(f, topic)), None)
+            if handler is None:
+                return False
+        handler(topic, payload)
+        return True
+
 class Mqtt:
     """Class to handle mqtt."""
     def __init__(
         self,
-        config_dict:dict
+        config_dict:dict,
+        lock_ids:Optional[List[str]]=None
         ) -> None:
         self.config = MqttConfig.from_dict(config_dict)
-        self.update_callback = self.default_update_callback
+        # All locks share one connection, topics are routed by lock id
+        self.locks: Dict[str, MqttLock] = {
+            lock_id: MqttLock(self, lock_id) for lock_id in (lock_ids or [self.config.lock_id])}
+        self._hass_config_timer = None
+        self._hass_config_lock = threading.Lock()
+        self._was_connected = False
+        self.publisher = MqttPublisher(max_pending=self.config.mqtt_offline_buffer_size)
+        self.publisher.on_message_dropped = self._message_dropped
+        self.publisher.start()
         self.connect_mqtt()
 
+    def lock(self, lock_id:Optional[str]=None) -> "MqttLock":
+        """Return topics and callbacks of a lock, the first one by default."""
+        if lock_id is None:
+            return next(iter(self.locks.values()))
+        return self.locks[lock_id]
+
+    def _message_dropped(self, message:MqttMessage):
+        for lock in self.locks.values():
+            if message.topic.startswith(lock.topic_prefix):
+                lock.on_message_dropped()
+
+    def stop(self):
+        """Flush pending messages and disconnect."""
+        with self._hass_config_lock:
+            if self._hass_config_timer is not None:
+                self._hass_config_timer.cancel()
+                self._hass_config_timer = None
+        # Will is not sent on a clean disconnect
+        self.publisher.publish(self.config.mqtt_oneline_topic, "offline", 0, True)
+        self.publisher.stop()
+        self.client.disconnect()
+        self.client.loop_stop()
+
     def connect_mqtt(self):
-        """Connect to mqtt."""
+        """Connect to mqtt. Connection is made and restored in the background by paho."""
         log.info("Connecting to MQTT")
         def on_connect(client, _1, _2, rc):
             if rc == 0:
                 log.info("Connected to MQTT Broker!")
+                if self._was_connected:
+                    for lock in self.locks.values():
+                        lock.on_reconnected()
+                self._was_connected = True
                 self.setup_subscriptions()
-                self.publish_hass_config()
-                client.publish(self.config.mqtt_oneline_topic, "online", 0, True)
+                self.schedule_hass_config()
+                self.publisher.publish(self.config.mqtt_oneline_topic, "online", 0, True)
+                self.publisher.set_connected(True)
             else:
                 log.error("Failed to connect, return code %d\n", rc)
-        def on_disconnect(_1, _2, _3):
-            self.connect_mqtt()
-            log.warning("Mqtt Disconnected")
+        def on_disconnect(_1, _2, rc):
+            self.publisher.set_connected(False)
+            log.warning("Mqtt Disconnected, return code %d", rc)
         # Set Connecting Client ID
         rand_string = ''.join(random.choice(string.ascii_letters) for i in range(8))
         self.client = mqtt_client.Client(self.config.mqtt_client_id + "_" + rand_string)
+        self.publisher.client = self.client
         if self.config.mqtt_auth:
             self.client.username_pw_set(self.config.mqtt_user, self.config.mqtt_pass)
         self.client.on_connect = on_connect
         self.client.on_disconnect = on_disconnect
         self.client.will_set(self.config.mqtt_oneline_topic, "offline", 0, True)
-        self.client.connect(self.config.mqtt_server, self.config.mqtt_port)
+        # paho doubles the delay after each failed attempt, jitter keeps many readers
+        # from reconnecting in lockstep after a broker restart
+        self.client.reconnect_delay_set(
+            min_delay=random.uniform(0.5, 1.5),
+            max_delay=self.config.mqtt_reconnect_max_delay * random.uniform(0.8, 1.0))
+        self.client.connect_async(self.config.mqtt_server, self.config.mqtt_port)
         self.client.loop_start()
         log.info("MQTT Connection setup")
 
     def setup_subscriptions(self):
         """Setup mqtt subscriptions."""
+        dispatcher = MqttDispatcher()
+        dispatcher.add(self.config.mqtt_ha_status_topic, self._on_hass_status)
+        for lock in self.locks.values():
+            for name, handler in lock.command_handlers().items():
+                dispatcher.add(lock.topic_prefix + name, handler)
         def on_message(_1, _2, msg):
-            log.debug("Message recieved on topic: " +
-                      msg.topic + " With Message: " +
-                      msg.payload.decode())
-            if msg.topic == self.config.mqtt_command_topic:
-                self.update_callback(True if msg.payload.decode() == "lock" else False)
-            elif msg.topic == self.config.mqtt_ha_status_topic:
-                self.publish_hass_config()
-
-        self.client.subscribe(self.config.mqtt_command_topic)
+            log.debug("Message recieved on topic: %s With Message: %r", msg.topic, msg.payload)
+            try:
+                payload = msg.payload.decode()
+            except UnicodeDecodeError:
+                log.warning("Ignoring message with invalid payload on topic %s", msg.topic)
+                return
+            try:
+                if not dispatcher.dispatch(msg.topic, payload):
+                    log.debug("No handler for topic %s", msg.topic)
+            except Exception:
+                log.exception("Could not handle message on topic %s", msg.topic)
+
+        # A wildcard subscription per command covers all locks sharing the connection
+        for name in MqttLock.COMMANDS:
+            self.client.subscribe(self.config.lock_topic("+", name))
         self.client.subscribe(self.config.mqtt_ha_status_topic)
         self.client.on_message = on_message
         log.info("Subscription setup")
 
+    def _on_hass_status(self, _, payload:str):
+        if payload == "online":
+            self.schedule_hass_config()
+
+    def schedule_hass_config(self):
+        """Publish hass config after a delay, giving home assistant time to subscribe.
+        Runs on a timer so that paho callbacks are not blocked, requests made while one is pending are merged."""
+        if not self.config.mqtt_ha_enable:
+            return
+        with self._hass_config_lock:
+            if self._hass_config_timer is not None:
+                return
+            self._hass_config_timer = threading.Timer(
+                self.config.mqtt_ha_discovery_delay, self._publish_scheduled_hass_config)
+            self._hass_config_timer.daemon = True
+            self._hass_config_timer.start()
+
+    def _publish_scheduled_hass_config(self):
+        with self._hass_config_lock:
+            self._hass_config_timer = None
+        self.publish_hass_config()
+
     def publish_hass_config(self):
-        """Publish hass config to mqtt."""
-        time.sleep(10)
-        hass_device_name = "mqtt-homekey-lock-" + self.config.lock_id
-        hass_lock_name = "mqtt-homekey-lock-" + self.config.lock_id + "-lock"
+        """Publish hass config of every lock to mqtt."""
+        for lock in self.locks.values():
+            self.publisher.publish(lock.hass_config_topic, lock.hass_config_payload)
+
+class MqttLock:
+    """Class to handle mqtt topics of a single lock, many locks can share one connection."""
+    # Inbound topics under the lock prefix
+    COMMANDS = ("command_topic", "relock_delay/set", "reannounce")
+
+    def __init__(self, mqtt:Mqtt, lock_id:str):
+        self.mqtt = mqtt
+        self.lock_id = lock_id
+        self.topic_prefix = mqtt.config.lock_topic(lock_id, "")
+        self.state_topic = mqtt.config.lock_topic(lock_id, "mqtt_state_topic")
+        self.command_topic = mqtt.config.lock_topic(lock_id, "command_topic")
+        self.key_id_authed_topic = mqtt.config.lock_topic(lock_id, "key_id_authed")
+        self.update_callback = self.default_update_callback
+        self.hass_config_topic, self.hass_config_payload = self.build_hass_config()
+
+    def build_hass_config(self):
+        """Create hass config topic and payload, they only depend on configuration."""
+        object_id = hass_object_id(self.lock_id)
+        hass_device_name = "mqtt-homekey-lock-" + object_id
+        hass_lock_name = "mqtt-homekey-lock-" + object_id + "-lock"
         config = {
             "name": "lock",
             "unique_id": hass_lock_name,
@@ -127,23 +407,61 @@ class Mqtt:
             "state_unlocked":"unlocked",
             "state_locking":"unlocking",
             "state_unlocking":"unlocking",
-            "state_topic": self.config.mqtt_state_topic,
-            "command_topic": self.config.mqtt_command_topic,
+            "state_topic": self.state_topic,
+            "command_topic": self.command_topic,
+            # Availability follows the shared connection
             "availability": {
-                "topic": self.config.mqtt_oneline_topic,
+                "topic": self.mqtt.config.mqtt_oneline_topic,
                 "payload_available":"online",
                 "payload_not_available":"offline"
             }
         }
-        self.client.publish(
-            "homeassistant/lock/" + hass_lock_name + "/config",
-            json.dumps(config))
-
+        return "homeassistant/lock/" + hass_lock_name + "/config", json.dumps(config)
 
-    # This should be overriden by the accessory file
+    # These should be overriden by the accessory file
     def default_update_callback(self, set_locked:bool):
         """Create a default callback to call when mqtt sets state."""
 
+    def on_reconnected(self):
+        """Called when connection to the broker was restored."""
+
+    def on_message_dropped(self):
+        """Called when an outbound message of this lock was dropped while offline."""
+
+    def on_relock_delay(self, delay:float):
+        """Called when relock delay is set over mqtt."""
+
+    def on_reannounce(self):
+        """Called when state of the lock should be published again."""
+
+    def command_handlers(self) -> Dict[str, Callable[[str, str], None]]:
+        return {
+            "command_topic": self._handle_command,
+            "relock_delay/set": self._handle_relock_delay,
+            "reannounce": self._handle_reannounce,
+        }
+
+    def _handle_command(self, topic:str, payload:str):
+        if payload not in ("lock", "unlock"):
+            log.warning("Ignoring invalid command %r on topic %s", payload, topic)
+            return
+        self.update_callback(payload == "lock")
+
+    def _handle_relock_delay(self, topic:str, payload:str):
+        try:
+            delay = float(payload)
+        except ValueError:
+            delay = math.nan
+        if not math.isfinite(delay) or delay < 0:
+            log.warning("Ignoring invalid relock delay %r on topic %s", payload, topic)
+            return
+        self.on_relock_delay(delay)
+
+    def _handle_reannounce(self, _topic:str, _payload:str):
+        if self.mqtt.config.mqtt_ha_enable:
+            self.mqtt.publisher.publish(self.hass_config_topic, self.hass_config_payload)
+        self.on_reannounce()
+
     def update_state(self, target_locked:bool, current_locked:bool):
         """Send status update to mqtt."""
         pub_state = "unkown"
@@ -155,9 +473,8 @@ class Mqtt:
             pub_state = "unlocking"
         elif target_locked and not current_locked:
             pub_state = "locking"
-        self.client.publish(self.config.mqtt_state_topic, pub_state, 0, True)
+        self.mqtt.publisher.publish(self.state_topic, pub_state, 0, True)
 
     def device_passed_auth(self, key_id:str):
         """Send device authentication method to mqtt."""
-        self.client.publish(self.config.mqtt_key_id_authed_topic, key_id)
-    
\ No newline at end of file
+        self.mqtt.publisher.publish(self.key_id_authed_topic, key_id)
@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional, Union
+
+log = logging.getLogger()
+
+
+def parse_cooldowns(value: Union[str, float, Dict[str, float]]) -> Dict[str, float]:
+    """Parses cooldowns given as a single number of seconds or as "fast=1,standard=2" pairs"""
+    if isinstance(value, dict):
+        return {key.lower(): float(seconds) for key, seconds in value.items()}
+    if isinstance(value, (int, float)):
+        return {"default": float(value)}
+    cooldowns = dict()
+    for item in str(value).split(","):
+        if not item.strip():
+            continue
+        key, separator, seconds = item.partition("=")
+        if separator:
+            cooldowns[key.strip().lower()] = float(seconds)
+        else:
+            cooldowns["default"] = float(key)
+    return cooldowns
+
+
+class PollingScheduler:
+    """Paces the NFC sense loop.
+
+    Polls back to back for active_period seconds after any activity, such as a tap
+    or a lock state change coming from HAP or MQTT, then backs off to idle_interval
+    between polls to reduce reader heat and bus traffic.
+    Waits can be interrupted by activity or by stop
+    """
+
+    def __init__(
+        self,
+        active_interval: float = 0.0,
+        idle_interval: float = 0.0,
+        active_period: float = 30.0,
+        cooldowns: Union[str, float, Dict[str, float]] = 2.0,
+        presence_interval: float = 0.5,
+        clock=time.monotonic,
+    ):
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.active_period = active_period
+        self.cooldowns = {"default": 2.0, **parse_cooldowns(cooldowns)}
+        self.presence_interval = presence_interval
+        self._clock = clock
+        self._active_until = clock() + active_period
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    @property
+    def is_active(self) -> bool:
+        return self._clock() < self._active_until
+
+    @property
+    def poll_interval(self) -> float:
+        return self.active_interval if self.is_active else self.idle_interval
+
+    def mark_activity(self):
+        """Switches to tight polling, cutting short a pending idle wait"""
+        self._active_until = self._clock() + self.active_period
+        self._wakeup.set()
+
+    def get_cooldown(self, flow: Optional[str]) -> float:
+        """Seconds to wait after a device left the field, keyed by flow name or "failed" """
+        key = (flow or "failed").lower()
+        return self.cooldowns.get(key, self.cooldowns["default"])
+
+    def sleep(self, seconds: float, interruptible=False) -> bool:
+        """Returns False if scheduler was stopped meanwhile"""
+        if self._stopped:
+            return False
+        if seconds <= 0:
+            return True
+        self._wakeup.clear()
+        if interruptible:
+            self._wakeup.wait(seconds)
+        else:
+            deadline = time.monotonic() + seconds
+            remaining = seconds
+            # Activity does not cut cooldown short, only stop does
+            while remaining > 0 and not self._stopped:
+                self._wakeup.wait(remaining)
+                self._wakeup.clear()
+                remaining = deadline - time.monotonic()
+        return not self._stopped
+
+    def wait_for_next_poll(self) -> bool:
+        return self.sleep(self.poll_interval, interruptible=True)
+
+    def start(self):
+        self._stopped = False
+        self.mark_activity()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+
+__all__ = ("PollingScheduler", "parse_cooldowns")
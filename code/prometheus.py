@@ -2,7 +2,13 @@
 
 from dataclasses import dataclass
 
-from prometheus_client import start_http_server, Enum, Counter
+from prometheus_client import start_http_server, Enum, Counter, Gauge, Histogram
+
+from tracing import Trace
+
+# NFC transactions take from tens of milliseconds up to a few seconds for attestation
+TRANSACTION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5,
+                       0.75, 1.0, 2.5, 5.0)
 
 @dataclass
 class Metrics:
@@ -11,8 +17,46 @@ class Metrics:
                               states=["Locked", "Unlocked"], labelnames=['lock_name'])
     lock_current_status = Enum("mqtt_current_lock_status", "Current Lock Status",
                                states=["Locked", "Unlocked"], labelnames=['lock_name'])
-    unlock_counter = Counter('my_failures', 'Description of counter',
-                             labelnames=['lock_name'], labelnames=['lock_name', 'key_id'])
+    unlock_counter = Counter("homekey_unlocks", "Number of times the lock was unlocked",
+                             labelnames=['lock_name', 'key_id'])
+    transaction_phase_duration = Histogram(
+        "homekey_transaction_phase_seconds", "Duration of a single phase of NFC transaction",
+        labelnames=['lock_name', 'flow', 'phase'], buckets=TRANSACTION_BUCKETS)
+    tap_to_unlock_duration = Histogram(
+        "homekey_tap_to_unlock_seconds",
+        "Time from device detection until lock callback returned",
+        labelnames=['lock_name', 'flow'], buckets=TRANSACTION_BUCKETS)
+    transaction_duration = Histogram(
+        "homekey_transaction_seconds", "Duration of whole NFC transaction",
+        labelnames=['lock_name', 'flow'], buckets=TRANSACTION_BUCKETS)
+    transactions = Counter("homekey_transactions", "Number of NFC transactions by resulting flow",
+                           labelnames=['lock_name', 'flow'])
+    auth_round_trip_duration = Histogram(
+        "homekey_auth_round_trip_seconds", "Time from sending AUTH0 or AUTH1 until response",
+        labelnames=['lock_name', 'command'], buckets=TRANSACTION_BUCKETS)
+    errors = Counter("homekey_errors", "Number of failed NFC transactions by error type",
+                     labelnames=['lock_name', 'error'])
+    reader_connects = Counter("homekey_reader_connects",
+                              "Number of times the NFC reader was connected, including reconnects",
+                              labelnames=['lock_name'])
+    repository_save_duration = Histogram(
+        "homekey_repository_save_seconds", "Time to persist Home Key configuration",
+        labelnames=['lock_name', 'operation'], buckets=TRANSACTION_BUCKETS)
+    issuers = Gauge("homekey_issuers", "Number of configured issuers", labelnames=['lock_name'])
+    endpoints = Gauge("homekey_endpoints", "Number of configured endpoints",
+                      labelnames=['lock_name'])
+    nfc_poll_interval = Gauge("homekey_nfc_poll_interval_seconds",
+                              "Current pause between NFC polls", labelnames=['lock_name'])
+    nfc_polls = Counter("homekey_nfc_polls", "Number of NFC polls",
+                        labelnames=['lock_name'])
+    nfc_rf_on_duration = Counter("homekey_nfc_rf_on_seconds",
+                                 "Time spent with RF field on while polling",
+                                 labelnames=['lock_name'])
+    mqtt_reconnects = Counter("mqtt_reconnects", "Number of times MQTT connection was restored",
+                              labelnames=['lock_name'])
+    mqtt_dropped_messages = Counter("mqtt_dropped_messages",
+                                    "Number of outbound MQTT messages dropped while offline",
+                                    labelnames=['lock_name'])
 
 @dataclass
 class AppMetricsParams:
@@ -33,7 +77,7 @@ class AppMetrics:
         """Create class from dict."""
         params = AppMetricsParams()
         params.metrics_enabled = config.get("enabled", True)
-        params.metrics_port = config.get("metrics_port", 8000)
+        params.metrics_port = config.get("port", 8000)
         params.lock_name = config.get("lock_name", "NFC Lock")
         return AppMetrics(params=params)
 
@@ -43,11 +87,77 @@ class AppMetrics:
         if self.params.metrics_enabled:
             start_http_server(self.params.metrics_port)
 
-    def lock_updated(self, target_locked:bool, current_locked:bool, key_id:str="Homekit"):
+    def lock_updated(self, target_locked:bool, current_locked:bool, key_id:str="Homekit",
+                     unlocked:bool=False):
         """Export Metric"""
         if self.params.metrics_enabled:
             self.metrics.lock_target_status.labels(
                 lock_name=self.params.lock_name).state("Locked" if target_locked else "Unlocked")
             self.metrics.lock_current_status.labels(
                 lock_name=self.params.lock_name).state("Locked" if current_locked else "Unlocked")
-            self.metrics.unlock_counter.labels(lock_name=self.params.lock_name, key_id=key_id).inc()
+            if unlocked:
+                self.metrics.unlock_counter.labels(lock_name=self.params.lock_name, key_id=key_id).inc()
+
+    def transaction_traced(self, transaction: Trace):
+        """Export phase timings of a NFC transaction"""
+        if self.params.metrics_enabled:
+            flow = transaction.attributes.get("flow", "FAILED")
+            self.metrics.transactions.labels(lock_name=self.params.lock_name, flow=flow).inc()
+            for span in transaction.spans:
+                self.metrics.transaction_phase_duration.labels(
+                    lock_name=self.params.lock_name, flow=flow, phase=span.name).observe(span.duration)
+                if span.name in ("auth0", "auth1"):
+                    self.metrics.auth_round_trip_duration.labels(
+                        lock_name=self.params.lock_name, command=span.name).observe(span.duration)
+            self.metrics.transaction_duration.labels(
+                lock_name=self.params.lock_name, flow=flow).observe(transaction.duration)
+            unlocked = transaction.get_span("lock_callback")
+            if unlocked is not None:
+                # Device is in the field once sense returned, time spent polling before does not count
+                sensed = transaction.get_span("sense")
+                detected_at = sensed.finished_at if sensed is not None else 0.0
+                self.metrics.tap_to_unlock_duration.labels(
+                    lock_name=self.params.lock_name, flow=flow).observe(unlocked.finished_at - detected_at)
+
+    def nfc_polled(self, duration: float):
+        """Export NFC poll rate and RF on time"""
+        if self.params.metrics_enabled:
+            self.metrics.nfc_polls.labels(lock_name=self.params.lock_name).inc()
+            self.metrics.nfc_rf_on_duration.labels(lock_name=self.params.lock_name).inc(duration)
+
+    def mqtt_reconnected(self):
+        """Export MQTT reconnect"""
+        if self.params.metrics_enabled:
+            self.metrics.mqtt_reconnects.labels(lock_name=self.params.lock_name).inc()
+
+    def mqtt_message_dropped(self):
+        """Export dropped MQTT message"""
+        if self.params.metrics_enabled:
+            self.metrics.mqtt_dropped_messages.labels(lock_name=self.params.lock_name).inc()
+
+    def protocol_error(self, error: Exception):
+        """Export failed transaction"""
+        if self.params.metrics_enabled:
+            self.metrics.errors.labels(
+                lock_name=self.params.lock_name, error=type(error).__name__).inc()
+
+    def reader_connected(self):
+        """Export NFC reader connect"""
+        if self.params.metrics_enabled:
+            self.metrics.reader_connects.labels(lock_name=self.params.lock_name).inc()
+
+    def repository_saved(self, operation: str, duration: float):
+        """Export time it took to persist configuration"""
+        if self.params.metrics_enabled:
+            self.metrics.repository_save_duration.labels(
+                lock_name=self.params.lock_name, operation=operation).observe(duration)
+
+    def track_service(self, service):
+        """Export gauges that are read from the service on every scrape"""
+        if self.params.metrics_enabled:
+            self.metrics.issuers.labels(lock_name=self.params.lock_name).set_function(
+                lambda: len(service.repository.get_all_issuers()))
+            self.metrics.endpoints.labels(lock_name=self.params.lock_name).set_function(
+                lambda: len(service.repository.get_all_endpoints()))
+            self.metrics.nfc_poll_interval.labels(lock_name=self.params.lock_name).set_function(
+                lambda: service.scheduler.poll_interval)
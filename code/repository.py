@@ -1,28 +1,98 @@
 import copy
-import hashlib
 import json
 import logging
-from threading import Lock
-from typing import List, Optional
+import time
+from contextlib import contextmanager
+from threading import Lock, Timer
+from typing import Dict, List, Optional, Tuple
 
+from cryptogram import EndpointKeyIndex
 from entity import Endpoint, Issuer
+from homekey import get_reader_group_identifier
+from util.journal import Journal, write_file_atomically
 
 log = logging.getLogger()
 
 
 class Repository:
-    """Serves as a way of emulating a storage/database"""
+    """Serves as a way of emulating a storage/database
 
-    _issuers: List[Issuer]
+    Changes are appended to a journal next to the storage file, which is periodically
+    compacted into a new snapshot of the storage file, written atomically.
+    Updates that only touch endpoint usage counters are buffered and written
+    on a timer, on flush, or together with the next structural change
 
-    def __init__(self, storage_file_path):
+    Issuer state is copy-on-write: every mutation replaces the snapshot and its lookup indexes,
+    while objects that were handed out are never modified. Returned objects are shared snapshots
+    that are frozen and raise FrozenInstanceError on changes, copy them before making any
+    """
+
+    _issuers: Tuple[Issuer, ...]
+    _issuers_by_id: Dict[bytes, Issuer]
+    _issuers_by_public_key: Dict[bytes, Issuer]
+    _endpoints_by_id: Dict[bytes, Endpoint]
+    _endpoints_by_public_key: Dict[bytes, Endpoint]
+
+    def __init__(
+        self,
+        storage_file_path,
+        journal_compaction_threshold=64,
+        usage_flush_interval=30,
+    ):
         self.storage_file_path = storage_file_path
+        self.journal_compaction_threshold = journal_compaction_threshold
+        # Seconds to buffer endpoint usage updates for, 0 writes them right away
+        self.usage_flush_interval = usage_flush_interval
+        self._journal = Journal(f"{storage_file_path}.journal")
+        self._pending_usage_records = dict()
+        self._flush_timer = None
         self._reader_private_key = bytes.fromhex("00" * 32)
         self._reader_identifier = bytes.fromhex("00" * 8)
-        self._issuers = list()
+        self._endpoint_key_index = EndpointKeyIndex()
+        self._set_issuers(tuple())
         self._transaction_lock = Lock()
         self._state_lock = Lock()
         self._load_state_from_file()
+        self._replay_journal()
+
+    def on_saved(self, operation: str, duration: float):
+        """This method will be called after every write with its kind, journal or snapshot"""
+        # Currently overwritten by accessory.py
+
+    def _set_issuers(self, issuers: Tuple[Issuer, ...]):
+        """Replaces issuer snapshot and rebuilds lookup indexes for it"""
+        issuers_by_id = dict()
+        issuers_by_public_key = dict()
+        endpoints_by_id = dict()
+        endpoints_by_public_key = dict()
+        for issuer in issuers:
+            issuer.freeze()
+            issuers_by_id[issuer.id] = issuer
+            issuers_by_public_key[issuer.public_key] = issuer
+            for endpoint in issuer.endpoints:
+                endpoints_by_id[endpoint.id] = endpoint
+                endpoints_by_public_key[endpoint.public_key] = endpoint
+        # Swap whole containers so that readers on other threads see a consistent state
+        self._issuers = issuers
+        self._issuers_by_id = issuers_by_id
+        self._issuers_by_public_key = issuers_by_public_key
+        self._endpoints_by_id = endpoints_by_id
+        self._endpoints_by_public_key = endpoints_by_public_key
+        self._endpoint_key_index.update(issuers)
+
+    def _snapshot_endpoint(self, endpoint: Endpoint) -> Endpoint:
+        # Endpoints that are already part of the snapshot can be shared as is
+        if self._endpoints_by_id.get(endpoint.id) is endpoint:
+            return endpoint
+        return copy.deepcopy(endpoint)
+
+    def _snapshot_issuer(self, issuer: Issuer) -> Issuer:
+        if self._issuers_by_id.get(issuer.id) is issuer:
+            return issuer
+        return Issuer(
+            public_key=issuer.public_key,
+            endpoints=tuple(self._snapshot_endpoint(e) for e in issuer.endpoints),
+        )
 
     def _load_state_from_file(self):
         try:
@@ -34,19 +104,58 @@ class Repository:
                 self._reader_identifier = bytes.fromhex(
                     configuration.get("reader_identifier", "00" * 8)
                 )
-                self._issuers = [
+                issuers = (
                     Issuer.from_dict(issuer)
                     for _, issuer in configuration.get("issuers", {}).items()
-                ]
+                )
+                self._set_issuers(
+                    tuple(
+                        Issuer(public_key=i.public_key, endpoints=tuple(i.endpoints))
+                        for i in issuers
+                    )
+                )
         except Exception:
             log.exception(
                 f"Could not load Home Key configuration. Assuming that device is not yet configured..."
             )
             pass
 
+    def _replay_journal(self):
+        records = self._journal.read()
+        for record in records:
+            try:
+                self._apply_record(record)
+            except Exception:
+                log.exception(f"Could not replay journal record {record.get('op')}")
+        if len(records):
+            log.info(f"Replayed {len(records)} journal records")
+        # Compacting also drops unreadable lines, so that later records are not appended to them
+        if len(records) or self._journal.unreadable:
+            self._compact()
+
+    def _apply_record(self, record: dict):
+        op = record["op"]
+        if op == "set_reader":
+            if "reader_private_key" in record:
+                self._reader_private_key = bytes.fromhex(record["reader_private_key"])
+            if "reader_identifier" in record:
+                self._reader_identifier = bytes.fromhex(record["reader_identifier"])
+        elif op == "remove_issuer":
+            self._remove_issuer(bytes.fromhex(record["issuer_id"]))
+        elif op == "upsert_issuer":
+            self._upsert_issuers([Issuer.from_dict(record["issuer"])])
+        elif op == "upsert_endpoint":
+            self._upsert_endpoint(
+                bytes.fromhex(record["issuer_id"]),
+                Endpoint.from_dict(record["endpoint"]),
+            )
+        else:
+            raise ValueError(f"Unknown journal operation {op}")
+
     def _save_state_to_file(self):
-        with self._state_lock:
-            json.dump(
+        write_file_atomically(
+            self.storage_file_path,
+            json.dumps(
                 {
                     "reader_private_key": self._reader_private_key.hex(),
                     "reader_identifier": self._reader_identifier.hex(),
@@ -54,111 +163,211 @@ class Repository:
                         issuer.id.hex(): issuer.to_dict() for issuer in self._issuers
                     },
                 },
-                open(self.storage_file_path, "w"),
                 indent=2,
-            )
+            ),
+        )
 
-    def _refresh_state(self):
-        self._save_state_to_file()
-        self._load_state_from_file()
+    def _compact(self):
+        """Folds journal into a new snapshot"""
+        with self._state_lock:
+            started = time.perf_counter()
+            self._save_state_to_file()
+            # Records are idempotent, so a crash before truncation only causes them to be replayed again
+            self._journal.truncate()
+            self.on_saved("snapshot", time.perf_counter() - started)
+
+    @contextmanager
+    def _transaction(self):
+        """Serializes changes, restoring in-memory state if they could not be persisted"""
+        with self._transaction_lock:
+            issuers = self._issuers
+            reader_private_key = self._reader_private_key
+            reader_identifier = self._reader_identifier
+            try:
+                yield
+            except Exception:
+                self._reader_private_key = reader_private_key
+                self._reader_identifier = reader_identifier
+                self._set_issuers(issuers)
+                raise
+
+    def _persist(self, records: List[dict]):
+        """Persists changes that are already applied to in-memory state,
+        preceded by any buffered usage records"""
+        records = [*self._pending_usage_records.values(), *records]
+        with self._state_lock:
+            started = time.perf_counter()
+            self._journal.append(records)
+            self.on_saved("journal", time.perf_counter() - started)
+        # Buffered records are kept if writing failed, so they go out with the next write
+        self._pending_usage_records = dict()
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if self._journal.length >= self.journal_compaction_threshold:
+            try:
+                self._compact()
+            except Exception:
+                # Changes are already durable in the journal, compaction is retried on next write
+                log.exception("Could not compact journal")
+
+    def _buffer_usage_records(self, records: List[dict]):
+        for record in records:
+            # Only the latest usage of an endpoint has to be written
+            self._pending_usage_records[record["endpoint"]["public_key"]] = record
+        if self._flush_timer is None or not self._flush_timer.is_alive():
+            self._flush_timer = Timer(self.usage_flush_interval, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    @staticmethod
+    def _is_usage_record(record: dict, previous_endpoints: Dict[bytes, Endpoint]):
+        """Usage records only change counter and last use time of an existing endpoint"""
+        if record["op"] != "upsert_endpoint":
+            return False
+        endpoint = record["endpoint"]
+        previous = previous_endpoints.get(bytes.fromhex(endpoint["public_key"]))
+        if previous is None:
+            return False
+        return endpoint == {
+            **previous.to_dict(),
+            "counter": endpoint["counter"],
+            "last_used_at": endpoint["last_used_at"],
+        }
+
+    def flush(self):
+        """Writes buffered usage records to the journal"""
+        with self._transaction_lock:
+            if len(self._pending_usage_records):
+                self._persist([])
 
     def get_reader_private_key(self):
         return self._reader_private_key
 
     def set_reader_private_key(self, reader_private_key):
-        with self._transaction_lock:
+        with self._transaction():
             self._reader_private_key = reader_private_key
-            self._refresh_state()
+            self._persist(
+                [{"op": "set_reader", "reader_private_key": reader_private_key.hex()}]
+            )
 
     def get_reader_identifier(self):
         return self._reader_identifier
 
     def set_reader_identifier(self, reader_identifier):
-        with self._transaction_lock:
+        with self._transaction():
             self._reader_identifier = reader_identifier
-            self._refresh_state()
+            self._persist(
+                [{"op": "set_reader", "reader_identifier": reader_identifier.hex()}]
+            )
 
     def get_reader_group_identifier(self):
-        return (
-            hashlib.sha256("key-identifier".encode() + self.get_reader_private_key())
-        ).digest()[:8]
+        return get_reader_group_identifier(self.get_reader_private_key())
 
-    def get_all_issuers(self):
-        return copy.deepcopy([i for i in self._issuers])
+    def get_endpoint_key_index(self) -> EndpointKeyIndex:
+        return self._endpoint_key_index
 
-    def get_all_endpoints(self):
-        return copy.deepcopy(
-            [endpoint for issuer in self._issuers for endpoint in issuer.endpoints]
-        )
+    def get_all_issuers(self) -> List[Issuer]:
+        return list(self._issuers)
+
+    def get_all_endpoints(self) -> List[Endpoint]:
+        return list(self._endpoints_by_id.values())
 
     def get_endpoint_by_public_key(self, public_key: bytes) -> Optional[Endpoint]:
-        return next(
-            (
-                endpoint
-                for endpoint in self.get_all_endpoints()
-                if endpoint.public_key == public_key
-            ),
-            None,
-        )
+        return self._endpoints_by_public_key.get(public_key)
 
     def get_endpoint_by_id(self, id) -> Optional[Endpoint]:
-        return next(
-            (endpoint for endpoint in self.get_all_endpoints() if endpoint.id == id),
-            None,
-        )
+        return self._endpoints_by_id.get(id)
 
     def get_issuer_by_public_key(self, public_key) -> Optional[Issuer]:
-        return next(
-            (
-                issuer
-                for issuer in self.get_all_issuers()
-                if issuer.public_key == public_key
-            ),
-            None,
-        )
+        return self._issuers_by_public_key.get(public_key)
 
     def get_issuer_by_id(self, id) -> Optional[Issuer]:
-        return next(
-            (issuer for issuer in self.get_all_issuers() if issuer.id == id), None
+        return self._issuers_by_id.get(id)
+
+    def _remove_issuer(self, issuer_id: bytes):
+        self._set_issuers(tuple(i for i in self._issuers if i.id != issuer_id))
+
+    def _upsert_endpoint(self, issuer_id: bytes, endpoint: Endpoint):
+        issuer = self._issuers_by_id.get(issuer_id)
+        if issuer is None:
+            raise ValueError(f"Issuer {issuer_id.hex()} does not exist")
+        endpoint = self._snapshot_endpoint(endpoint)
+        endpoints = tuple(
+            (e if e.id != endpoint.id else endpoint) for e in issuer.endpoints
+        )
+        if endpoint.id not in (e.id for e in issuer.endpoints):
+            endpoints += (endpoint,)
+        issuer = Issuer(public_key=issuer.public_key, endpoints=endpoints)
+        self._set_issuers(
+            tuple((i if i.id != issuer_id else issuer) for i in self._issuers)
         )
 
+    def _upsert_issuers(self, issuers: List[Issuer]) -> List[dict]:
+        """Returns journal records describing the changes that were applied"""
+        records = []
+        issuers = {issuer.id: self._snapshot_issuer(issuer) for issuer in issuers}
+        for issuer in issuers.values():
+            records.extend(
+                self._get_issuer_change_records(
+                    self._issuers_by_id.get(issuer.id), issuer
+                )
+            )
+        iss = tuple(issuers.pop(i.id, i) for i in self._issuers)
+        self._set_issuers(iss + tuple(issuers.values()))
+        return records
+
+    @staticmethod
+    def _get_issuer_change_records(old: Optional[Issuer], new: Issuer) -> List[dict]:
+        if old is new:
+            return []
+        issuer_record = {"op": "upsert_issuer", "issuer": new.to_dict()}
+        if old is None:
+            return [issuer_record]
+        new_endpoint_ids = set(e.id for e in new.endpoints)
+        if any(e.id not in new_endpoint_ids for e in old.endpoints):
+            return [issuer_record]
+        # Usually only a few endpoints change, e.g. counters after a tap, so only those are recorded
+        old_endpoints = {e.id: e for e in old.endpoints}
+        return [
+            {
+                "op": "upsert_endpoint",
+                "issuer_id": new.id.hex(),
+                "endpoint": endpoint.to_dict(),
+            }
+            for endpoint in new.endpoints
+            if old_endpoints.get(endpoint.id) != endpoint
+        ]
+
     def remove_issuer(self, issuer: Issuer):
-        with self._transaction_lock:
-            issuers = [i for i in copy.deepcopy(self._issuers) if i.id != issuer.id]
-            self._issuers = issuers
-            self._refresh_state()
+        with self._transaction():
+            self._remove_issuer(issuer.id)
+            self._persist([{"op": "remove_issuer", "issuer_id": issuer.id.hex()}])
 
     def upsert_issuer(self, issuer: Issuer):
-        with self._transaction_lock:
-            issuer = copy.deepcopy(issuer)
-            issuers = [
-                (i if i.id != issuer.id else issuer)
-                for i in copy.deepcopy(self._issuers)
-            ]
-            if issuer not in issuers:
-                issuers.append(issuer)
-            self._issuers = issuers
-            self._refresh_state()
+        self.upsert_issuers([issuer])
 
     def upsert_endpoint(self, issuer_id, endpoint: Endpoint):
-        with self._transaction_lock:
-            issuer = next(
-                (issuer for issuer in self._issuers if issuer.id == issuer_id), None
+        with self._transaction():
+            self._upsert_endpoint(issuer_id, endpoint)
+            self._persist(
+                [
+                    {
+                        "op": "upsert_endpoint",
+                        "issuer_id": issuer_id.hex(),
+                        "endpoint": endpoint.to_dict(),
+                    }
+                ]
             )
-            endpoints = [
-                (e if e.id != endpoint.id else endpoint) for e in issuer.endpoints
-            ]
-            if endpoint not in endpoints:
-                endpoints.append(endpoint)
-            issuer.endpoints = endpoints
-            self._refresh_state()
 
     def upsert_issuers(self, issuers: List[Issuer]):
-        issuers = {issuer.id: copy.deepcopy(issuer) for issuer in issuers}
-        with self._transaction_lock:
-            iss = [issuers.get(i.id, i) for i in copy.deepcopy(self._issuers)]
-            for issuer in issuers.values():
-                if issuer not in iss:
-                    iss.append(issuer)
-            self._issuers = iss
-            self._refresh_state()
+        with self._transaction():
+            # Indexes are swapped on change, so this keeps referring to the previous state
+            previous_endpoints = self._endpoints_by_public_key
+            records = self._upsert_issuers(issuers)
+            if self.usage_flush_interval and all(
+                self._is_usage_record(record, previous_endpoints) for record in records
+            ):
+                self._buffer_usage_records(records)
+            else:
+                self._persist(records)
@@ -1,11 +1,14 @@
 import base64
+import dataclasses
 import logging
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from operator import attrgetter
 from nfc.tag.tt4 import Type4TagCommandError
 from nfc import clf
 
+from cryptogram import create_cryptogram_matcher
 from entity import (
     Issuer,
     Operation,
@@ -23,8 +26,11 @@ from entity import (
     ControlPointRequest,
     ControlPointResponse,
 )
-from homekey import read_homekey, ProtocolError
+from homekey import read_homekey, ProtocolError, ReaderIdentity
+from keypool import EphemeralKeyPool
+from polling import PollingScheduler
 from repository import Repository
+from tracing import Trace, span, trace
 from util.bfclf import (
     BroadcastFrameContactlessFrontend,
     RemoteTarget,
@@ -48,10 +54,16 @@ class Service:
         express: bool = True,
         finish: str = "silver",
         flow: str = "fast",
+        match_workers: int = 0,
+        key_pool_size: int = 4,
+        speculative_standard: bool = False,
+        poll_idle_interval: float = 0.0,
+        poll_active_period: float = 30.0,
+        cooldowns=2.0,
     ) -> None:
         self.repository = repository
         self.clf = clf
-        self.express = express in (True, "True", "true", "1")
+        self.express = express
 
         try:
             self.hardware_finish_color = HardwareFinishColor[finish.upper()]
@@ -68,14 +80,93 @@ class Service:
                 f"Digital Key flow {flow} is not supported. Falling back to {self.flow}"
             )
 
+        self.matcher = create_cryptogram_matcher(match_workers)
+        self._reader = None
+        self._broadcast_frame = None
+        self.key_pool = EphemeralKeyPool(key_pool_size) if key_pool_size else None
+        # Prepares STANDARD flow while FAST cryptogram is being matched.
+        # On a FAST hit preparation is abandoned, but an AUTH1 signature that already started
+        # still completes in the background
+        self.speculative_executor = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="speculative")
+            if speculative_standard in (True, "True", "true", "1")
+            else None
+        )
+
+        self.scheduler = PollingScheduler(
+            idle_interval=poll_idle_interval,
+            active_period=poll_active_period,
+            cooldowns=cooldowns,
+        )
+
         self._run_flag = True
         self._runner = None
 
+    @property
+    def express(self) -> bool:
+        return self._express
+
+    @express.setter
+    def express(self, express):
+        self._express = express in (True, "True", "true", "1")
+        self._broadcast_frame = None
+
+    @property
+    def broadcast_frame(self) -> bytes:
+        """ECP frame broadcast while polling, rebuilt only when reader key or express setting changes.
+        CRC for it is memoised by the frontend, keyed by the frame"""
+        frame = self._broadcast_frame
+        if frame is None:
+            frame = self._broadcast_frame = ECP.home(
+                identifier=self.reader.group_identifier,
+                flag_2=self.express,
+            ).pack()
+        return frame
+
+    def _invalidate_reader(self):
+        self._reader = None
+        self._broadcast_frame = None
+
+    @property
+    def reader(self) -> ReaderIdentity:
+        """Reader key material, derived once per reader key change"""
+        reader = self._reader
+        if reader is None:
+            reader = self._reader = ReaderIdentity.from_unique_identifier(
+                self.repository.get_reader_private_key(),
+                self.repository.get_reader_identifier(),
+            )
+        return reader
+
     def on_endpoint_authenticated(self, endpoint):
         """This method will be called when an endpoint is authenticated"""
         # Currently overwritten by accessory.py
 
+    def on_transaction_traced(self, transaction: Trace):
+        """This method will be called with phase timings of every transaction"""
+        # Currently overwritten by accessory.py
+
+    def on_nfc_polled(self, duration: float):
+        """This method will be called after every poll with the time RF field was on"""
+        # Currently overwritten by accessory.py
+
+    def on_protocol_error(self, error: Exception):
+        """This method will be called when a transaction fails with an error"""
+        # Currently overwritten by accessory.py
+
+    def on_reader_connected(self):
+        """This method will be called every time the NFC reader is (re)connected"""
+        # Currently overwritten by accessory.py
+
+    def mark_activity(self):
+        """Makes the reader poll tightly for a while, e.g. after lock state was changed remotely"""
+        self.scheduler.mark_activity()
+
     def start(self):
+        self._run_flag = True
+        self.scheduler.start()
+        if self.key_pool is not None:
+            self.key_pool.start()
         self._runner = create_runner(
             name="homekey",
             target=self.run,
@@ -87,8 +178,15 @@ class Service:
 
     def stop(self):
         self._run_flag = False
+        self.scheduler.stop()
         if self._runner is not None:
             self._runner.join()
+        if self.key_pool is not None:
+            self.key_pool.stop()
+        self.matcher.close()
+        if self.speculative_executor is not None:
+            self.speculative_executor.shutdown(wait=False, cancel_futures=True)
+        self.repository.flush()
 
     def update_hap_pairings(self, issuer_public_keys):
         issuers = {
@@ -108,66 +206,94 @@ class Service:
             self.repository.upsert_issuer(issuer)
 
     def _read_homekey(self):
-        start = time.monotonic()
-
-        remote_target = self.clf.sense(
-            RemoteTarget("106A"),
-            broadcast=ECP.home(
-                identifier=self.repository.get_reader_group_identifier(),
-                flag_2=self.express,
-            ).pack(),
-        )
-        if remote_target is None:
-            return
-
-        target = activate(self.clf, remote_target)
-        if target is None:
-            return
-
-        if not isinstance(target, ISODEPTag):
-            log.debug(
-                f"Found non-ISODEP Tag with UID: {target.identifier.hex().upper()}"
-            )
-            while self.clf.sense(RemoteTarget("106A")) is not None:
-                log.debug("Waiting for target to leave the field...")
-                time.sleep(0.5)
-            return
+        result_flow = None
+        with trace("homekey") as transaction:
+            # Transaction keys are generated in the background only while waiting for a device
+            if self.key_pool is not None:
+                self.key_pool.set_idle(True)
+            with span("sense"):
+                sense_started = time.perf_counter()
+                remote_target = self.clf.sense(
+                    RemoteTarget("106A"), broadcast=self.broadcast_frame
+                )
+                # Field is turned off when sense returns
+                self.on_nfc_polled(time.perf_counter() - sense_started)
+            if remote_target is None:
+                return
+            if self.key_pool is not None:
+                self.key_pool.set_idle(False)
+
+            with span("activate"):
+                target = activate(self.clf, remote_target)
+            if target is None:
+                return
+
+            if not isinstance(target, ISODEPTag):
+                log.debug(
+                    f"Found non-ISODEP Tag with UID: {target.identifier.hex().upper()}"
+                )
+                while self.clf.sense(RemoteTarget("106A")) is not None:
+                    log.debug("Waiting for target to leave the field...")
+                    if not self.scheduler.sleep(self.scheduler.presence_interval):
+                        break
+                return
 
-        log.debug(f"Got NFC tag {target}")
+            log.debug(f"Got NFC tag {target}")
 
-        tag = ISO7816Tag(target)
+            tag = ISO7816Tag(target)
+            try:
+                result_flow, new_issuers_state, endpoint = read_homekey(
+                    tag,
+                    issuers=self.repository.get_all_issuers(),
+                    preferred_versions=[b"\x02\x00"],
+                    flow=self.flow,
+                    transaction_code=DigitalKeyTransactionType.UNLOCK,
+                    reader=self.reader,
+                    key_size=16,
+                    endpoint_index=self.repository.get_endpoint_key_index(),
+                    matcher=self.matcher,
+                    key_pool=self.key_pool,
+                    speculative_executor=self.speculative_executor,
+                )
+                transaction.attributes["flow"] = (
+                    result_flow.name if endpoint is not None else "FAILED"
+                )
+                if endpoint is None:
+                    result_flow = None
+
+                log.debug(f"Authenticated endpoint via {result_flow!r}: {endpoint}")
+
+                try:
+                    if endpoint is not None:
+                        self.scheduler.mark_activity()
+                        with span("lock_callback"):
+                            self.on_endpoint_authenticated(endpoint)
+                finally:
+                    # Saved after unlocking, usage counter updates are buffered by the repository
+                    if new_issuers_state is not None and len(new_issuers_state):
+                        with span("repository_write"):
+                            self.repository.upsert_issuers(new_issuers_state)
+            except ProtocolError as e:
+                transaction.attributes["flow"] = "FAILED"
+                log.info(f'Could not authenticate device due to protocol error "{e}"')
+                self.on_protocol_error(e)
+
+        log.debug(f"{transaction}")
         try:
-            result_flow, new_issuers_state, endpoint = read_homekey(
-                tag,
-                issuers=self.repository.get_all_issuers(),
-                preferred_versions=[b"\x02\x00"],
-                flow=self.flow,
-                transaction_code=DigitalKeyTransactionType.UNLOCK,
-                reader_identifier=self.repository.get_reader_group_identifier()
-                + self.repository.get_reader_identifier(),
-                reader_private_key=self.repository.get_reader_private_key(),
-                key_size=16,
-            )
-
-            if new_issuers_state is not None and len(new_issuers_state):
-                self.repository.upsert_issuers(new_issuers_state)
-
-            log.debug(f"Authenticated endpoint via {result_flow!r}: {endpoint}")
-
-            end = time.monotonic()
-            log.debug(f"Transaction took {(end - start) * 1000} ms")
-
-            if endpoint is not None:
-                self.on_endpoint_authenticated(endpoint)
-        except ProtocolError as e:
-            log.info(f'Could not authenticate device due to protocol error "{e}"')
+            self.on_transaction_traced(transaction)
+        except Exception:
+            log.exception("Could not export transaction trace")
 
         # Let device cool down, wait for ISODEP to drop to consider comms finished
         while target.is_present:
             log.info("Waiting for device to leave the field...")
-            time.sleep(0.5)
-        log.info("Device left the field. Continuing in 2 seconds...")
-        time.sleep(2)
+            if not self.scheduler.sleep(self.scheduler.presence_interval):
+                return
+        cooldown = self.scheduler.get_cooldown(
+            result_flow.name if result_flow is not None else None
+        )
+        log.info(f"Device left the field. Continuing in {cooldown} seconds...")
+        self.scheduler.sleep(cooldown)
         log.info("Waiting for next device...")
 
     def run(self):
@@ -182,22 +308,29 @@ class Service:
             raise Exception(
                 f"Could not connect to NFC device {self.clf} at {self.clf.path}"
             )
+        self.on_reader_connected()
 
         while self._run_flag:
+            if not self.scheduler.wait_for_next_poll():
+                break
             try:
                 self._read_homekey()
-            except TimeoutError:
+            except TimeoutError as e:
                 log.warning("Recieved Timeout error")
-            except clf.TimeoutError:
+                self.on_protocol_error(e)
+            except clf.TimeoutError as e:
                 log.warning("Recieved Timeout error")
-            except Type4TagCommandError:
+                self.on_protocol_error(e)
+            except Type4TagCommandError as e:
                 log.warning("Recieved Type4TagCommandError")
-            except clf.TransmissionError:
+                self.on_protocol_error(e)
+            except clf.TransmissionError as e:
                 log.warning("Recieved TransmissionError")
+                self.on_protocol_error(e)
 
     def get_reader_key(self, request: ReaderKeyRequest) -> ReaderKeyResponse:
         response = ReaderKeyResponse(
-            key_identifier=self.repository.get_reader_group_identifier(),
+            key_identifier=self.reader.group_identifier,
         )
         return response
 
@@ -209,18 +342,21 @@ class Service:
         if self.repository.get_reader_identifier() != request.unique_reader_identifier:
             changed = True
             self.repository.set_reader_identifier(request.unique_reader_identifier)
+        if changed:
+            self._invalidate_reader()
         response = ReaderKeyResponse(
             status=OperationStatus.SUCCESS if changed else OperationStatus.DUPLICATE
         )
         return response
 
     def remove_reader_key(self, request: ReaderKeyRequest) -> ReaderKeyResponse:
-        if request.key_identifier == self.repository.get_reader_group_identifier():
+        # Compared before removal, as group identifier changes together with the key
+        exists = request.key_identifier == self.reader.group_identifier
+        if exists:
             self.repository.set_reader_private_key(bytes.fromhex("00" * 32))
+            self._invalidate_reader()
         response = ReaderKeyResponse(
-            status=OperationStatus.SUCCESS
-            if request.key_identifier == self.repository.get_reader_group_identifier()
-            else OperationStatus.DOES_NOT_EXIST
+            status=OperationStatus.SUCCESS if exists else OperationStatus.DOES_NOT_EXIST
         )
         return response
 
@@ -240,13 +376,20 @@ class Service:
         if endpoint is not None:
             if endpoint.enrollments.hap is None:
                 issuer = self.repository.get_issuer_by_id(request.issuer_key_identifier)
-                endpoint.enrollments.hap = Enrollment(
-                    at=int(time.time()),
-                    payload=base64.b64encode(request.pack()).decode(),
+                # Repository returns shared snapshots, so endpoint is copied before changing it
+                endpoint = dataclasses.replace(
+                    endpoint,
+                    enrollments=dataclasses.replace(
+                        endpoint.enrollments,
+                        hap=Enrollment(
+                            at=int(time.time()),
+                            payload=base64.b64encode(request.pack()).decode(),
+                        ),
+                    ),
                 )
                 self.repository.upsert_endpoint(issuer.id, endpoint)
             return DeviceCredentialResponse(
-                key_identifier=self.repository.get_reader_group_identifier(),
+                key_identifier=self.reader.group_identifier,
                 status=OperationStatus.DUPLICATE,
             )
 
@@ -255,7 +398,7 @@ class Service:
 
         if issuer is None:
             return DeviceCredentialResponse(
-                key_identifier=self.repository.get_reader_group_identifier(),
+                key_identifier=self.reader.group_identifier,
                 status=OperationStatus.DOES_NOT_EXIST,
             )
 
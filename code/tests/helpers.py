@@ -0,0 +1,19 @@
+import os
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from entity import Endpoint, Enrollments, KeyType
+from util.crypto import get_ec_key_public_points
+
+
+def generate_endpoint(last_used_at=0):
+    public_key = ec.generate_private_key(ec.SECP256R1()).public_key()
+    x, y = get_ec_key_public_points(public_key)
+    return Endpoint(
+        last_used_at=last_used_at,
+        counter=0,
+        key_type=KeyType.SECP256R1,
+        public_key=bytes([0x04, *x, *y]),
+        persistent_key=os.urandom(32),
+        enrollments=Enrollments(hap=None, attestation=None),
+    )
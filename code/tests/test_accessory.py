@@ -0,0 +1,168 @@
+import os
+import threading
+
+import pytest
+from prometheus_client import REGISTRY
+from pyhap.loader import get_loader
+
+from accessory import Lock
+from entity import Endpoint, Enrollments, KeyType
+from prometheus import AppMetrics
+from repository import Repository
+from service import Service
+
+
+class FakeDriver:
+    def __init__(self):
+        self.loader = get_loader()
+        self.published = []
+
+    def publish(self, data, *args, **kwargs):
+        self.published.append(data)
+
+
+class FakeMqtt:
+    def __init__(self):
+        self.states = []
+        self.authed = []
+
+    def update_state(self, target_locked, current_locked):
+        self.states.append((target_locked, current_locked))
+
+    def device_passed_auth(self, key_id):
+        self.authed.append(key_id)
+
+
+class FakeTimer:
+    """Stands in for threading.Timer, fires only when told to"""
+
+    def __init__(self, interval, function):
+        self.interval = interval
+        self.function = function
+        self.daemon = False
+        self.started = False
+        self.cancelled = False
+
+    def start(self):
+        self.started = True
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        if not self.cancelled:
+            self.function()
+
+
+def create_endpoint():
+    return Endpoint(
+        last_used_at=0,
+        counter=0,
+        key_type=KeyType.SECP256R1,
+        public_key=os.urandom(65),
+        persistent_key=os.urandom(32),
+        enrollments=Enrollments(hap=None, attestation=None),
+    )
+
+
+class TestLock:
+    @pytest.fixture()
+    def timers(self):
+        return []
+
+    @pytest.fixture()
+    def lock(self, tmp_path, timers):
+        def create_timer(interval, function):
+            timers.append(FakeTimer(interval, function))
+            return timers[-1]
+
+        repository = Repository(str(tmp_path / "homekey.json"))
+        service = Service(clf=None, repository=repository, key_pool_size=0)
+        lock = Lock(
+            FakeDriver(),
+            "Lock",
+            should_relock=True,
+            relock_delay=0.2,
+            mqtt=FakeMqtt(),
+            metrics=AppMetrics.from_dict({"lock_name": "test_accessory"}),
+            service=service,
+            timer_factory=create_timer,
+        )
+        lock.set_lock_target_state(1)
+        yield lock
+        lock._cancel_relock()
+        service.stop()
+
+    def test_tap_returns_before_relock(self, lock, timers):
+        lock.on_endpoint_authenticated(create_endpoint())
+        assert lock.get_lock_current_state() == 0
+        assert len(timers) == 1
+        assert timers[0].started and timers[0].daemon
+        assert timers[0].interval == 0.2
+        timers[0].fire()
+        assert lock.get_lock_current_state() == 1
+        assert lock.lock_target_state.value == lock.lock_current_state.value == 1
+        assert lock.mqtt.states[-1] == (True, True)
+
+    def test_relock_runs_on_timer_thread(self, lock):
+        lock._timer_factory = threading.Timer
+        relocked = threading.Event()
+        lock.lock_state.subscribe(
+            lambda change: change.state.current_locked and relocked.set()
+        )
+        lock.on_endpoint_authenticated(create_endpoint())
+        assert lock.get_lock_current_state() == 0
+        assert relocked.wait(2)
+        assert lock.get_lock_current_state() == 1
+
+    def test_tap_during_pending_relock_keeps_lock_open(self, lock, timers):
+        lock.on_endpoint_authenticated(create_endpoint())
+        lock.on_endpoint_authenticated(create_endpoint())
+        assert len(lock.mqtt.authed) == 2
+        # First relock was cancelled, second one is still pending
+        assert [timer.cancelled for timer in timers] == [True, False]
+        timers[0].fire()
+        assert lock.get_lock_current_state() == 0
+        timers[1].fire()
+        assert lock.get_lock_current_state() == 1
+
+    def test_cancelled_relock_that_already_fired_does_nothing(self, lock, timers):
+        lock.on_endpoint_authenticated(create_endpoint())
+        lock.on_endpoint_authenticated(create_endpoint())
+        # Timer thread was already waiting for the state lock when it was cancelled
+        timers[0].function()
+        assert lock.get_lock_current_state() == 0
+
+    def test_command_cancels_pending_relock(self, lock, timers):
+        lock.on_endpoint_authenticated(create_endpoint())
+        lock.set_lock_target_state(0)
+        assert timers[0].cancelled
+        timers[0].fire()
+        assert lock.get_lock_current_state() == 0
+
+    def test_unlock_relock_cycle_message_count(self, lock, timers):
+        lock.mqtt.states.clear()
+        lock.driver.published.clear()
+        endpoint = create_endpoint()
+        labels = {"lock_name": "test_accessory", "key_id": endpoint.id.hex()}
+        lock.on_endpoint_authenticated(endpoint)
+        timers[0].fire()
+        # One consolidated change for unlock and one for relock
+        assert lock.mqtt.states == [(False, False), (True, True)]
+        assert lock.mqtt.authed == [endpoint.id.hex()]
+        # Target and current characteristic for each change
+        assert len(lock.driver.published) == 4
+        assert REGISTRY.get_sample_value("homekey_unlocks_total", labels) == 1
+
+    def test_repeated_command_is_not_published(self, lock):
+        lock.mqtt.states.clear()
+        lock.mqtt_update_callback(True)
+        assert lock.mqtt.states == []
+        lock.mqtt_update_callback(False)
+        assert lock.mqtt.states == [(False, False)]
+        assert lock.lock_target_state.value == lock.lock_current_state.value == 0
+
+    def test_relock_delay_can_be_changed(self, lock, timers):
+        lock.mqtt.on_relock_delay(0.05)
+        lock.on_endpoint_authenticated(create_endpoint())
+        assert timers[0].interval == 0.05
@@ -0,0 +1,88 @@
+import nfc.clf.pn53x
+
+from util.bfclf import BroadcastFrameContactlessFrontend, RemoteTarget
+
+
+class FakeChipset(nfc.clf.pn53x.Chipset):
+    def __init__(self, commands):
+        self.commands = commands
+
+    def rf_configuration(self, cfg_item, cfg_data):
+        self.commands.append(("rf_configuration", cfg_item, bytes(cfg_data)))
+
+    def write_register(self, *args):
+        self.commands.append(("write_register", *args))
+
+    def in_communicate_thru(self, data, timeout):
+        self.commands.append(("in_communicate_thru", bytes(data)))
+        raise nfc.clf.pn53x.Chipset.Error(0x01, "Time Out")
+
+
+class FakeDevice:
+    def __init__(self):
+        self.commands = []
+        self.chipset = FakeChipset(self.commands)
+        self.target = None
+
+    def mute(self):
+        self.commands.append(("mute",))
+
+    def sense_tta(self, target):
+        self.commands.append(("sense_tta",))
+        return self.target
+
+    def send_cmd_recv_rsp(self, target, data, timeout):
+        self.commands.append(("exchange",))
+        return b"\x90\x00"
+
+
+def create_frontend():
+    frontend = BroadcastFrameContactlessFrontend(broadcast_enabled=True)
+    frontend.device = FakeDevice()
+    return frontend
+
+
+def sense(frontend):
+    return frontend.sense(RemoteTarget("106A"), broadcast=b"\x6a\x02")
+
+
+class TestBroadcastFrameContactlessFrontend:
+    def test_idle_poll_skips_redundant_commands(self):
+        frontend = create_frontend()
+        sense(frontend)
+        commands = frontend.device.commands
+        assert [c[0] for c in commands] == [
+            "mute",
+            "sense_tta",
+            "rf_configuration",
+            "write_register",
+            "in_communicate_thru",
+            "mute",
+        ]
+        commands.clear()
+        sense(frontend)
+        assert [c[0] for c in commands] == [
+            "sense_tta",
+            "write_register",
+            "in_communicate_thru",
+            "mute",
+        ]
+        assert frontend.saved_frames == 2
+
+    def test_field_is_muted_after_exchange(self):
+        frontend = create_frontend()
+        frontend.device.target = RemoteTarget("106A", sens_res=b"\x04\x00")
+        assert sense(frontend) is not None
+        frontend.exchange(b"\x00", timeout=0.1)
+        frontend.device.target = None
+        frontend.device.commands.clear()
+        sense(frontend)
+        assert frontend.device.commands[0] == ("mute",)
+
+    def test_reopened_device_is_configured_again(self):
+        frontend = create_frontend()
+        sense(frontend)
+        frontend.device = FakeDevice()
+        sense(frontend)
+        assert frontend.device.commands[0] == ("mute",)
+        assert ("rf_configuration", 0x05, b"\xff\x01\x00") in frontend.device.commands
@@ -0,0 +1,82 @@
+import copy
+import hashlib
+import os
+
+import pytest
+
+from entity import Endpoint, Enrollment, Enrollments, Issuer
+from tests.helpers import generate_endpoint
+
+
+def create_issuer():
+    endpoint = generate_endpoint()
+    endpoint.enrollments = Enrollments(
+        hap=Enrollment(at=1, payload="hap"), attestation=None
+    )
+    return Issuer(public_key=os.urandom(32), endpoints=[endpoint, generate_endpoint()])
+
+
+class TestEntity:
+    def test_endpoint_id_is_derived_from_public_key(self):
+        endpoint = generate_endpoint()
+        assert endpoint.id == hashlib.sha1(endpoint.public_key).digest()[:6]
+
+    def test_issuer_id_is_derived_from_public_key(self):
+        issuer = create_issuer()
+        assert (
+            issuer.id
+            == hashlib.sha256(b"key-identifier" + issuer.public_key).digest()[:8]
+        )
+
+    def test_ids_follow_public_key_changes(self):
+        issuer = create_issuer()
+        endpoint = issuer.endpoints[0]
+        endpoint.public_key = os.urandom(65)
+        issuer.public_key = os.urandom(32)
+        assert endpoint.id == hashlib.sha1(endpoint.public_key).digest()[:6]
+        assert (
+            issuer.id
+            == hashlib.sha256(b"key-identifier" + issuer.public_key).digest()[:8]
+        )
+
+    def test_deepcopy_is_equal_and_independent(self):
+        issuer = create_issuer()
+        copied = copy.deepcopy(issuer)
+        assert copied == issuer
+        assert copied is not issuer
+        assert copied.id == issuer.id
+        for original, endpoint in zip(issuer.endpoints, copied.endpoints):
+            assert endpoint == original
+            assert endpoint is not original
+            assert endpoint.id == original.id
+            assert endpoint.enrollments is not original.enrollments
+        assert copied.endpoints[0].enrollments.hap is not (
+            issuer.endpoints[0].enrollments.hap
+        )
+        copied.endpoints[0].counter = 5
+        copied.endpoints[0].enrollments.hap = None
+        assert issuer.endpoints[0].counter == 0
+        assert issuer.endpoints[0].enrollments.hap == Enrollment(at=1, payload="hap")
+
+    def test_dict_round_trip_keeps_ids(self):
+        issuer = create_issuer()
+        restored = Issuer.from_dict(issuer.to_dict())
+        assert restored == issuer
+        assert restored.id == issuer.id
+        assert [e.id for e in restored.endpoints] == [e.id for e in issuer.endpoints]
+        endpoint = Endpoint.from_dict(issuer.endpoints[0].to_dict())
+        assert endpoint.id == issuer.endpoints[0].id
+
+    @pytest.mark.parametrize(
+        "entity",
+        [
+            generate_endpoint(),
+            Issuer(public_key=os.urandom(32), endpoints=[]),
+            Enrollments(hap=None, attestation=None),
+            Enrollment(at=0, payload=b""),
+        ],
+        ids=lambda entity: type(entity).__name__,
+    )
+    def test_unknown_attribute_is_rejected(self, entity):
+        with pytest.raises(AttributeError):
+            entity.unknown = 1
@@ -1,21 +1,131 @@
 import os
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import threading
+from types import SimpleNamespace
 
 import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+from cryptogram import EndpointKeyIndex, ParallelCryptogramMatcher
+from entity import Context, Interface, Issuer
+from util.crypto import get_ec_key_public_points
+from util.digital_key import DigitalKeyFlow
 from util.structable import pack
 from util.tlv import BERTLV as TLV
-from util.iso7816 import ISO7816Response, ISO7816Tag
-from homekey import read_homekey, ProtocolError
+from util.iso7816 import ISO7816Command, ISO7816Response, ISO7816Tag
+import keypool
+from keypool import EphemeralKey, EphemeralKeyPool, TransactionMaterial
+from homekey import (
+    READER_CONTEXT,
+    prepare_standard_auth,
+    read_homekey,
+    ProtocolError,
+    ReaderIdentity,
+)
+from tests.helpers import generate_endpoint
+
+
+def calculate_fast_cryptogram(
+    endpoint,
+    reader_private_key,
+    reader_identifier,
+    reader_ephemeral_private_key,
+    endpoint_ephemeral_public_key,
+    transaction_identifier,
+):
+    """Calculates the cryptogram the way a device does, one endpoint at a time"""
+    reader_public_key_x, _ = get_ec_key_public_points(
+        ec.derive_private_key(
+            int.from_bytes(reader_private_key, "big"), ec.SECP256R1()
+        ).public_key()
+    )
+    reader_ephemeral_public_key_x, _ = get_ec_key_public_points(
+        ec.derive_private_key(
+            int.from_bytes(reader_ephemeral_private_key, "big"), ec.SECP256R1()
+        ).public_key()
+    )
+    endpoint_ephemeral_public_key_x, _ = get_ec_key_public_points(
+        endpoint_ephemeral_public_key
+    )
+    info = pack(
+        (
+            reader_public_key_x,
+            Context.VOLATILE_FAST,
+            reader_identifier,
+            endpoint.public_key[1:33],
+            Interface.CONTACTLESS,
+            TLV(0x5C, value=[b"\x02\x00"]),
+            TLV(0x5C, value=b"\x02\x00"),
+            reader_ephemeral_public_key_x,
+            transaction_identifier,
+            bytes([0x01, 0x01]),
+            endpoint_ephemeral_public_key_x,
+        )
+    )
+    return HKDF(algorithm=hashes.SHA256(), length=64, salt=None, info=info).derive(
+        endpoint.persistent_key
+    )[:16]
 
 
 class FakeTag:
     def __init__(self, generator):
         self.generator = generator
+        self.commands = []
 
-    def transceive(self, _):
+    def transceive(self, command):
+        self.commands.append(command)
         return pack(next(self.generator))
 
 
+def create_fast_transaction(reader_ephemeral_private_key, transaction_identifier):
+    """Returns a tag answering AUTH0 with a cryptogram of its first endpoint"""
+    issuers = [
+        Issuer(
+            public_key=os.urandom(32),
+            endpoints=[generate_endpoint(10), generate_endpoint(30)],
+        ),
+        Issuer(public_key=os.urandom(32), endpoints=[generate_endpoint(20)]),
+    ]
+    device_endpoint = issuers[0].endpoints[0]
+    params = {
+        "reader_private_key": os.urandom(32),
+        "reader_identifier": os.urandom(16),
+        "reader_ephemeral_private_key": reader_ephemeral_private_key,
+        "transaction_identifier": transaction_identifier,
+        "issuers": issuers,
+        "preferred_versions": [b"\x02\x00"],
+    }
+    endpoint_ephemeral_public_key = ec.generate_private_key(ec.SECP256R1()).public_key()
+    x, y = get_ec_key_public_points(endpoint_ephemeral_public_key)
+    cryptogram = calculate_fast_cryptogram(
+        device_endpoint,
+        params["reader_private_key"],
+        params["reader_identifier"],
+        params["reader_ephemeral_private_key"],
+        endpoint_ephemeral_public_key,
+        params["transaction_identifier"],
+    )
+
+    def generator():
+        yield ISO7816Response(
+            sw1=0x90, sw2=0x00, data=TLV(0x5C, value=bytes.fromhex("0200"))
+        )
+        yield ISO7816Response(
+            sw1=0x90,
+            sw2=0x00,
+            data=[
+                TLV(0x86, value=bytes([0x04, *x, *y])),
+                TLV(0x9D, value=cryptogram),
+            ],
+        )
+        yield ISO7816Response(sw1=0x90, sw2=0x00)
+
+    return ISO7816Tag(FakeTag(generator())), device_endpoint, params
+
+
 # Three basic test for now, should/will be expanded soon with FAST/STANDARD/ATTESTATION flows
 class TestHomekey:
     @pytest.fixture()
@@ -72,3 +182,252 @@ class TestHomekey:
             _ = read_homekey(
                 tag=endpoint_without_v2_support_on_select, **read_homekey_params
             )
+
+    @pytest.fixture()
+    def fast_transaction(self):
+        return create_fast_transaction(os.urandom(32), os.urandom(16))
+
+    def test_fast_auth_finds_matching_endpoint(self, fast_transaction):
+        tag, device_endpoint, params = fast_transaction
+        flow, issuers, endpoint = read_homekey(tag=tag, **params)
+        assert flow == DigitalKeyFlow.FAST
+        assert endpoint.id == device_endpoint.id
+        assert endpoint.counter == 1
+        assert endpoint in issuers[0].endpoints
+
+    def test_fast_auth_uses_provided_endpoint_index(self, fast_transaction):
+        tag, device_endpoint, params = fast_transaction
+        index = EndpointKeyIndex(params["issuers"])
+        flow, _, endpoint = read_homekey(tag=tag, endpoint_index=index, **params)
+        assert flow == DigitalKeyFlow.FAST
+        assert endpoint.id == device_endpoint.id
+
+    def test_endpoint_key_index_orders_by_most_recent_use(self, fast_transaction):
+        _, _, params = fast_transaction
+        index = EndpointKeyIndex(params["issuers"])
+        assert [entry.last_used_at for entry in index] == [30, 20, 10]
+
+    def test_fast_auth_with_reader_identity(self, fast_transaction):
+        tag, device_endpoint, params = fast_transaction
+        reader = ReaderIdentity(
+            params.pop("reader_private_key"),
+            identifier=params.pop("reader_identifier"),
+        )
+        flow, _, endpoint = read_homekey(tag=tag, reader=reader, **params)
+        assert flow == DigitalKeyFlow.FAST
+        assert endpoint.id == device_endpoint.id
+
+    def test_fast_hit_abandons_speculative_preparation(self, fast_transaction):
+        tag, device_endpoint, params = fast_transaction
+        submitted = []
+
+        class RecordingExecutor(ThreadPoolExecutor):
+            def submit(self, fn, *args, **kwargs):
+                submitted.append(kwargs)
+                return super().submit(fn, *args, **kwargs)
+
+        with RecordingExecutor(max_workers=1) as executor:
+            flow, _, endpoint = read_homekey(
+                tag=tag, speculative_executor=executor, **params
+            )
+        assert flow == DigitalKeyFlow.FAST
+        assert endpoint.id == device_endpoint.id
+        assert len(submitted) == 1
+        assert submitted[0]["cancelled"].is_set()
+
+    def test_standard_preparation_stops_once_cancelled(self):
+        reader_private_key = ec.generate_private_key(ec.SECP256R1())
+        cancelled = threading.Event()
+        signatures = []
+
+        class CancellingKey:
+            def sign(self, data, algorithm):
+                signatures.append(data)
+                # FAST cryptogram matched while signature was computed
+                cancelled.set()
+                return reader_private_key.sign(data, algorithm)
+
+        params = dict(
+            device_protocol_versions=[b"\x02\x00"],
+            protocol_version=b"\x02\x00",
+            interface=Interface.CONTACTLESS,
+            flags=b"\x01\x01",
+            reader_identifier=os.urandom(16),
+            reader_ephemeral_key=EphemeralKey.generate(),
+            transaction_identifier=os.urandom(16),
+            endpoint_ephemeral_public_key=ec.generate_private_key(
+                ec.SECP256R1()
+            ).public_key(),
+            cancelled=cancelled,
+        )
+        with pytest.raises(CancelledError):
+            prepare_standard_auth(reader_private_key=CancellingKey(), **params)
+        assert len(signatures) == 1
+        with pytest.raises(CancelledError):
+            prepare_standard_auth(reader_private_key=CancellingKey(), **params)
+        # Nothing is signed once cancelled beforehand
+        assert len(signatures) == 1
+        cancelled.clear()
+        preparation = prepare_standard_auth(
+            reader_private_key=reader_private_key, **params
+        )
+        assert len(preparation.kenc) == 16
+
+    @pytest.mark.parametrize("speculative", [False, True])
+    def test_standard_auth_follows_fast_miss(self, speculative):
+        reader_private_key = os.urandom(32)
+        reader_identifier = os.urandom(16)
+        reader_ephemeral_private_key = os.urandom(32)
+        transaction_identifier = os.urandom(16)
+        x, y = get_ec_key_public_points(
+            ec.generate_private_key(ec.SECP256R1()).public_key()
+        )
+
+        def generator():
+            yield ISO7816Response(
+                sw1=0x90, sw2=0x00, data=TLV(0x5C, value=bytes.fromhex("0200"))
+            )
+            yield ISO7816Response(
+                sw1=0x90,
+                sw2=0x00,
+                data=[
+                    TLV(0x86, value=bytes([0x04, *x, *y])),
+                    TLV(0x9D, value=os.urandom(16)),
+                ],
+            )
+            yield ISO7816Response(sw1=0x6A, sw2=0x80)
+
+        fake_tag = FakeTag(generator())
+        executor = ThreadPoolExecutor(max_workers=1) if speculative else None
+        try:
+            with pytest.raises(ProtocolError, match="AUTH1"):
+                read_homekey(
+                    tag=ISO7816Tag(fake_tag),
+                    reader_private_key=reader_private_key,
+                    reader_identifier=reader_identifier,
+                    reader_ephemeral_private_key=reader_ephemeral_private_key,
+                    transaction_identifier=transaction_identifier,
+                    issuers=[
+                        Issuer(
+                            public_key=os.urandom(32), endpoints=[generate_endpoint()]
+                        )
+                    ],
+                    speculative_executor=executor,
+                )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        reader_ephemeral_public_key_x, _ = get_ec_key_public_points(
+            ec.derive_private_key(
+                int.from_bytes(reader_ephemeral_private_key, "big"), ec.SECP256R1()
+            ).public_key()
+        )
+        auth1 = ISO7816Command.unpack(fake_tag.commands[-1])
+        signature = TLV.unpack(auth1.data).value
+        ec.derive_private_key(
+            int.from_bytes(reader_private_key, "big"), ec.SECP256R1()
+        ).public_key().verify(
+            encode_dss_signature(
+                int.from_bytes(signature[:32], "big"),
+                int.from_bytes(signature[32:], "big"),
+            ),
+            pack(
+                [
+                    TLV(0x4D, value=reader_identifier),
+                    TLV(0x86, value=x),
+                    TLV(0x87, value=reader_ephemeral_public_key_x),
+                    TLV(0x4C, value=transaction_identifier),
+                    TLV(0x93, value=READER_CONTEXT),
+                ]
+            ),
+            ec.ECDSA(hashes.SHA256()),
+        )
+
+    def test_fast_auth_with_parallel_matcher(self, fast_transaction):
+        tag, device_endpoint, params = fast_transaction
+        matcher = ParallelCryptogramMatcher(workers=2, min_candidates=2)
+        try:
+            flow, _, endpoint = read_homekey(tag=tag, matcher=matcher, **params)
+        finally:
+            matcher.close()
+        assert flow == DigitalKeyFlow.FAST
+        assert endpoint.id == device_endpoint.id
+
+
+def private_key_bytes(material: TransactionMaterial) -> bytes:
+    return material.ephemeral_key.private_key.private_numbers().private_value.to_bytes(
+        32, "big"
+    )
+
+
+class TestEphemeralKeyPool:
+    @pytest.fixture()
+    def generated(self, monkeypatch):
+        """Records material generated for a pool of size 2, full is set once it's filled"""
+        generated = SimpleNamespace(materials=[], full=threading.Event())
+        generate = TransactionMaterial.generate
+
+        def record():
+            material = generate()
+            generated.materials.append(material)
+            # Producer only generates the next item once the previous one was queued,
+            # so the third one is held back by a full pool
+            if len(generated.materials) > 2:
+                generated.full.set()
+            return material
+
+        monkeypatch.setattr(keypool.TransactionMaterial, "generate", record)
+        return generated
+
+    @pytest.fixture()
+    def pool(self, generated):
+        pool = EphemeralKeyPool(size=2)
+        pool.start()
+        pool.set_idle(True)
+        assert generated.full.wait(2)
+        pool.set_idle(False)
+        yield pool
+        pool.stop()
+
+    def test_material_is_handed_out_once(self, pool, generated):
+        assert len(pool) == 2
+        materials = [pool.get() for _ in range(3)]
+        assert materials[:2] == generated.materials[:2]
+        keys = set(m.ephemeral_key.public_key_bytes for m in materials)
+        assert len(keys) == 3
+        assert len(set(m.transaction_identifier for m in materials)) == 3
+
+    def test_fast_auth_with_pooled_material(self, pool, generated):
+        material = generated.materials[0]
+        tag, device_endpoint, params = create_fast_transaction(
+            private_key_bytes(material), material.transaction_identifier
+        )
+        del params["reader_ephemeral_private_key"]
+        del params["transaction_identifier"]
+        flow, _, endpoint = read_homekey(tag=tag, key_pool=pool, **params)
+        assert flow == DigitalKeyFlow.FAST
+        assert endpoint.id == device_endpoint.id
+        auth0 = tag._implementation.commands[-2]
+        assert material.ephemeral_key.public_key_bytes in auth0
+        assert material.transaction_identifier in auth0
+        # Material was consumed, next one in line is handed out
+        assert pool.get() == generated.materials[1]
+
+    def test_fast_auth_generates_material_when_pool_is_empty(self, monkeypatch):
+        # Pool is never started, so material has to be generated in place
+        pool = EphemeralKeyPool(size=2)
+        material = TransactionMaterial.generate()
+        monkeypatch.setattr(keypool.TransactionMaterial, "generate", lambda: material)
+        tag, device_endpoint, params = create_fast_transaction(
+            private_key_bytes(material), material.transaction_identifier
+        )
+        del params["reader_ephemeral_private_key"]
+        del params["transaction_identifier"]
+        flow, _, endpoint = read_homekey(tag=tag, key_pool=pool, **params)
+        assert flow == DigitalKeyFlow.FAST
+        assert endpoint.id == device_endpoint.id
+        auth0 = tag._implementation.commands[-2]
+        assert material.ephemeral_key.public_key_bytes in auth0
+        assert material.transaction_identifier in auth0
+        assert len(pool) == 0
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from util.iso7816 import ISO7816Command, ISO7816Instruction
+from util.structable import pack
+from util.tlv import BERTLV
+
+
+def concatenating_pack(command: ISO7816Command):
+    """Encoding as it was before data was packed only once, used as a reference"""
+    lc = len(pack(command.data))
+    le = (command.le,) if command.le is not None else ()
+    if 256 <= lc <= 65_535:
+        lc_data = pack((0x00, lc.to_bytes(2, "big"), command.data))
+    elif 0 < lc < 256:
+        lc_data = pack((lc, command.data))
+    else:
+        lc_data = ()
+    return bytes([command.cla, command.ins, command.p1, command.p2, *lc_data, *le])
+
+
+class TestISO7816Command:
+    @pytest.mark.parametrize("le", [None, 0x00])
+    @pytest.mark.parametrize(
+        "data",
+        [
+            b"",
+            bytes.fromhex("a0000008580101"),
+            os.urandom(255),
+            os.urandom(256),
+            os.urandom(1000),
+            [BERTLV(0x5C, value=b"\x02\x00"), BERTLV(0x87, value=os.urandom(65))],
+        ],
+        ids=["empty", "short", "short_max", "extended_min", "extended", "tlv"],
+    )
+    def test_matches_reference(self, data, le):
+        command = ISO7816Command(
+            cla=0x80, ins=ISO7816Instruction.SELECT_FILE, p1=0x04, data=data, le=le
+        )
+        assert command.pack() == concatenating_pack(command)
+
+    def test_empty_body(self):
+        command = ISO7816Command(cla=0x80, ins=0x3C, p1=0x01, p2=0x00)
+        assert command.pack() == bytes.fromhex("803c0100")
+
+    def test_short_body(self):
+        command = ISO7816Command(ins=0xA4, p1=0x04, data=b"\x01\x02", le=0x00)
+        assert command.pack() == bytes.fromhex("00a404000201" + "0200")
+
+    def test_extended_length_body(self):
+        data = os.urandom(300)
+        packed = ISO7816Command(cla=0x80, ins=0x80, data=data).pack()
+        assert packed[:7] == bytes.fromhex("80800000" + "00012c")
+        assert packed[7:] == data
+
+    def test_too_long_body_raises(self):
+        with pytest.raises(ValueError):
+            ISO7816Command(data=bytes(65_536)).pack()
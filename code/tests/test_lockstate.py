@@ -0,0 +1,25 @@
+from lockstate import LockState, LockStateMachine
+
+
+class TestLockStateMachine:
+    def test_subscribers_are_notified_once_per_change(self):
+        machine = LockStateMachine(LockState(True, True))
+        changes = []
+        machine.subscribe(changes.append)
+        machine.set_locked(False, key_id="01")
+        machine.set_locked(False)
+        machine.apply(target_locked=True)
+        assert [c.state for c in changes] == [
+            LockState(False, False),
+            LockState(True, False),
+        ]
+        assert changes[0].unlocked and changes[0].key_id == "01"
+        assert changes[1].target_changed and not changes[1].current_changed
+
+    def test_failing_subscriber_does_not_block_others(self):
+        machine = LockStateMachine()
+        changes = []
+        machine.subscribe(lambda change: 1 / 0)
+        machine.subscribe(changes.append)
+        assert machine.set_locked(True) is not None
+        assert len(changes) == 1
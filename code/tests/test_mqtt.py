@@ -0,0 +1,344 @@
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt_client
+import pytest
+
+import mqtt
+from mqtt import Mqtt, MqttDispatcher, MqttMessage, MqttOutbox, MqttPublisher
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+        self.gate = threading.Event()
+        self.gate.set()
+        # Set once a publish call is in progress
+        self.publishing = threading.Event()
+        self.connected = True
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.publishing.set()
+        self.gate.wait()
+        if not self.connected:
+            return SimpleNamespace(rc=mqtt_client.MQTT_ERR_NO_CONN)
+        self.published.append((topic, payload, retain))
+        return SimpleNamespace(rc=mqtt_client.MQTT_ERR_SUCCESS)
+
+
+class FakePahoClient(FakeClient):
+    def __init__(self, client_id):
+        super().__init__()
+        self.subscriptions = []
+
+    def username_pw_set(self, user, password):
+        pass
+
+    def will_set(self, topic, payload, qos, retain):
+        pass
+
+    def reconnect_delay_set(self, min_delay, max_delay):
+        self.reconnect_delay = (min_delay, max_delay)
+
+    def connect_async(self, host, port):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic):
+        self.subscriptions.append(topic)
+
+
+class FakePahoMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode()
+
+
+class TestMqttOutbox:
+    def test_retained_messages_are_coalesced(self):
+        outbox = MqttOutbox()
+        assert not outbox.put(MqttMessage("state", "unlocking", retain=True))
+        outbox.put(MqttMessage("key_id_authed", "01"))
+        assert outbox.put(MqttMessage("state", "unlocked", retain=True))
+        outbox.put(MqttMessage("key_id_authed", "01"))
+        assert len(outbox) == 3
+        messages = [outbox.get(0) for _ in range(3)]
+        assert [(m.topic, m.payload) for m in messages] == [
+            ("key_id_authed", "01"),
+            ("state", "unlocked"),
+            ("key_id_authed", "01"),
+        ]
+        assert outbox.get(0) is None
+
+    def test_get_returns_none_once_closed(self):
+        outbox = MqttOutbox()
+        outbox.put(MqttMessage("state", "locked", retain=True))
+        outbox.close()
+        assert outbox.get().payload == "locked"
+        assert outbox.get() is None
+
+    def test_oldest_event_is_dropped_when_full(self):
+        dropped = []
+        outbox = MqttOutbox(max_size=2, on_dropped=dropped.append)
+        outbox.put(MqttMessage("state", "locked", retain=True))
+        outbox.put(MqttMessage("key_id_authed", "01"))
+        outbox.put(MqttMessage("key_id_authed", "02"))
+        assert [m.payload for m in dropped] == ["01"]
+        assert [outbox.get(0).payload for _ in range(2)] == ["locked", "02"]
+
+    def test_retained_messages_are_never_dropped(self):
+        dropped = []
+        outbox = MqttOutbox(max_size=1, on_dropped=dropped.append)
+        outbox.put(MqttMessage("front/state", "locked", retain=True))
+        outbox.put(MqttMessage("back/state", "unlocked", retain=True))
+        outbox.put(MqttMessage("key_id_authed", "01"))
+        assert [m.payload for m in dropped] == ["01"]
+        assert [outbox.get(0).payload for _ in range(2)] == ["locked", "unlocked"]
+
+    def test_put_back_keeps_newer_retained_message(self):
+        outbox = MqttOutbox()
+        outbox.put(MqttMessage("key_id_authed", "01"))
+        outbox.put(MqttMessage("state", "locked", retain=True))
+        outbox.put_back(MqttMessage("state", "unlocked", retain=True))
+        outbox.put_back(MqttMessage("key_id_authed", "00"))
+        assert [outbox.get(0).payload for _ in range(3)] == ["00", "01", "locked"]
+
+
+class TestMqttDispatcher:
+    def test_exact_topic_takes_precedence_over_wildcard(self):
+        calls = []
+        dispatcher = MqttDispatcher()
+        dispatcher.add("a/+/c", lambda t, p: calls.append(("wildcard", t)))
+        dispatcher.add("a/b/c", lambda t, p: calls.append(("exact", t)))
+        dispatcher.add("d/#", lambda t, p: calls.append(("multi", t)))
+        assert dispatcher.dispatch("a/b/c", "")
+        assert dispatcher.dispatch("a/x/c", "")
+        assert dispatcher.dispatch("d/e/f", "")
+        assert not dispatcher.dispatch("a/b", "")
+        assert calls == [("exact", "a/b/c"), ("wildcard", "a/x/c"), ("multi", "d/e/f")]
+
+
+class TestMqttPublisher:
+    def test_publishes_latest_state_while_broker_is_slow(self):
+        client = FakeClient()
+        client.gate.clear()
+        publisher = MqttPublisher(client)
+        publisher.set_connected(True)
+        publisher.start()
+        publisher.publish("state", "unlocking", retain=True)
+        # Wait for the worker to be stuck on the first message
+        assert client.publishing.wait(2)
+        assert len(publisher.outbox) == 0
+        for state in ("unlocked", "locking", "locked"):
+            publisher.publish("state", state, retain=True)
+        client.gate.set()
+        publisher.stop()
+        assert client.published == [
+            ("state", "unlocking", True),
+            ("state", "locked", True),
+        ]
+        assert publisher.superseded == 2
+
+    def test_failed_publish_counts_as_dropped(self):
+        class FailingClient(FakeClient):
+            def publish(self, topic, payload, qos=0, retain=False):
+                if topic == "raises":
+                    raise ValueError("Invalid topic")
+                if topic == "rejected":
+                    return SimpleNamespace(rc=mqtt_client.MQTT_ERR_QUEUE_SIZE)
+                return super().publish(topic, payload, qos, retain)
+
+        client = FailingClient()
+        publisher = MqttPublisher(client)
+        dropped = []
+        publisher.on_message_dropped = dropped.append
+        publisher.set_connected(True)
+        publisher.start()
+        for topic in ("raises", "rejected", "state"):
+            publisher.publish(topic, "locked")
+        publisher.stop()
+        assert [message.topic for message in dropped] == ["raises", "rejected"]
+        assert publisher.dropped == 2
+        assert client.published == [("state", "locked", False)]
+
+
+class TestMqtt:
+    @pytest.fixture()
+    def connection(self, monkeypatch):
+        monkeypatch.setattr(mqtt.mqtt_client, "Client", FakePahoClient)
+        connection = Mqtt(
+            {"lock_id": "test", "prefix_topic": "lock", "hass_discovery_delay": 0.2}
+        )
+        connection.client.on_connect(connection.client, None, None, 0)
+        yield connection
+        connection.stop()
+
+    def test_commands_are_handled_during_home_assistant_restart_storm(self, connection):
+        commands = []
+        connection.lock().update_callback = commands.append
+        client = connection.client
+        latencies = []
+        for index in range(50):
+            started = time.perf_counter()
+            client.on_message(
+                client, None, FakePahoMessage("homeassistant/status", "online")
+            )
+            client.on_message(
+                client,
+                None,
+                FakePahoMessage(
+                    connection.config.mqtt_command_topic,
+                    "lock" if index % 2 else "unlock",
+                ),
+            )
+            latencies.append(time.perf_counter() - started)
+        assert len(commands) == 50
+        assert max(latencies) < 0.05
+
+        time.sleep(0.4)
+        connection.publisher.stop()
+        discovery = [
+            payload
+            for topic, payload, _ in client.published
+            if topic == connection.lock().hass_config_topic
+        ]
+        # Connect and the storm are merged into one publish
+        assert len(discovery) == 1
+        assert json.loads(discovery[0])["command_topic"] == "lock/test/command_topic"
+
+    def test_discovery_is_not_published_when_disabled(self, monkeypatch):
+        monkeypatch.setattr(mqtt.mqtt_client, "Client", FakePahoClient)
+        connection = Mqtt({"hass_enabled": False, "hass_discovery_delay": 0})
+        connection.client.on_connect(connection.client, None, None, 0)
+        connection.stop()
+        assert [p for _, p, _ in connection.client.published] == ["offline"]
+
+    def test_messages_are_buffered_while_offline(self, connection):
+        client = connection.client
+        reconnects = []
+        dropped = []
+        connection.lock().on_reconnected = lambda: reconnects.append(True)
+        connection.lock().on_message_dropped = lambda: dropped.append(True)
+        connection.publisher.outbox.max_size = 4
+        assert wait_until(lambda: not len(connection.publisher.outbox))
+        client.on_disconnect(client, None, 1)
+        client.connected = False
+        for index in range(4):
+            connection.lock().device_passed_auth(f"0{index}")
+            connection.lock().update_state(
+                target_locked=bool(index % 2), current_locked=False
+            )
+        assert len(dropped) == 1
+
+        client.connected = True
+        client.published.clear()
+        client.on_connect(client, None, None, 0)
+        connection.publisher.stop()
+        assert reconnects == [True]
+        # Queueing availability on reconnect pushed out the oldest key id, "01"
+        assert len(dropped) == 2
+        assert [p for t, p, _ in client.published if "hass" not in t] == [
+            "02",
+            "03",
+            "locking",
+            "online",
+        ]
+
+    def test_message_is_retried_after_failed_publish(self, connection):
+        client = connection.client
+        client.connected = False
+        connection.lock().device_passed_auth("01")
+        assert wait_until(lambda: not connection.publisher._connected.is_set())
+        client.connected = True
+        client.on_connect(client, None, None, 0)
+        connection.publisher.stop()
+        assert "01" in [p for _, p, _ in client.published]
+
+    def test_locks_share_connection(self, monkeypatch):
+        monkeypatch.setattr(mqtt.mqtt_client, "Client", FakePahoClient)
+        connection = Mqtt(
+            {"prefix_topic": "fleet", "hass_discovery_delay": 0},
+            lock_ids=["front", "back"],
+        )
+        client = connection.client
+        client.on_connect(client, None, None, 0)
+        commands = {}
+        for lock_id, lock in connection.locks.items():
+            lock.update_callback = lambda locked, lock_id=lock_id: commands.update(
+                {lock_id: locked}
+            )
+        client.on_message(
+            client, None, FakePahoMessage("fleet/back/command_topic", "lock")
+        )
+        assert commands == {"back": True}
+        assert "fleet/+/command_topic" in client.subscriptions
+
+        connection.lock("front").update_state(target_locked=False, current_locked=False)
+        time.sleep(0.1)
+        connection.stop()
+        published = {topic: payload for topic, payload, _ in client.published}
+        assert published["fleet/front/mqtt_state_topic"] == "unlocked"
+        assert (
+            json.loads(
+                published["homeassistant/lock/mqtt-homekey-lock-back-lock/config"]
+            )["state_topic"]
+            == "fleet/back/mqtt_state_topic"
+        )
+
+    def test_discovery_ids_are_valid_for_lock_names_with_spaces(self, monkeypatch):
+        monkeypatch.setattr(mqtt.mqtt_client, "Client", FakePahoClient)
+        connection = Mqtt(
+            {"prefix_topic": "fleet", "hass_discovery_delay": 0},
+            lock_ids=["Front Door", "Back Door"],
+        )
+        lock = connection.lock("Front Door")
+        config = json.loads(lock.hass_config_payload)
+        assert (
+            lock.hass_config_topic
+            == "homeassistant/lock/mqtt-homekey-lock-Front_Door-lock/config"
+        )
+        assert re.fullmatch(r"[a-zA-Z0-9_-]+", config["unique_id"])
+        assert config["command_topic"] == "fleet/Front Door/command_topic"
+        connection.stop()
+
+    def test_lock_commands_are_validated(self, connection):
+        lock = connection.lock()
+        commands, delays, reannounced = [], [], []
+        lock.update_callback = commands.append
+        lock.on_relock_delay = delays.append
+        lock.on_reannounce = lambda: reannounced.append(True)
+        client = connection.client
+
+        def send(name, payload):
+            message = FakePahoMessage(lock.topic_prefix + name, "")
+            message.payload = payload
+            client.on_message(client, None, message)
+
+        for payload in (b"lock", b"open", b"\xff", b"unlock"):
+            send("command_topic", payload)
+        for payload in (b"2.5", b"-1", b"nan", b"soon"):
+            send("relock_delay/set", payload)
+        send("reannounce", b"")
+        assert commands == [True, False]
+        assert delays == [2.5]
+        assert reannounced == [True]
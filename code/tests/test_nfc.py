@@ -0,0 +1,29 @@
+import os
+
+from util.nfc import crc16a, with_crc16a
+
+
+def bitwise_crc16a(data):
+    w_crc = 0x6363
+    for byte in data:
+        byte = byte ^ (w_crc & 0x00FF)
+        byte = (byte ^ (byte << 4)) & 0xFF
+        w_crc = ((w_crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)) & 0xFFFF
+    return bytearray([w_crc & 0xFF, (w_crc >> 8) & 0xFF])
+
+
+class TestCRC16A:
+    def test_known_value(self):
+        # ISO/IEC 14443-3 Annex B example
+        assert crc16a(bytes.fromhex("0000")) == bytes.fromhex("a01e")
+
+    def test_matches_bitwise_implementation(self):
+        for size in range(0, 64):
+            data = os.urandom(size)
+            assert crc16a(data) == bitwise_crc16a(data)
+
+    def test_frame_is_reused(self):
+        frame = with_crc16a(bytearray.fromhex("6a02c8010009011234567890abcdef"))
+        assert frame[:-2] == bytes.fromhex("6a02c8010009011234567890abcdef")
+        assert frame[-2:] == bitwise_crc16a(frame[:-2])
+        assert with_crc16a(bytes.fromhex("6a02c8010009011234567890abcdef")) is frame
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from polling import PollingScheduler, parse_cooldowns
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPollingScheduler:
+    @pytest.mark.parametrize(
+        "value,expected",
+        [
+            (2, {"default": 2.0}),
+            ("1.5", {"default": 1.5}),
+            ("fast=0.5, standard=1,3", {"fast": 0.5, "standard": 1.0, "default": 3.0}),
+            ({"FAILED": 4}, {"failed": 4.0}),
+        ],
+    )
+    def test_parse_cooldowns(self, value, expected):
+        assert parse_cooldowns(value) == expected
+
+    def test_cooldown_falls_back_to_default(self):
+        scheduler = PollingScheduler(cooldowns="fast=0.5,failed=3")
+        assert scheduler.get_cooldown("FAST") == 0.5
+        assert scheduler.get_cooldown(None) == 3.0
+        assert scheduler.get_cooldown("STANDARD") == 2.0
+
+    def test_backs_off_after_active_period(self):
+        clock = FakeClock()
+        scheduler = PollingScheduler(idle_interval=1.0, active_period=30.0, clock=clock)
+        assert scheduler.poll_interval == 0.0
+        clock.now = 31.0
+        assert not scheduler.is_active
+        assert scheduler.poll_interval == 1.0
+        scheduler.mark_activity()
+        assert scheduler.poll_interval == 0.0
+
+    def test_idle_wait_is_cut_short_by_activity(self):
+        clock = FakeClock()
+        scheduler = PollingScheduler(idle_interval=10.0, active_period=0.0, clock=clock)
+        threading.Timer(0.05, scheduler.mark_activity).start()
+        started = time.monotonic()
+        assert scheduler.wait_for_next_poll()
+        assert time.monotonic() - started < 5
+
+    def test_stop_interrupts_cooldown(self):
+        scheduler = PollingScheduler()
+        threading.Timer(0.05, scheduler.stop).start()
+        started = time.monotonic()
+        assert not scheduler.sleep(10.0)
+        assert time.monotonic() - started < 5
+        assert not scheduler.wait_for_next_poll()
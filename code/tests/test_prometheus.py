@@ -0,0 +1,57 @@
+import os
+
+import pytest
+from prometheus_client import REGISTRY
+
+from homekey import ProtocolError
+from prometheus import AppMetrics
+from repository import Repository
+from service import Service
+from tracing import span, trace
+
+LOCK_NAME = "test_prometheus"
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, {"lock_name": LOCK_NAME, **labels}) or 0
+
+
+class TestAppMetrics:
+    @pytest.fixture()
+    def metrics(self):
+        return AppMetrics.from_dict({"lock_name": LOCK_NAME, "port": 9100})
+
+    def test_port_is_read_from_config(self, metrics):
+        assert metrics.params.metrics_port == 9100
+
+    def test_transaction_is_counted_by_flow(self, metrics):
+        before = sample("homekey_transactions_total", flow="STANDARD")
+        with trace("homekey") as transaction:
+            with span("auth0"):
+                pass
+            with span("auth1"):
+                pass
+        transaction.attributes["flow"] = "STANDARD"
+        metrics.transaction_traced(transaction)
+        assert sample("homekey_transactions_total", flow="STANDARD") == before + 1
+        assert sample("homekey_auth_round_trip_seconds_count", command="auth1") >= 1
+
+    def test_errors_are_counted_by_type(self, metrics):
+        before = sample("homekey_errors_total", error="ProtocolError")
+        metrics.protocol_error(ProtocolError("AUTH0 INVALID STATUS"))
+        assert sample("homekey_errors_total", error="ProtocolError") == before + 1
+
+    def test_service_gauges_and_repository_timings(self, metrics, tmp_path):
+        repository = Repository(str(tmp_path / "homekey.json"))
+        repository.on_saved = metrics.repository_saved
+        service = Service(clf=None, repository=repository, key_pool_size=0)
+        metrics.track_service(service)
+        before = sample("homekey_repository_save_seconds_count", operation="journal")
+        repository.set_reader_private_key(os.urandom(32))
+        assert (
+            sample("homekey_repository_save_seconds_count", operation="journal")
+            == before + 1
+        )
+        assert sample("homekey_issuers") == 0
+        assert sample("homekey_nfc_poll_interval_seconds") == 0
+        service.stop()
@@ -0,0 +1,217 @@
+import copy
+import dataclasses
+import os
+
+import pytest
+
+from entity import Issuer
+from repository import Repository
+from tests.helpers import generate_endpoint
+
+
+class TestRepository:
+    @pytest.fixture()
+    def storage_file_path(self, tmp_path):
+        return str(tmp_path / "homekey.json")
+
+    @pytest.fixture()
+    def repository(self, storage_file_path):
+        return Repository(storage_file_path)
+
+    @pytest.fixture()
+    def issuer(self):
+        return Issuer(
+            public_key=os.urandom(32),
+            endpoints=[generate_endpoint(), generate_endpoint()],
+        )
+
+    def test_lookups_after_upsert_issuer(self, repository, issuer):
+        repository.upsert_issuer(issuer)
+        endpoint = issuer.endpoints[1]
+        assert repository.get_issuer_by_id(issuer.id).public_key == issuer.public_key
+        assert repository.get_issuer_by_public_key(issuer.public_key).id == issuer.id
+        assert repository.get_endpoint_by_id(endpoint.id) == endpoint
+        assert repository.get_endpoint_by_public_key(endpoint.public_key) == endpoint
+        assert len(repository.get_all_endpoints()) == 2
+
+    def test_stored_state_is_not_affected_by_caller_changes(self, repository, issuer):
+        repository.upsert_issuer(issuer)
+        issuer.endpoints.append(generate_endpoint())
+        issuer.endpoints[0].counter = 100
+        stored = repository.get_issuer_by_id(issuer.id)
+        assert len(stored.endpoints) == 2
+        assert stored.endpoints[0].counter == 0
+
+    def test_returned_objects_reject_changes(self, repository, issuer):
+        repository.upsert_issuer(issuer)
+        stored = repository.get_issuer_by_id(issuer.id)
+        endpoint = repository.get_endpoint_by_id(issuer.endpoints[0].id)
+        with pytest.raises(dataclasses.FrozenInstanceError):
+            endpoint.last_used_at = 100
+        with pytest.raises(dataclasses.FrozenInstanceError):
+            endpoint.enrollments.hap = None
+        with pytest.raises(dataclasses.FrozenInstanceError):
+            stored.endpoints = []
+        assert isinstance(stored.endpoints, tuple)
+        assert endpoint in stored.endpoints
+
+    def test_copies_of_returned_objects_can_be_changed(self, repository, issuer):
+        repository.upsert_issuer(issuer)
+        issuer = copy.deepcopy(repository.get_issuer_by_id(issuer.id))
+        issuer.endpoints[0].counter = 2
+        issuer.endpoints.append(generate_endpoint())
+        repository.upsert_issuer(issuer)
+        assert repository.get_endpoint_by_id(issuer.endpoints[0].id).counter == 2
+        assert len(repository.get_all_endpoints()) == 3
+
+    def test_upsert_endpoint_updates_indexes(self, repository, issuer):
+        repository.upsert_issuer(issuer)
+        endpoint = dataclasses.replace(issuer.endpoints[0], counter=5)
+        added = generate_endpoint()
+        repository.upsert_endpoint(issuer.id, endpoint)
+        repository.upsert_endpoint(issuer.id, added)
+        assert repository.get_endpoint_by_id(endpoint.id).counter == 5
+        assert repository.get_endpoint_by_public_key(added.public_key) == added
+        assert len(repository.get_issuer_by_id(issuer.id).endpoints) == 3
+
+    def test_upsert_issuers_merges_by_id(self, repository, issuer):
+        other = Issuer(public_key=os.urandom(32), endpoints=[])
+        repository.upsert_issuers([issuer, other])
+        updated = Issuer(public_key=issuer.public_key, endpoints=issuer.endpoints[:1])
+        repository.upsert_issuers([updated])
+        assert [i.id for i in repository.get_all_issuers()] == [issuer.id, other.id]
+        assert repository.get_endpoint_by_id(issuer.endpoints[1].id) is None
+
+    def test_remove_issuer_drops_its_endpoints(self, repository, issuer):
+        repository.upsert_issuer(issuer)
+        repository.remove_issuer(issuer)
+        assert repository.get_issuer_by_id(issuer.id) is None
+        assert repository.get_endpoint_by_id(issuer.endpoints[0].id) is None
+        assert len(repository.get_endpoint_key_index()) == 0
+
+    def test_state_is_restored_from_file(self, repository, storage_file_path, issuer):
+        repository.set_reader_private_key(os.urandom(32))
+        repository.upsert_issuer(issuer)
+        restored = Repository(storage_file_path)
+        assert restored.get_reader_private_key() == repository.get_reader_private_key()
+        assert restored.get_issuer_by_id(issuer.id).to_dict() == issuer.to_dict()
+        assert len(restored.get_endpoint_key_index()) == 2
+
+    def test_changes_are_appended_to_journal(
+        self, repository, storage_file_path, issuer
+    ):
+        repository.upsert_issuer(issuer)
+        # Restarting compacts the journal into the snapshot
+        repository = Repository(storage_file_path)
+        snapshot = open(storage_file_path).read()
+        endpoint = dataclasses.replace(issuer.endpoints[0], counter=1)
+        repository.upsert_issuers(
+            [
+                Issuer(
+                    public_key=issuer.public_key,
+                    endpoints=[endpoint, issuer.endpoints[1]],
+                )
+            ]
+        )
+        assert open(storage_file_path).read() == snapshot
+        # Counter updates are buffered until flushed
+        assert open(f"{storage_file_path}.journal").read() == ""
+        assert repository.get_endpoint_by_id(endpoint.id).counter == 1
+        repository.flush()
+        records = open(f"{storage_file_path}.journal").read().splitlines()
+        assert len(records) == 1
+        assert '"op":"upsert_endpoint"' in records[0]
+
+    def test_structural_change_writes_buffered_usage(
+        self, repository, storage_file_path, issuer
+    ):
+        repository.upsert_issuer(issuer)
+        endpoint = dataclasses.replace(issuer.endpoints[0], counter=3)
+        repository.upsert_issuers(
+            [
+                Issuer(
+                    public_key=issuer.public_key,
+                    endpoints=[endpoint, issuer.endpoints[1]],
+                )
+            ]
+        )
+        repository.upsert_issuer(Issuer(public_key=os.urandom(32), endpoints=[]))
+        restored = Repository(storage_file_path)
+        assert restored.get_endpoint_by_id(endpoint.id).counter == 3
+        assert len(restored.get_all_issuers()) == 2
+
+    def test_journal_is_replayed_and_compacted_on_start(
+        self, repository, storage_file_path, issuer
+    ):
+        repository.upsert_issuer(issuer)
+        repository.upsert_endpoint(
+            issuer.id, dataclasses.replace(issuer.endpoints[1], counter=7)
+        )
+        restored = Repository(storage_file_path)
+        assert restored.get_endpoint_by_id(issuer.endpoints[1].id).counter == 7
+        assert open(f"{storage_file_path}.journal").read() == ""
+        assert Repository(storage_file_path).get_issuer_by_id(issuer.id) is not None
+
+    def test_torn_journal_record_is_ignored(
+        self, repository, storage_file_path, issuer
+    ):
+        repository.upsert_issuer(issuer)
+        with open(f"{storage_file_path}.journal", "a") as file:
+            file.write('{"op":"remove_iss')
+        restored = Repository(storage_file_path)
+        assert restored.get_issuer_by_id(issuer.id) is not None
+
+    def test_append_after_torn_journal_survives_restart(
+        self, repository, storage_file_path, issuer
+    ):
+        repository.upsert_issuer(issuer)
+        Repository(storage_file_path)
+        # Journal holds nothing but a torn record
+        with open(f"{storage_file_path}.journal", "w") as file:
+            file.write('{"op":"remove_iss')
+        restored = Repository(storage_file_path)
+        restored.upsert_endpoint(
+            issuer.id, dataclasses.replace(issuer.endpoints[0], counter=9)
+        )
+        restored = Repository(storage_file_path)
+        assert restored.get_endpoint_by_id(issuer.endpoints[0].id).counter == 9
+
+    def test_record_after_torn_line_starts_on_new_line(
+        self, repository, storage_file_path, issuer
+    ):
+        journal = repository._journal
+        with open(journal.path, "w") as file:
+            file.write('{"op":"remove_iss')
+        journal.read()
+        repository.upsert_issuer(issuer)
+        assert journal.read() == [{"op": "upsert_issuer", "issuer": issuer.to_dict()}]
+        assert journal.unreadable == 1
+
+    def test_memory_is_restored_when_journal_append_fails(
+        self, repository, issuer, monkeypatch
+    ):
+        repository.upsert_issuer(issuer)
+        reader_private_key = repository.get_reader_private_key()
+
+        def fail(records):
+            raise OSError("No space left on device")
+
+        monkeypatch.setattr(repository._journal, "append", fail)
+        with pytest.raises(OSError):
+            repository.set_reader_private_key(os.urandom(32))
+        with pytest.raises(OSError):
+            repository.remove_issuer(issuer)
+        assert repository.get_reader_private_key() == reader_private_key
+        assert repository.get_issuer_by_id(issuer.id) is not None
+        assert len(repository.get_endpoint_key_index()) == 2
+
+    def test_journal_is_compacted_after_threshold(self, storage_file_path, issuer):
+        repository = Repository(storage_file_path, journal_compaction_threshold=3)
+        repository.upsert_issuer(issuer)
+        for counter in range(1, 3):
+            repository.upsert_endpoint(
+                issuer.id, dataclasses.replace(issuer.endpoints[0], counter=counter)
+            )
+        assert open(f"{storage_file_path}.journal").read() == ""
+        restored = Repository(storage_file_path)
+        assert restored.get_endpoint_by_id(issuer.endpoints[0].id).counter == 2
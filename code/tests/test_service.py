@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from entity import ReaderKeyRequest
+from repository import Repository
+from service import Service
+from util.ecp import ECP
+
+
+class TestService:
+    @pytest.fixture()
+    def service(self, tmp_path):
+        repository = Repository(str(tmp_path / "homekey.json"))
+        repository.set_reader_private_key(os.urandom(32))
+        repository.set_reader_identifier(os.urandom(8))
+        service = Service(clf=None, repository=repository, key_pool_size=0)
+        yield service
+        service.stop()
+
+    def test_broadcast_frame_is_cached(self, service):
+        frame = service.broadcast_frame
+        assert (
+            frame
+            == ECP.home(
+                identifier=service.repository.get_reader_group_identifier(),
+                flag_2=True,
+            ).pack()
+        )
+        assert service.broadcast_frame is frame
+
+    def test_broadcast_frame_follows_express_setting(self, service):
+        frame = service.broadcast_frame
+        service.express = False
+        assert service.broadcast_frame != frame
+        assert service.broadcast_frame[2] & 0b01000000 == 0
+
+    def test_broadcast_frame_follows_reader_key(self, service):
+        frame = service.broadcast_frame
+        service.add_reader_key(
+            ReaderKeyRequest(
+                reader_private_key=os.urandom(32),
+                unique_reader_identifier=service.repository.get_reader_identifier(),
+            )
+        )
+        assert service.broadcast_frame != frame
+        assert service.broadcast_frame[-8:] == (
+            service.repository.get_reader_group_identifier()
+        )
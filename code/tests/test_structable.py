@@ -0,0 +1,130 @@
+from collections.abc import Iterable
+from enum import Enum, IntEnum
+
+import pytest
+
+from util.structable import Packable, int_to_bytes, pack, pack_into
+from util.tlv import BERTLV
+
+
+def isinstance_pack(data, *, byteorder="big", signed=False):
+    """Encoder as it was before exact type dispatch, used as a reference"""
+    if isinstance(data, Packable):
+        return data.pack()
+    elif isinstance(data, bytes):
+        return data
+    elif isinstance(data, memoryview):
+        return bytes(data)
+    elif isinstance(data, str):
+        return data.encode()
+    elif isinstance(data, bytearray):
+        return bytes(data)
+    elif isinstance(data, Enum):
+        return isinstance_pack(data.value, byteorder=byteorder, signed=signed)
+    elif isinstance(data, Iterable):
+        return b"".join(
+            isinstance_pack(element, byteorder=byteorder, signed=signed)
+            for element in data
+        )
+    elif isinstance(data, int):
+        return int_to_bytes(data, byteorder=byteorder, signed=signed)
+    raise TypeError(f"Cannot pack data {type(data)} {data}")
+
+
+class Color(IntEnum):
+    RED = 0x01
+    BLUE = 0x0102
+
+
+class Name(str, Enum):
+    FRONT = "front"
+
+
+class Version(Enum):
+    V2 = b"\x02\x00"
+
+
+class Identifier(bytes):
+    pass
+
+
+class Counter(int):
+    pass
+
+
+class Header(Packable):
+    def pack(self):
+        return b"\xaa\xbb"
+
+
+class IterablePackable(Packable):
+    """Packable takes precedence over iteration"""
+
+    def __iter__(self):
+        return iter((b"\x00",))
+
+    def pack(self):
+        return b"\xcc"
+
+
+SAMPLES = [
+    0,
+    1,
+    255,
+    256,
+    0x010203,
+    -1,
+    True,
+    b"",
+    b"\x01\x02",
+    bytearray(b"\x03\x04"),
+    memoryview(b"\x05\x06"),
+    "",
+    "key-identifier",
+    [],
+    [1, b"\x02", "3"],
+    (0x00, (0x01, [b"\x02", (0x0304,)]), "x"),
+    Header(),
+    [Header(), (Header(), 0x05)],
+    BERTLV(0x86, value=b"\x01\x02"),
+    [BERTLV(0x7F49, value=[BERTLV(0x86, value=b"\x01")]), b"\x00"],
+    # Type precedence cases
+    Color.RED,
+    Color.BLUE,
+    Name.FRONT,
+    Version.V2,
+    Identifier(b"\x07\x08"),
+    Counter(0x0102),
+    IterablePackable(),
+    (Color.RED, Name.FRONT, Identifier(b"\x09"), Counter(3), IterablePackable()),
+]
+
+
+class TestPack:
+    @pytest.mark.parametrize("data", SAMPLES, ids=repr)
+    def test_matches_isinstance_encoder(self, data):
+        assert pack(data) == isinstance_pack(data)
+
+    @pytest.mark.parametrize("data", [-1, 0x7F, 0x80, [0x80, -2]], ids=repr)
+    def test_signed_matches_isinstance_encoder(self, data):
+        assert pack(data, signed=True) == isinstance_pack(data, signed=True)
+
+    def test_byteorder_is_passed_to_nested_ints(self):
+        data = [0x0102, (Counter(0x0304),)]
+        assert pack(data, byteorder="little") == bytes.fromhex("02010403")
+
+    def test_result_is_bytes(self):
+        assert type(pack([bytearray(b"\x01"), memoryview(b"\x02")])) is bytes
+
+    def test_unsupported_type_raises(self):
+        with pytest.raises(TypeError):
+            pack(1.5)
+        with pytest.raises(TypeError):
+            pack([b"\x01", None])
+
+    def test_pack_into_appends_at_offset(self):
+        result = bytearray(b"\xff\xfe")
+        pack_into(result, [0x01, b"\x02", BERTLV(0x86, value=b"\x03")])
+        assert result == bytes.fromhex("fffe0102860103")
+        Header().pack_into(result)
+        assert result == bytes.fromhex("fffe0102860103aabb")
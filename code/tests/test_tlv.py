@@ -0,0 +1,182 @@
+import os
+import random
+
+import pytest
+
+from util.generic import get_tlv_tag
+from util.structable import pack
+from entity import (
+    ControlPointRequest,
+    DeviceCredentialRequest,
+    HardwareFinishColor,
+    HardwareFinishResponse,
+    KeyType,
+    Operation,
+    ReaderKeyRequest,
+)
+from util.tlv import BERTLV, TLV8, TLVList
+
+
+def generate_tag(rng: random.Random, constructed: bool):
+    first = rng.randrange(0, 0x100) & 0b11000000 | (0b00100000 if constructed else 0)
+    if rng.random() < 0.2:
+        # Multi-byte tag number
+        extension = [rng.randrange(0x80, 0x100) for _ in range(rng.randrange(0, 2))]
+        return bytes([first | 0b00011111, *extension, rng.randrange(0, 0x80)])
+    return bytes([first | rng.randrange(0, 0b00011111)])
+
+
+def generate_tree(rng: random.Random, depth=0):
+    """Returns a list of (tag, value) pairs, where value is either bytes or a nested list"""
+    elements = []
+    for _ in range(rng.randrange(1, 5)):
+        if depth < 3 and rng.random() < 0.3:
+            elements.append((generate_tag(rng, True), generate_tree(rng, depth + 1)))
+        else:
+            # Lengths above 127 and 255 exercise long length forms
+            size = rng.choice((0, 1, 16, 65, 127, 128, 300))
+            elements.append((generate_tag(rng, False), os.urandom(size)))
+    return elements
+
+
+def build(elements):
+    return [
+        BERTLV(tag, value=build(value) if isinstance(value, list) else value)
+        for tag, value in elements
+    ]
+
+
+def assert_matches(tlv_array, elements):
+    assert len(tlv_array) == len(elements)
+    for tlv, (tag, value) in zip(tlv_array, elements):
+        assert tlv.tag.data == tag
+        if isinstance(value, list):
+            assert_matches(tlv.value, value)
+        else:
+            assert tlv.value == value
+
+
+class TestBERTLV:
+    @pytest.mark.parametrize("seed", range(50))
+    def test_unpack_array_fuzz(self, seed):
+        elements = generate_tree(random.Random(seed))
+        data = pack(build(elements))
+        tlv_array = BERTLV.unpack_array(data)
+        assert_matches(tlv_array, elements)
+        assert pack(tlv_array) == data
+        offset = 0
+        for tlv in tlv_array:
+            assert tlv.offset == offset
+            offset += len(tlv.pack())
+
+    def test_modified_value_is_packed(self):
+        tlv = BERTLV.unpack(pack(BERTLV(0x86, value=b"\x01\x02")))
+        tlv.value = b"\x03\x04"
+        assert tlv.pack() == bytes.fromhex("86020304")
+
+    def test_changed_child_of_parsed_element_is_packed(self):
+        data = pack(
+            BERTLV(
+                0x7F49,
+                value=[BERTLV(0x86, value=b"\x01\x02"), BERTLV(0x87, value=b"\x03")],
+            )
+        )
+        tlv = BERTLV.unpack(data)
+        tlv.value[0].value = b"\x0a\x0b"
+        assert tlv.pack() == bytes.fromhex("7f490786020a0b870103")
+        tlv.value[1] = BERTLV(0x88, value=b"\x04")
+        result = bytearray(b"\xff")
+        tlv.pack_into(result)
+        assert result == bytes.fromhex("ff7f490786020a0b880104")
+
+    def test_unchanged_parsed_element_is_packed_from_source(self):
+        data = bytes.fromhex("7f49078602010287010386020405")
+        tlv = BERTLV.unpack_array(data)[0]
+        assert tlv.value[0].value == b"\x01\x02"
+        result = bytearray(b"\xee")
+        tlv.pack_into(result)
+        assert result == bytes.fromhex("ee7f490786020102870103")
+
+    def test_truncated_value_raises(self):
+        with pytest.raises(ValueError):
+            BERTLV.unpack_array(bytes.fromhex("8605010203"))
+
+    def test_tag_lookup(self):
+        tlv_array = BERTLV.unpack_array(
+            bytes.fromhex("5c0202005c020100") + pack(BERTLV(0x9D, value=b"\x00" * 16))
+        )
+        assert isinstance(tlv_array, TLVList)
+        assert get_tlv_tag(tlv_array, 0x5C) == bytes.fromhex("0200")
+        assert get_tlv_tag(tlv_array, 0x9D) == b"\x00" * 16
+        assert get_tlv_tag(tlv_array, 0x86) is None
+        assert get_tlv_tag(list(tlv_array), 0x5C) == bytes.fromhex("0200")
+
+
+class TestTLV8:
+    def test_control_point_request_round_trip(self):
+        request = ControlPointRequest(
+            operation=Operation.ADD,
+            device_credential_request=DeviceCredentialRequest(
+                key_type=KeyType.SECP256R1,
+                credential_public_key=os.urandom(64),
+                issuer_key_identifier=os.urandom(8),
+            ),
+        )
+        data = request.pack()
+        assert data[:3] == bytes([0x01, 0x01, Operation.ADD])
+        unpacked = ControlPointRequest.unpack(data)
+        assert unpacked.operation == Operation.ADD
+        assert unpacked.reader_key_request is None
+        credential = unpacked.device_credential_request
+        assert credential.key_type == KeyType.SECP256R1
+        assert credential.credential_public_key == (
+            request.device_credential_request.credential_public_key
+        )
+        assert unpacked.pack() == data
+
+    def test_first_occurrence_of_tag_wins(self):
+        request = ReaderKeyRequest.unpack(bytes.fromhex("0302aaaa0302bbbb"))
+        assert request.unique_reader_identifier == bytes.fromhex("aaaa")
+
+    def test_enum_field_is_cast(self):
+        response = HardwareFinishResponse(color=HardwareFinishColor.SILVER)
+        unpacked = HardwareFinishResponse.unpack(response.pack())
+        assert unpacked.color == HardwareFinishColor.SILVER
+
+    @pytest.mark.parametrize("size", [254, 255, 256, 510, 600])
+    def test_long_values_are_fragmented(self, size):
+        value = os.urandom(size)
+        data = TLV8(0x02, value).pack()
+        assert len(data) == size + 2 * max(1, -(-size // 255))
+        tlv_array = TLV8.unpack_array(data + bytes.fromhex("0301ff"))
+        assert [tlv.tag for tlv in tlv_array] == [0x02, 0x03]
+        assert bytes(tlv_array[0].value) == value
+        assert ReaderKeyRequest.unpack(data).reader_private_key == value
+
+    def test_separated_items_are_not_joined(self):
+        value = os.urandom(255)
+        data = (
+            TLV8(0x01, value).pack() + bytes.fromhex("ff00") + TLV8(0x01, b"x").pack()
+        )
+        tlv_array = TLV8.unpack_array(data)
+        assert [tlv.tag for tlv in tlv_array] == [0x01, 0xFF, 0x01]
+        assert bytes(tlv_array[0].value) == value
+        assert bytes(tlv_array[2].value) == b"x"
+
+    def test_separated_fragmented_values_are_not_joined(self):
+        first, second = os.urandom(300), os.urandom(255)
+        data = (
+            TLV8(0x01, first).pack()
+            + bytes.fromhex("ff00")
+            + TLV8(0x01, second).pack()
+            + TLV8(0x02, b"y").pack()
+        )
+        tlv_array = TLV8.unpack_array(data)
+        assert [tlv.tag for tlv in tlv_array] == [0x01, 0xFF, 0x01, 0x02]
+        assert bytes(tlv_array[0].value) == first
+        assert bytes(tlv_array[2].value) == second
+
+    def test_adjacent_items_after_short_item_are_not_joined(self):
+        data = bytes.fromhex("0101aa0101bb")
+        tlv_array = TLV8.unpack_array(data)
+        assert [bytes(tlv.value) for tlv in tlv_array] == [b"\xaa", b"\xbb"]
@@ -0,0 +1,73 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from prometheus_client import REGISTRY
+
+from prometheus import AppMetrics
+from tracing import Trace, get_current_trace, span, trace, traced
+
+
+@traced("decorated")
+def decorated_phase():
+    with span("nested"):
+        pass
+
+
+class TestTracing:
+    def test_spans_are_recorded_in_order(self):
+        with trace("transaction") as transaction:
+            with span("first"):
+                pass
+            decorated_phase()
+        assert [s.name for s in transaction.spans] == ["first", "nested", "decorated"]
+        assert transaction.get_span("decorated").finished_at <= transaction.duration
+        assert get_current_trace() is None
+
+    def test_span_outside_of_trace_does_nothing(self):
+        with span("orphan"):
+            pass
+        assert get_current_trace() is None
+
+    def test_spans_from_copied_context_join_trace(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with trace("transaction") as transaction:
+                executor.submit(
+                    contextvars.copy_context().run, decorated_phase
+                ).result()
+        assert transaction.get_span("decorated") is not None
+
+    def test_metrics_export_tap_to_unlock(self):
+        metrics = AppMetrics.from_dict({"lock_name": "test_tracing"})
+        labels = {"lock_name": "test_tracing", "flow": "FAST"}
+        with trace("transaction") as transaction:
+            with span("auth0"):
+                pass
+            with span("lock_callback"):
+                pass
+        transaction.attributes["flow"] = "FAST"
+        metrics.transaction_traced(transaction)
+        assert (
+            REGISTRY.get_sample_value("homekey_tap_to_unlock_seconds_count", labels)
+            == 1
+        )
+        assert (
+            REGISTRY.get_sample_value(
+                "homekey_transaction_phase_seconds_count", {**labels, "phase": "auth0"}
+            )
+            == 1
+        )
+
+    def test_tap_to_unlock_excludes_sense(self):
+        metrics = AppMetrics.from_dict({"lock_name": "test_tap_to_unlock"})
+        labels = {"lock_name": "test_tap_to_unlock", "flow": "FAST"}
+        transaction = Trace("transaction")
+        started_at = transaction._started_at
+        transaction.add_span("sense", started_at, 2.0)
+        transaction.add_span("activate", started_at + 2.0, 0.01)
+        transaction.add_span("lock_callback", started_at + 2.1, 0.05)
+        transaction.attributes["flow"] = "FAST"
+        metrics.transaction_traced(transaction)
+        assert REGISTRY.get_sample_value(
+            "homekey_tap_to_unlock_seconds_sum", labels
+        ) == pytest.approx(0.15)
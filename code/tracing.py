@@ -0,0 +1,104 @@
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+log = logging.getLogger()
+
+
+@dataclass(frozen=True)
+class Span:
+    name: str
+    # Seconds since the start of the trace
+    started_at: float
+    duration: float
+
+    @property
+    def finished_at(self):
+        return self.started_at + self.duration
+
+
+class Trace:
+    """Timings of phases of a single transaction"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.attributes: Dict[str, str] = dict()
+        self.spans: List[Span] = []
+        self._started_at = time.perf_counter()
+        self._finished_at: Optional[float] = None
+
+    @property
+    def duration(self) -> float:
+        return (self._finished_at or time.perf_counter()) - self._started_at
+
+    def add_span(self, name: str, started_at: float, duration: float):
+        # list.append is atomic, so spans can be added from helper threads
+        self.spans.append(
+            Span(name=name, started_at=started_at - self._started_at, duration=duration)
+        )
+
+    def get_span(self, name: str) -> Optional[Span]:
+        """Returns the last span with a given name"""
+        return next((s for s in reversed(self.spans) if s.name == name), None)
+
+    def finish(self):
+        if self._finished_at is None:
+            self._finished_at = time.perf_counter()
+
+    def __repr__(self):
+        spans = " ".join(f"{s.name}={s.duration * 1000:.1f}ms" for s in self.spans)
+        return f"Trace({self.name} {self.attributes} total={self.duration * 1000:.1f}ms {spans})"
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def get_current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace(name: str):
+    """Makes spans opened in this context, including nested calls, part of a new Trace"""
+    current = Trace(name)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        current.finish()
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    """Records duration of the block into the current trace, does nothing outside of one"""
+    current = _current_trace.get()
+    if current is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add_span(name, started_at, time.perf_counter() - started_at)
+
+
+def traced(name: str):
+    """Decorator form of span"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+__all__ = ("Span", "Trace", "get_current_trace", "trace", "span", "traced")
@@ -84,9 +84,54 @@ class BroadcastFrameContactlessFrontend(ContactlessFrontend):
     def __init__(self, path=None, *, broadcast_enabled=False):
         self.path = path
         self.broadcast_enabled = broadcast_enabled
+        # Number of chipset commands that were skipped as they would not change anything
+        self.saved_frames = 0
+        # Chipset state as left by this frontend, valid only for _state_device
+        self._state_device = None
+        self._rf_configuration = {}
+        self._field_off = False
         # We send None so that we can try activating the reader later in a loop instead of throwing an exception right away
         super().__init__(None)
 
+    def _sync_chipset_state(self):
+        # Reopening the reader creates a new device which starts with default configuration
+        if self._state_device is not self.device:
+            self._state_device = self.device
+            self._rf_configuration = {}
+            self._field_off = False
+
+    def _set_rf_configuration(self, cfg_item, cfg_data):
+        self._sync_chipset_state()
+        cfg_data = bytes(cfg_data)
+        if self._rf_configuration.get(cfg_item) == cfg_data:
+            self.saved_frames += 1
+            return
+        # Forget the value first in case the command fails midway
+        self._rf_configuration.pop(cfg_item, None)
+        self.device.chipset.rf_configuration(cfg_item, cfg_data)
+        self._rf_configuration[cfg_item] = cfg_data
+
+    def _mute(self):
+        self._sync_chipset_state()
+        if self._field_off:
+            self.saved_frames += 1
+            return
+        self.device.mute()
+        self._field_off = True
+
+    def _unmute(self):
+        # Any command sent to a target or a poll turns the field back on
+        self._sync_chipset_state()
+        self._field_off = False
+
+    def exchange(self, send_data, timeout):
+        self._unmute()
+        return super().exchange(send_data, timeout)
+
+    def listen(self, target, timeout):
+        self._unmute()
+        return super().listen(target, timeout)
+
     # Modified code END
 
     def sense(self, *targets, **options):
@@ -152,9 +197,11 @@ class BroadcastFrameContactlessFrontend(ContactlessFrontend):
                 )
 
             # Turn off detection retries at it might break broadcast frame sequence
-            self.device.chipset.rf_configuration(0x05, [0xFF, 0x01, 0x00])
+            # Only the driver init touches this item, so it is sent once per opened device
+            self._set_rf_configuration(0x05, [0xFF, 0x01, 0x00])
 
             if target.brty.endswith("A"):
+                # Not cached, as firmware changes bit framing for the short REQA frame while sensing
                 self.device.chipset.write_register("CIU_BitFraming", 0x00)
                 broadcast = with_crc16a(broadcast)
             try:
@@ -176,12 +223,17 @@ class BroadcastFrameContactlessFrontend(ContactlessFrontend):
                 raise IOError(errno.ENODEV, os.strerror(errno.ENODEV))
 
             self.target = None  # forget captured target
-            self.device.mute()  # deactivate the rf field
+            # Modified code BEGIN
+            self._mute()  # deactivate the rf field, unless previous poll already did
+            # Modified code END
 
             for i in range(max(1, options.get("iterations", 1))):
                 started = time.time()
                 for target in targets:
                     # log.debug("sense {0}".format(target))
+                    # Modified code BEGIN
+                    self._unmute()
+                    # Modified code END
                     try:
                         if target.atr_req is not None:
                             self.target = sense_dep(target)
@@ -210,7 +262,9 @@ class BroadcastFrameContactlessFrontend(ContactlessFrontend):
                             log.debug("found {0}".format(self.target))
                             return self.target
                 if len(targets) > 0:
-                    self.device.mute()  # deactivate the rf field
+                    # Modified code BEGIN
+                    self._mute()  # deactivate the rf field
+                    # Modified code END
                 if i < options.get("iterations", 1) - 1:
                     elapsed = time.time() - started
                     time.sleep(max(0, options.get("interval", 0.1) - elapsed))
@@ -1,4 +1,9 @@
 def get_tlv_tag(tlv_array, tag_value):
+    # Parsed arrays are TLVList, which is indexed by tag
+    find = getattr(tlv_array, "find", None)
+    if find is not None:
+        tlv_ = find(tag_value)
+        return tlv_.value if tlv_ is not None else None
     try:
         return next(tlv_ for tlv_ in tlv_array if tlv_.tag.data[0] == tag_value).value
     except StopIteration:
@@ -85,19 +85,24 @@ class ISO7816Command(Packable):
     def pack(self) -> bytearray:
         force_extended_length = False
 
-        le = (self.le,) if self.le is not None else ()
-
-        if 256 <= self.lc <= 65_535 or force_extended_length:
-            lc_data = pack((0x00, self.lc.to_bytes(2, "big"), self.data))
-        elif 0 < self.lc < 256:
-            lc_data = pack((self.lc, self.data))
-        elif self.lc == 0:
-            lc_data = ()
-        else:
+        # Data is packed once, as lc would otherwise pack it again
+        data = pack(self.data)
+        lc = len(data)
+
+        result = bytearray((self.cla, self.ins, self.p1, self.p2))
+        if 256 <= lc <= 65_535 or force_extended_length:
+            result.append(0x00)
+            result += lc.to_bytes(2, "big")
+        elif 0 < lc < 256:
+            result.append(lc)
+        elif lc != 0:
             raise ValueError(
-                f"Length of an APDU should be in range [0, 65535], actual = {self.lc}"
+                f"Length of an APDU should be in range [0, 65535], actual = {lc}"
             )
-        return bytes([self.cla, self.ins, self.p1, self.p2, *lc_data, *le])
+        result += data
+        if self.le is not None:
+            result.append(self.le)
+        return bytes(result)
 
     def __repr__(self):
         return (
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+from typing import Collection, List
+
+log = logging.getLogger()
+
+
+def fsync_directory(path: str):
+    """Makes a rename or file creation inside directory durable"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        # Not supported on every platform
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_atomically(path: str, data: str):
+    """Writes data so that path contains either the old or the new content, never a mix"""
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+    fsync_directory(path)
+
+
+class Journal:
+    """Append-only log of JSON records, one per line
+
+    After read, unreadable is the number of lines that could not be parsed,
+    such as a record torn by a crash mid-append
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.length = 0
+        self.unreadable = 0
+        # Set when file may end with a partial line, so that next record starts on a new one
+        self._torn = False
+
+    def append(self, records: Collection[dict]):
+        if not len(records):
+            return
+        data = "".join(
+            json.dumps(record, separators=(",", ":")) + "\n" for record in records
+        )
+        if self._torn:
+            data = "\n" + data
+        try:
+            with open(self.path, "a") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+        except Exception:
+            self._torn = True
+            raise
+        self._torn = False
+        self.length += len(records)
+
+    def read(self) -> List[dict]:
+        records = []
+        self.unreadable = 0
+        try:
+            with open(self.path, "r") as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return records
+        for number, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Only the last record can be torn by a crash mid-append
+                self.unreadable += 1
+                log.warning(
+                    f"Ignoring unreadable journal record {number + 1} of {len(lines)} in {self.path}"
+                )
+        self._torn = len(lines) > 0 and not lines[-1].endswith("\n")
+        self.length = len(records)
+        return records
+
+    def truncate(self):
+        with open(self.path, "w") as file:
+            file.flush()
+            os.fsync(file.fileno())
+        self.length = 0
+        self._torn = False
@@ -1,14 +1,37 @@
+from functools import lru_cache
+
+
+def _generate_crc16a_table():
+    # CRC-A is CRC-16/CCITT in reflected form, so the reflected polynomial 0x8408 is used
+    table = []
+    for index in range(256):
+        crc = index
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16A_TABLE = _generate_crc16a_table()
+
+
 def crc16a(data):
     w_crc = 0x6363
+    table = CRC16A_TABLE
     for byte in data:
-        byte = byte ^ (w_crc & 0x00FF)
-        byte = (byte ^ (byte << 4)) & 0xFF
-        w_crc = ((w_crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)) & 0xFFFF
+        w_crc = (w_crc >> 8) ^ table[(w_crc ^ byte) & 0xFF]
     return bytearray([w_crc & 0xFF, (w_crc >> 8) & 0xFF])
 
 
+# Broadcast frames stay the same while reader configuration doesn't change,
+# so polling loop gets the same frame back instead of recomputing it
+@lru_cache(maxsize=16)
+def _with_crc16(data: bytes):
+    return data + crc16a(data)
+
+
 def with_crc16(data):
-    return bytes([*data, *crc16a(data)])
+    return _with_crc16(bytes(data))
 
 
 with_crc16a = with_crc16
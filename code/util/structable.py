@@ -3,7 +3,7 @@ import base64
 from collections.abc import Iterable
 from enum import Enum
 from string import printable
-from typing import Collection, ForwardRef, TypeVar, Union
+from typing import Callable, Collection, Dict, ForwardRef, TypeVar, Union
 
 PRINATBLE_BYTES = set(bytes(printable, "ascii"))
 
@@ -27,6 +27,11 @@ class Packable:
     def pack(self) -> Union[bytearray, bytes]:
         raise NotImplementedError()
 
+    def pack_into(self, result: bytearray):
+        """Appends packed representation to result.
+        Nested structures override it to avoid intermediate bytes"""
+        result += self.pack()
+
 
 class Unpackable:
     @classmethod
@@ -39,26 +44,83 @@ def int_to_bytes(i: int, *, byteorder="big", signed: bool = False) -> bytes:
     return i.to_bytes(length, byteorder=byteorder, signed=i < 0 or signed)
 
 
+Encoder = Callable[[bytearray, PackableData, str, bool], None]
+
+
+def _encode_bytes(result: bytearray, data, byteorder: str, signed: bool):
+    result += data
+
+
+def _encode_str(result: bytearray, data: str, byteorder: str, signed: bool):
+    result += data.encode()
+
+
+def _encode_int(result: bytearray, data: int, byteorder: str, signed: bool):
+    result += int_to_bytes(data, byteorder=byteorder, signed=signed)
+
+
+def _encode_packable(result: bytearray, data: Packable, byteorder: str, signed: bool):
+    data.pack_into(result)
+
+
+def _encode_enum(result: bytearray, data: Enum, byteorder: str, signed: bool):
+    pack_into(result, data.value, byteorder=byteorder, signed=signed)
+
+
+def _encode_iterable(result: bytearray, data, byteorder: str, signed: bool):
+    for element in data:
+        pack_into(result, element, byteorder=byteorder, signed=signed)
+
+
+def _resolve_encoder(data_type: type) -> Encoder:
+    # Order matches precedence of the original isinstance chain
+    if issubclass(data_type, Packable):
+        return _encode_packable
+    elif issubclass(data_type, (bytes, memoryview, bytearray)):
+        return _encode_bytes
+    elif issubclass(data_type, str):
+        return _encode_str
+    elif issubclass(data_type, Enum):
+        return _encode_enum
+    elif issubclass(data_type, Iterable):
+        return _encode_iterable
+    elif issubclass(data_type, int):
+        return _encode_int
+    raise TypeError(f"Cannot pack data {data_type}")
+
+
+# Encoders are looked up by exact type, subclasses are resolved once and cached
+_ENCODERS: Dict[type, Encoder] = {
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    memoryview: _encode_bytes,
+    str: _encode_str,
+    int: _encode_int,
+    list: _encode_iterable,
+    tuple: _encode_iterable,
+}
+
+
+def pack_into(result: bytearray, data: PackableData, *, byteorder="big", signed=False):
+    """Appends packed data to result, nested structures included"""
+    encoder = _ENCODERS.get(type(data))
+    if encoder is None:
+        try:
+            encoder = _ENCODERS[type(data)] = _resolve_encoder(type(data))
+        except TypeError:
+            raise TypeError(f"Cannot pack data {type(data)} {data}")
+    encoder(result, data, byteorder, signed)
+
+
 def pack(data: PackableData, *, byteorder="big", signed=False) -> bytes:
-    if isinstance(data, Packable):
-        return data.pack()
-    elif isinstance(data, bytes):
+    data_type = type(data)
+    if data_type is bytes:
         return data
-    elif isinstance(data, memoryview):
-        return bytes(data)
-    elif isinstance(data, str):
-        return data.encode()
-    elif isinstance(data, bytearray):
-        return bytes(data)
-    elif isinstance(data, Enum):
-        return pack(data.value, byteorder=byteorder, signed=signed)
-    elif isinstance(data, Iterable):
-        return b"".join(
-            pack(element, byteorder=byteorder, signed=signed) for element in data
-        )
-    elif isinstance(data, int):
-        return int_to_bytes(data, byteorder=byteorder, signed=signed)
-    raise TypeError(f"Cannot pack data {type(data)} {data}")
+    elif isinstance(data, Packable):
+        return data.pack()
+    result = bytearray()
+    pack_into(result, data, byteorder=byteorder, signed=signed)
+    return bytes(result)
 
 
 def represent(data: PackableData):
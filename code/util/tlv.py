@@ -1,8 +1,15 @@
 from enum import Enum, IntEnum
-from typing import Collection, List, Union
+from typing import Callable, Collection, Dict, List, Optional, Tuple, Union
 
 from util.generic import int_to_bytes
-from util.structable import PackableData, Packable, Unpackable, pack, represent
+from util.structable import (
+    PackableData,
+    Packable,
+    Unpackable,
+    pack,
+    pack_into,
+    represent,
+)
 
 
 def try_cast_type(value: bytes, type):
@@ -14,22 +21,8 @@ def try_cast_type(value: bytes, type):
         and not isinstance(value, bytearray)
     ):
         return value
-
-    try:
-        if issubclass(type, IntEnum):
-            return type(int.from_bytes(value, "big"))
-        elif issubclass(type, Enum):
-            return type(value)
-        elif issubclass(type, Unpackable):
-            return type.unpack(value)
-        elif type == bytes or type == memoryview or type == bytearray:
-            return bytes(value)
-        elif type == int:
-            return int.from_bytes(value, "big")
-        else:
-            return value
-    except (TypeError, ValueError, Exception):
-        return value
+    cast = compile_tlv8_caster(type)
+    return cast(value) if cast is not None else value
 
 
 def unpack_optional_tlv(value):
@@ -66,6 +59,26 @@ class TLV:
 
 
 class TLVList(list):
+    """List of parsed TLV elements with lookup of elements by tag"""
+
+    _index: Optional[Dict[int, TLV]] = None
+    _indexed_length = 0
+
+    @staticmethod
+    def _get_tag_number(tag):
+        return tag if isinstance(tag, int) else int.from_bytes(tag.data, "big")
+
+    def find(self, tag: int) -> Optional[TLV]:
+        """Returns the first element with a given tag"""
+        # Index is built on first lookup and rebuilt if elements were added since
+        if self._index is None or self._indexed_length != len(self):
+            index = dict()
+            for tlv in self:
+                index.setdefault(self._get_tag_number(tlv.tag), tlv)
+            self._index = index
+            self._indexed_length = len(self)
+        return self._index.get(tag)
+
     def __repr__(self) -> str:
         result = "["
         for el in self:
@@ -86,7 +99,7 @@ class BERTLVTag(Packable, Unpackable):
 
     @property
     def value(self):
-        raise NotImplementedError()
+        return int.from_bytes(self.data, "big")
 
     @property
     def class_(self):
@@ -115,20 +128,7 @@ class BERTLVTag(Packable, Unpackable):
 
     @classmethod
     def _unpack_tag(cls, data: bytes):
-        result = []
-        index = 0
-        tag = data[index]
-
-        index += 1
-        result.append(tag)
-        tag_number = tag & 0b00011111
-        tag_extension_left = tag_number & 0b00011111 == 0b00011111
-        while tag_extension_left:
-            tag_extension = data[index]
-            result.append(tag_extension)
-            tag_extension_left = bool(tag_extension & 0b10000000)
-            index += 1
-        return BERTLVTag(result)
+        return BERTLVTag(bytes(data[: _get_tag_end(data, 0)]))
 
     def pack(self) -> bytes:
         return self.data
@@ -189,30 +189,23 @@ class BERTLVLength(Packable, Unpackable):
 
     @classmethod
     def _unpack_length(cls, data: bytes):
-        index = 0
-        result = []
-        length_base_data = data[index]
-        result.append(data[index])
-        index += 1
-
+        length_base_data = data[0]
         length_form_is_simple = bool(~length_base_data & 0b10000000)
         if length_form_is_simple:
-            return BERTLVLength(data=result)
-        else:
-            length_length = length_base_data & 0b01111111
-
-            if length_length:
-                # Definite form
-                result.extend(data[index : index + length_length])
-                index += length_length
-                if len(result) != length_length + 1:
-                    raise ValueError("Bad format")
-            else:
-                # Indefinite form
-                while not bytes(result).endswith(b"\x00\x00"):
-                    result.append(data[index])
-                    index += 1
-            return BERTLVLength(result)
+            return BERTLVLength(data=bytes(data[:1]))
+        length_length = length_base_data & 0b01111111
+        if length_length:
+            # Definite form
+            if len(data) < length_length + 1:
+                raise ValueError("Bad format")
+            return BERTLVLength(bytes(data[: length_length + 1]))
+        # Indefinite form
+        result = [length_base_data]
+        index = 1
+        while not bytes(result).endswith(b"\x00\x00"):
+            result.append(data[index])
+            index += 1
+        return BERTLVLength(result)
 
     def pack(self):
         return self.data
@@ -221,10 +214,54 @@ class BERTLVLength(Packable, Unpackable):
         return f"{self.pack().hex()}"
 
 
+def _get_tag_end(data, index: int) -> int:
+    """Returns offset right after the tag that starts at index"""
+    tag_number_is_extended = data[index] & 0b00011111 == 0b00011111
+    index += 1
+    if tag_number_is_extended:
+        while data[index] & 0b10000000:
+            index += 1
+        index += 1
+    return index
+
+
+def _parse_bertlv_header(data: memoryview, index: int) -> Tuple[int, int, int]:
+    """Returns offsets of length and value, and value length of element at index"""
+    length_start = _get_tag_end(data, index)
+    length_base_data = data[length_start]
+    if not length_base_data & 0b10000000:
+        return length_start, length_start + 1, length_base_data
+    length_length = length_base_data & 0b01111111
+    if not length_length:
+        # Indefinite form is rare enough to go through the generic implementation
+        length = BERTLVLength.unpack(data[length_start:])
+        return length_start, length_start + len(length.data), length.value
+    value_start = length_start + 1 + length_length
+    if value_start > len(data):
+        raise ValueError("Bad format")
+    length = int.from_bytes(data[length_start + 1 : value_start], "big")
+    return length_start, value_start, length
+
+
+# Marks that value of an unpacked element has not been materialized yet
+_UNPARSED = object()
+
+
 class BERTLV(TLV, Packable, Unpackable):
+    """BER-TLV element.
+
+    Unpacked elements keep a view into the buffer they were parsed from:
+    their value is only converted into bytes or child elements on access,
+    and unchanged elements are packed by copying the original bytes
+    """
+
     tag: BERTLVTag
     length: BERTLVLength
-    value: PackableData
+    # Offset of the element in the buffer it was unpacked from
+    offset: Optional[int] = None
+
+    _raw: Optional[memoryview] = None
+    _value_view: Optional[memoryview] = None
 
     def __init__(self, tag, length=None, value: PackableData = b""):
         tag = BERTLVTag(tag) if isinstance(tag, int) else tag
@@ -235,6 +272,23 @@ class BERTLV(TLV, Packable, Unpackable):
         self.value = value
         self.length = length
 
+    @property
+    def value(self) -> PackableData:
+        value = self._value
+        if value is _UNPARSED:
+            if self.tag.is_constructed:
+                value = BERTLV.unpack_array(self._value_view)
+            else:
+                value = bytes(self._value_view)
+            self._value = value
+        return value
+
+    @value.setter
+    def value(self, value: PackableData):
+        self._value = value
+        self._raw = None
+        self._value_view = None
+
     def __getitem__(self, key: Union[int, bytes, bytearray, Collection[int]]):
         if (
             isinstance(key, bytes)
@@ -254,17 +308,56 @@ class BERTLV(TLV, Packable, Unpackable):
             return self.value[key]
 
     def pack(self):
-        return pack((self.tag, self.length, self.value))
+        result = bytearray()
+        self.pack_into(result)
+        return bytes(result)
+
+    def pack_into(self, result: bytearray):
+        # Parsed children can be modified in place, so only immutable values reuse source bytes
+        if self._raw is not None and (
+            self._value is _UNPARSED or isinstance(self._value, bytes)
+        ):
+            result += self._raw
+            return
+        # Tag can also be provided as raw bytes
+        pack_into(result, self.tag)
+        pack_into(result, self.length)
+        pack_into(result, self.value)
+
+    @classmethod
+    def _parse(cls, data: memoryview, index: int) -> "BERTLV":
+        length_start, value_start, length = _parse_bertlv_header(data, index)
+        value_end = value_start + length
+        if value_end > len(data):
+            raise ValueError("Tag length does not match data size")
+        # Constructors are bypassed, as their input conversion is not needed here
+        tlv = cls.__new__(cls)
+        tlv.tag = BERTLVTag.__new__(BERTLVTag)
+        tlv.tag.data = bytes(data[index:length_start])
+        tlv.length = BERTLVLength.__new__(BERTLVLength)
+        tlv.length.data = bytes(data[length_start:value_start])
+        tlv.offset = index
+        tlv._value = _UNPARSED
+        tlv._value_view = data[value_start:value_end]
+        tlv._raw = data[index:value_end]
+        return tlv
 
     @classmethod
     def unpack_array(cls, data: bytes):
-        result = []
+        result = TLVList()
+        tags = dict()
+        data = memoryview(data)
         index = 0
+        # A single trailing byte cannot form an element and is ignored
         while index < len(data) - 1:
-            _tlv = BERTLV.unpack(data[index:])
-            index += len(_tlv.pack())
+            _tlv = cls._parse(data, index)
+            index += len(_tlv._raw)
             result.append(_tlv)
-        return TLVList(result)
+            tags.setdefault(int.from_bytes(_tlv.tag.data, "big"), _tlv)
+        # Index is filled in during parsing, so that lookups don't need another pass
+        result._index = tags
+        result._indexed_length = len(result)
+        return result
 
     @classmethod
     def unpack(cls, data: bytes):
@@ -272,19 +365,52 @@ class BERTLV(TLV, Packable, Unpackable):
 
     @classmethod
     def _unpack_tlv(cls, data: bytes):
-        index = 0
-        data = memoryview(data)
-        tag = BERTLVTag.unpack(data[index:])
-        index += len(tag.data)
-        length = BERTLVLength.unpack(data[index:])
-        index += len(length.data)
-        data = memoryview(data)[index : index + length.value]
-        if len(data) != length.value:
-            raise ValueError("Tag length does not match data size")
-        if tag.is_constructed:
-            return BERTLV(tag, length, cls.unpack_array(data[index:]))
+        return cls._parse(memoryview(data), 0)
+
+
+# HAP splits TLV8 values longer than this into consecutive items with the same tag
+TLV8_FRAGMENT_SIZE = 255
+
+
+def pack_tlv8_into(result: bytearray, tag: int, data: bytes):
+    """Appends a TLV8 item, fragmenting values that don't fit into one item"""
+    if len(data) <= TLV8_FRAGMENT_SIZE:
+        result.append(tag)
+        result.append(len(data))
+        result += data
+        return
+    for offset in range(0, len(data), TLV8_FRAGMENT_SIZE):
+        fragment = data[offset : offset + TLV8_FRAGMENT_SIZE]
+        result.append(tag)
+        result.append(len(fragment))
+        result += fragment
+
+
+def read_tlv8(data) -> List[Tuple[int, Union[memoryview, bytes]]]:
+    """Reads TLV8 items in a single pass, joining fragments of values longer than 255 bytes.
+
+    Values that were not fragmented are returned as views into data
+    """
+    data = memoryview(data)
+    result = []
+    index = 0
+    # Tag and length of the item right before the current one in data
+    previous_tag = None
+    previous_length = None
+    while index < len(data):
+        tag = data[index]
+        length = data[index + 1] if index + 1 < len(data) else 0
+        value = data[index + 2 : index + 2 + length]
+        index += 2 + length
+        # Only an item directly after a full-size fragment with the same tag continues it,
+        # anything in between, such as a 0xFF separator, starts a new value
+        if tag == previous_tag and previous_length == TLV8_FRAGMENT_SIZE:
+            result[-1] = (tag, bytes(result[-1][1]) + bytes(value))
         else:
-            return BERTLV(tag, length, bytes(data))
+            result.append((tag, value))
+        previous_tag = tag
+        previous_length = length
+    return result
 
 
 class TLV8(TLV, Packable, Unpackable):
@@ -303,31 +429,21 @@ class TLV8(TLV, Packable, Unpackable):
 
     @classmethod
     def unpack_array(cls, data: bytes):
-        result = []
-        while len(data):
-            tlv = cls._unpack_tlv(data)
-            data = data[len(tlv.pack()) :]
-            result.append(tlv)
-        return TLVList(result)
+        return TLVList(TLV8(tag, value) for tag, value in read_tlv8(data))
 
     @property
     def length(self):
         return len(pack(self.value))
 
     def pack(self):
-        data = pack(self.value)
-        return bytes([self.tag, len(data), *data])
+        result = bytearray()
+        pack_tlv8_into(result, self.tag, pack(self.value))
+        return bytes(result)
 
     @classmethod
     def _unpack_tlv(cls, data: bytes):
-        index = 0
-        data = memoryview(data)
-        tag = data[index]
-        index += 1
-        length = data[index]
-        index += 1
-        data = memoryview(data)[index : index + length]
-        return TLV8(tag, data)
+        tag, value = read_tlv8(data)[0]
+        return TLV8(tag, value)
 
 
 class TLV8Field:
@@ -337,6 +453,42 @@ class TLV8Field:
         self.default = default
 
 
+def compile_tlv8_caster(field_type) -> Optional[Callable]:
+    """Resolves the conversion of a raw value into field_type once, so that
+    decoding does not repeat subclass checks for every value"""
+    if not isinstance(field_type, type):
+        return None
+    if issubclass(field_type, IntEnum):
+
+        def convert(value):
+            return field_type(int.from_bytes(value, "big"))
+
+    elif issubclass(field_type, Enum):
+
+        def convert(value):
+            return field_type(bytes(value))
+
+    elif issubclass(field_type, Unpackable):
+        convert = field_type.unpack
+    elif field_type in (bytes, memoryview, bytearray):
+        convert = bytes
+    elif field_type == int:
+
+        def convert(value):
+            return int.from_bytes(value, "big")
+
+    else:
+        return None
+
+    def cast(value):
+        try:
+            return convert(value)
+        except Exception:
+            return value
+
+    return cast
+
+
 class TLV8ObjectMeta(type):
     class _TLV8Field:
         def __init__(self, index, type: "type", optional=True, default=None):
@@ -358,11 +510,21 @@ class TLV8ObjectMeta(type):
                 )
         new_class = super().__new__(cls, name, bases, attrs)
         new_class._tlv8_fields = _tlv8_fields
+        # Field layout is fixed, so encoding and decoding steps are resolved here once
+        new_class._tlv8_encoders = tuple(
+            (fname, field.index) for fname, field in _tlv8_fields.items()
+        )
+        new_class._tlv8_decoders = tuple(
+            (fname, field.index, compile_tlv8_caster(field.type))
+            for fname, field in _tlv8_fields.items()
+        )
         return new_class
 
 
 class TLV8Object(Packable, Unpackable, metaclass=TLV8ObjectMeta):
     _tlv8_fields: dict[str, TLV8Field]
+    _tlv8_encoders: Tuple[Tuple[str, int], ...]
+    _tlv8_decoders: Tuple[Tuple[str, int, Optional[Callable]], ...]
 
     def __init__(self, **kwargs):
         super().__init__()
@@ -374,25 +536,25 @@ class TLV8Object(Packable, Unpackable, metaclass=TLV8ObjectMeta):
 
     @classmethod
     def unpack(cls, data) -> "TLV8Object":
-        tlv_array = TLV8.unpack_array(data)
-        result = {
-            name: try_cast_type(
-                unpack_optional_tlv(
-                    next((tlv for tlv in tlv_array if tlv.tag == field.index), None)
-                ),
-                type=field.type,
-            )
-            for name, field in cls._tlv8_fields.items()
-        }
+        items = dict()
+        for tag, value in read_tlv8(data):
+            # First occurrence of a tag wins
+            items.setdefault(tag, value)
+        result = dict()
+        for name, index, cast in cls._tlv8_decoders:
+            value = items.get(index)
+            if value is not None and cast is not None:
+                value = cast(value)
+            result[name] = value
         return cls(**result)
 
     def pack(self) -> bytes:
-        result = []
-        for name, field in self._tlv8_fields.items():
+        result = bytearray()
+        for name, index in self._tlv8_encoders:
             value = getattr(self, name)
             if value is not None:
-                result.append(TLV8(field.index, value))
-        return b"".join(tlv.pack() for tlv in result)
+                pack_tlv8_into(result, index, pack(value))
+        return bytes(result)
 
     def __repr__(self) -> str:
         data = {